@@ -0,0 +1,79 @@
+"""Benchmark: JSON vs binary serialisation of machine State
+
+Encodes and decodes a State holding large lists, as happens every time a
+machine stops or resumes on the DynamoDB controller. RESUME is decoding the
+State, using the top of its stack and encoding it again, as a machine resumed
+after a Wait does (the lists are passed through without being decoded).
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/bench_codec.py [N]
+"""
+
+import json
+import sys
+import time
+
+from teal_lang.machine import codec
+from teal_lang.machine import types as mt
+from teal_lang.machine.state import State
+
+
+def best_of(fn, repeats=5):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def resume(load, dump):
+    state = load()
+    state.ds_push(state.ds_pop())
+    dump(state)
+
+
+def main(n=10000):
+    state = State(
+        [
+            mt.TlList([mt.TlInt(i) for i in range(n)]),
+            mt.TlList([mt.TlString(f"item {i % 100}") for i in range(n)]),
+            mt.TlInt(0),
+        ]
+    )
+    as_json = json.dumps(state.serialise()).encode()
+    as_binary = codec.dumps(state)
+
+    formats = [
+        (
+            "json",
+            len(as_json),
+            best_of(lambda: json.dumps(state.serialise()).encode()),
+            best_of(lambda: State.deserialise(json.loads(as_json))),
+            best_of(
+                lambda: resume(
+                    lambda: State.deserialise(json.loads(as_json)),
+                    lambda s: json.dumps(s.serialise()).encode(),
+                )
+            ),
+        ),
+        (
+            "binary",
+            len(as_binary),
+            best_of(lambda: codec.dumps(state)),
+            best_of(lambda: codec.loads(as_binary)),
+            best_of(lambda: resume(lambda: codec.loads(as_binary), codec.dumps)),
+        ),
+    ]
+
+    print(
+        f"{'FORMAT':<8} {'BYTES':>10} {'ENCODE (s)':>12} {'DECODE (s)':>12} "
+        f"{'RESUME (s)':>12}"
+    )
+    for name, size, enc, dec, res in formats:
+        print(f"{name:<8} {size:>10} {enc:>12.4f} {dec:>12.4f} {res:>12.4f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
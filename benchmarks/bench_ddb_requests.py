@@ -0,0 +1,92 @@
+"""Benchmark: DynamoDB requests per session
+
+Runs examples/fractals/service.tl on the DynamoDB controller (with Python
+threads), and counts the requests made to DynamoDB, by operation. The Python
+functions that draw and upload the fractals are replaced with trivial ones, so
+only the Teal side is measured.
+
+Needs a DynamoDB endpoint, e.g. DynamoDB Local or moto_server:
+
+    DYNAMODB_ENDPOINT=http://localhost:9000 PYTHONPATH=src \\
+        python benchmarks/bench_ddb_requests.py
+"""
+
+import collections
+import sys
+import threading
+import tempfile
+from pathlib import Path
+
+from pynamodb.connection.base import Connection
+
+import teal_lang.controllers.ddb_model as db
+from teal_lang.controllers import ddb as ddb_controller
+from teal_lang.executors import thread as teal_thread
+from teal_lang.run.common import run_and_wait
+
+SERVICE = Path(__file__).parent.parent / "examples" / "fractals" / "service.tl"
+
+COUNTS = collections.Counter()
+_COUNTS_LOCK = threading.Lock()
+
+
+def _counting(dispatch):
+    def wrapper(self, operation_name, operation_kwargs):
+        with _COUNTS_LOCK:
+            COUNTS[operation_name] += 1
+        return dispatch(self, operation_name, operation_kwargs)
+
+    return wrapper
+
+
+FAKE_MODULES = {
+    "draw.py": (
+        "def random_fractals(n):\n"
+        "    return [['koch', i] for i in range(n)]\n"
+        "def save_fractal_to_file(kind, size, dest):\n"
+        "    return f'{dest}/{kind}_{size}.png'\n"
+    ),
+    "store.py": "def upload_to_bucket(path):\n    return path\n",
+}
+
+
+def _fake_fractal_modules(root):
+    src = Path(root) / "src"
+    src.mkdir()
+    (src / "__init__.py").write_text("")
+    for name, text in FAKE_MODULES.items():
+        (src / name).write_text(text)
+    sys.path.insert(0, str(root))
+
+
+def _join_threads(controller, invoker):
+    # Wait for the machine threads directly, instead of polling the controller
+    # (which would add requests)
+    while threading.active_count() > 1:
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(timeout=60)
+
+
+def main(codec=db.DEFAULT_CODEC):
+    _fake_fractal_modules(tempfile.mkdtemp())
+    if not db.SessionItem.exists():
+        db.SessionItem.create_table(
+            read_capacity_units=1, write_capacity_units=1, wait=True
+        )
+
+    Connection.dispatch = _counting(Connection.dispatch)
+    controller = ddb_controller.DataController.with_new_session(codec)
+    invoker = teal_thread.Invoker(controller)
+    COUNTS.clear()
+    run_and_wait(controller, invoker, _join_threads, SERVICE, "main", [])
+    assert controller.all_stopped()
+
+    print(f"{'OPERATION':<20} {'REQUESTS':>10}")
+    for operation, count in COUNTS.most_common():
+        print(f"{operation:<20} {count:>10}")
+    print(f"{'TOTAL':<20} {sum(COUNTS.values()):>10}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
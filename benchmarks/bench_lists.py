@@ -0,0 +1,38 @@
+"""Benchmark: mapping over long lists
+
+Builds a list with cons (range_tr), then maps over it with a tail-recursive
+loop that uses first, rest and append (see map_tr.tl). With copy-on-write lists
+each of those was O(n), making the whole map O(n^2).
+
+Usage (from the repository root):
+
+    PYTHONPATH=src:test/examples python benchmarks/bench_lists.py [REPEATS]
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from teal_lang.load import compile_file
+
+from bench_machine import run_once
+
+WORKLOADS = ["map_1k", "map_10k", "map_100k"]
+
+
+def main(repeats=3):
+    time.sleep = lambda _: None
+    exe = compile_file(Path(__file__).parent / "map_tr.tl")
+
+    print(f"{'CASE':<12} {'STEPS':>10} {'SECONDS':>10} {'US/ELEMENT':>12}")
+    for function in WORKLOADS:
+        n = int(function.split("_")[1].replace("k", "000"))
+        best = None
+        for _ in range(repeats):
+            steps, seconds = run_once(exe, function, [])
+            best = seconds if best is None else min(best, seconds)
+        print(f"{function:<12} {steps:>10} {best:>10.4f} {best / n * 1e6:>12.2f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
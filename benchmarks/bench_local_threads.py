@@ -0,0 +1,103 @@
+"""Stress benchmark: forking many threads on the in-memory controller
+
+Forks N teal threads (10k by default) that each do a little work, then waits
+on every one of them, and checks the sum. This runs with each executor that
+uses Python threads, and with the in-memory controller as it is (striped
+locks) and with every future and arec sharing one lock (as it used to), to
+show the effect of lock contention.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/bench_local_threads.py [N]
+"""
+
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from pathlib import Path
+
+from teal_lang.controllers import local
+from teal_lang.executors import pool as teal_pool
+from teal_lang.executors import thread as teal_thread
+from teal_lang.run.common import run_and_wait, wait_for_finish
+
+FAN_OUT = """
+fn work(x) {
+  x + x
+}
+
+fn spawn(n, futures) {
+  if n == 0 {
+    futures
+  } else {
+    f = async work(n);
+    spawn(n + -1, conc(f, futures))
+  }
+}
+
+fn total(futures, acc) {
+  if futures == [] {
+    acc
+  } else {
+    total(rest(futures), acc + await first(futures))
+  }
+}
+
+fn main(n) {
+  total(spawn(parse_float(n), []), 0)
+}
+"""
+
+
+class GlobalLockController(local.DataController):
+    """The in-memory controller, but with one lock for everything"""
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.RLock()
+
+    def lock_arec(self, _):
+        return self._lock
+
+    def lock_future(self, _):
+        return self._lock
+
+
+def run_once(filename, n, controller_cls, executor):
+    """Run the fan-out, returning (result, seconds)"""
+    controller = controller_cls()
+    invoker = executor.Invoker(controller)
+    waiter = partial(wait_for_finish, 0.1, 300)
+    start = time.perf_counter()
+    result = run_and_wait(controller, invoker, waiter, filename, "main", [str(n)])
+    elapsed = time.perf_counter() - start
+    assert controller.all_stopped()
+    assert not controller.broken
+    return result, elapsed
+
+
+def main(n=10000):
+    n = int(n)
+    filename = Path(tempfile.mkdtemp()) / "fan_out.tl"
+    filename.write_text(FAN_OUT)
+    expected = 2 * sum(range(1, n + 1))
+
+    print(f"{n} threads")
+    print(f"{'CONTROLLER':<12} {'EXECUTOR':<10} {'SECONDS':>8} {'THREADS/S':>10}")
+    for controller_name, controller_cls in [
+        ("striped", local.DataController),
+        ("global", GlobalLockController),
+    ]:
+        for executor_name, executor in [("threads", teal_thread), ("pool", teal_pool)]:
+            result, elapsed = run_once(filename, n, controller_cls, executor)
+            assert result == expected, f"Got {result}, expected {expected}"
+            print(
+                f"{controller_name:<12} {executor_name:<10} "
+                f"{elapsed:>8.2f} {n / elapsed:>10.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
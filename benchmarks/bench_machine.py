@@ -0,0 +1,110 @@
+"""Micro-benchmark: Teal machine instructions per second
+
+Runs every function with test vectors in test/examples/*.tl, plus the long
+tail-recursive loops in benchmarks/map_tr.tl, and reports how many instructions
+the machine executed per second of time spent inside TlMachine.run().
+
+Threads are run one after the other on a simple run queue (instead of using the
+threading executor), and sleeps are skipped, so the numbers only reflect VM
+time.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src:test/examples python benchmarks/bench_machine.py [REPEATS]
+"""
+
+import collections
+import sys
+import time
+from pathlib import Path
+
+import teal_lang.examples as teal_examples
+from teal_lang.controllers import local
+from teal_lang.load import compile_file
+from teal_lang.machine import types as mt
+from teal_lang.machine.machine import TlMachine
+
+ROOT = Path(__file__).parent.parent
+EXAMPLES_SUBDIR = ROOT / "test" / "examples"
+WORKLOADS = [
+    (Path(__file__).parent / "map_tr.tl", "map_1k", []),
+    (Path(__file__).parent / "map_tr.tl", "count_10k", []),
+]
+
+
+class QueueInvoker:
+    """Run machines sequentially, recording the time spent in each"""
+
+    def __init__(self, data_controller):
+        self.data_controller = data_controller
+        self.exception = None
+        self.queue = collections.deque()
+        self.run_time = 0.0
+
+    def can_continue_inline(self):
+        return False  # measure each thread separately
+
+    def invoke(self, vmid, run_async=True):
+        self.queue.append(vmid)
+
+    def drain(self):
+        while self.queue:
+            m = TlMachine(self.queue.popleft(), self)
+            start = time.perf_counter()
+            m.run()
+            self.run_time += time.perf_counter() - start
+
+
+def run_once(exe, function, args):
+    """Run FUNCTION to completion, returning (steps, seconds in the VM)"""
+    controller = local.DataController()
+    controller.set_executable(exe)
+    controller.stdout = NullList()
+    invoker = QueueInvoker(controller)
+    fn_ptr = exe.bindings[function]
+    invoker.invoke(controller.toplevel_machine(fn_ptr, args))
+    invoker.drain()
+    steps = sum(
+        e.data["steps"] for e in controller.get_probe_events() if e.event == "stop"
+    )
+    return steps, invoker.run_time
+
+
+class NullList(list):
+    """Discard appended items (don't measure stdout growth)"""
+
+    def append(self, _):
+        pass
+
+
+def main(repeats=5):
+    time.sleep = lambda _: None  # skip sleep() and random_sleep()
+
+    names = [p.stem for p in EXAMPLES_SUBDIR.glob("*.tl")]
+    cases = [
+        (filename, fn, args)
+        for filename, fn, args, _ in teal_examples.load_examples(names, EXAMPLES_SUBDIR)
+    ] + WORKLOADS
+
+    results = []
+    for filename, function, args in cases:
+        exe = compile_file(filename)
+        args = [mt.TlString(str(a)) for a in args]
+        total_steps = 0
+        total_time = 0.0
+        for _ in range(repeats):
+            steps, seconds = run_once(exe, function, args)
+            total_steps += steps
+            total_time += seconds
+        results.append((f"{filename.stem}:{function}", total_steps, total_time))
+
+    print(f"{'CASE':<32} {'STEPS':>10} {'SECONDS':>10} {'INSTR/S':>12}")
+    for name, steps, seconds in results:
+        print(f"{name:<32} {steps:>10} {seconds:>10.4f} {steps / seconds:>12.0f}")
+    steps = sum(r[1] for r in results)
+    seconds = sum(r[2] for r in results)
+    print(f"{'TOTAL':<32} {steps:>10} {seconds:>10.4f} {steps / seconds:>12.0f}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
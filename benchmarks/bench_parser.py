@@ -0,0 +1,50 @@
+"""Benchmark: parsing big (generated) Teal programs
+
+Parses synthetic programs of 1k, 10k and 50k lines (or the sizes given), to
+show how parse time grows with the size of the file.
+
+Usage (from the repository root):
+
+    PYTHONPATH=src python benchmarks/bench_parser.py [LINES...]
+"""
+
+import sys
+import time
+
+from teal_lang.teal_parser.parser import tl_parse
+
+FUNCTION = """\
+fn f{i}(a, b) {{
+  x = a + b * {i};
+  if x > 10 {{
+    [x, "item {i}", a]
+  }} else {{
+    f{i}(x + 1, b)
+  }}
+}}
+
+"""
+LINES_PER_FUNCTION = FUNCTION.count("\n")
+
+
+def program(lines: int) -> str:
+    """Make a program with about LINES lines"""
+    return "".join(
+        FUNCTION.format(i=i) for i in range(max(1, lines // LINES_PER_FUNCTION))
+    )
+
+
+def main(*sizes):
+    sizes = [int(s) for s in sizes] or [1000, 10000, 50000]
+    print(f"{'LINES':>8} {'SECONDS':>10} {'LINES/S':>10}")
+    for lines in sizes:
+        text = program(lines)
+        start = time.perf_counter()
+        tl_parse("<bench>", text)
+        elapsed = time.perf_counter() - start
+        actual = text.count("\n")
+        print(f"{actual:>8} {elapsed:>10.2f} {actual / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -7,8 +7,8 @@ Usage:
   teal [options] deploy
   teal [options] destroy
   teal [options] invoke [-f FUNCTION] [--async] [ARG...]
-  teal [options] events [--unified | --json] [SESSION_ID]
-  teal [options] stdout [--json] [SESSION_ID]
+  teal [options] events [-s MODE] [--unified | --json] [SESSION_ID]
+  teal [options] stdout [-s MODE] [--json] [SESSION_ID]
   teal [options] FILE [-f FUNCTION] [-s MODE] [-c MODE] [ARG...]
   teal --version
   teal -h | --help
@@ -19,8 +19,8 @@ Commands:
   deploy   Deploy to the cloud.
   destroy  Remove cloud deployment.
   invoke   Invoke a teal function in the cloud.
-  events   Get events for a session.
-  stdout   Get session output.
+  events   Get events for a session (with -s sqlite, a local session).
+  stdout   Get session output (with -s sqlite, a local session).
   default  Run a Teal function locally.
 
 Options:
@@ -34,8 +34,8 @@ Options:
   --config=CONFIG  Config file to use  [default: teal.toml]
 
   -f FUNCTION, --function=FUNCTION  Target function      [default: main]
-  -s MODE, --storage=MODE           memory | dynamodb    [default: memory]
-  -c MODE, --concurrency=MODE       processes | threads  [default: threads]
+  -s MODE, --storage=MODE           memory | dynamodb | sqlite | redis  [default: memory]
+  -c MODE, --concurrency=MODE       processes | threads | pool | asyncio  [default: threads]
 
   -u, --unified  Merge events into one table
   -j, --json     Print as json
@@ -56,7 +56,7 @@ import logging
 import subprocess
 import sys
 import time
-from functools import wraps
+from functools import partial, wraps
 from pathlib import Path
 
 from docopt import docopt
@@ -100,6 +100,14 @@ def timed(fn):
     return _wrapped
 
 
+def _load_cfg_if_any(args):
+    """Load the config, or return None if there isn't one"""
+    try:
+        return config.load(args)
+    except config.ConfigError:
+        return None
+
+
 def need_cfg(fn):
     """Exec fn with config, requiring a deployment ID"""
 
@@ -111,6 +119,14 @@ def need_cfg(fn):
     return _wrapped
 
 
+def _use_exe_cache(cfg):
+    """Cache compiled executables in the project's data directory, if any"""
+    from .. import load
+
+    if cfg and not load.CACHE_DIR:
+        load.CACHE_DIR = cfg.project.data_dir / load.CACHE_DIRNAME
+
+
 def _run(args):
     fn = args["--function"]
     filename = args["FILE"]
@@ -122,15 +138,16 @@ def _run(args):
 
     # Try to find a timeout for the task. NOTE: we use the "lambda" timeout even
     # for local invocations. Maybe there should be a more general timeout
-    try:
-        cfg = config.load(args)
+    cfg = _load_cfg_if_any(args)
+    _use_exe_cache(cfg)
+    if cfg:
         timeout = cfg.instance.lambda_timeout
-    except config.ConfigError:
+    else:
         # Don't actually need teal.toml to run stuff locally, so here's a
         # default. Maybe it should be None.
         timeout = 60
 
-    supported_storages = ["memory", "dynamodb"]
+    supported_storages = ["memory", "dynamodb", "sqlite", "redis"]
 
     if args["--storage"] not in supported_storages:
         exit_problem(
@@ -139,24 +156,70 @@ def _run(args):
         )
 
     if args["--storage"] == "memory":
-        if args["--concurrency"] == "processes":
-            exit_problem(
-                "Can't use processes with in-memory storage",
-                "Processes can only be used with a thread-safe memory store, like dynamodb",
-            )
-
-        from ..run.local import run_local
+        from ..run.local import (
+            run_local,
+            run_local_asyncio,
+            run_local_pool,
+            run_local_processes,
+        )
 
-        result = run_local(filename, fn, fn_args, timeout)
+        if args["--concurrency"] == "processes":
+            result = run_local_processes(filename, fn, fn_args, timeout)
+        elif args["--concurrency"] == "pool":
+            result = run_local_pool(filename, fn, fn_args, timeout)
+        elif args["--concurrency"] == "asyncio":
+            result = run_local_asyncio(filename, fn, fn_args, timeout)
+        else:
+            result = run_local(filename, fn, fn_args, timeout)
 
     elif args["--storage"] == "dynamodb":
-        from ..run.dynamodb import run_ddb_local, run_ddb_processes
+        from ..run.dynamodb import run_ddb_local, run_ddb_pool, run_ddb_processes
 
+        if args["--concurrency"] == "asyncio":
+            exit_problem(
+                "Can't use asyncio with dynamodb storage",
+                "DynamoDB requests would block the event loop. Use threads or pool.",
+            )
         if args["--concurrency"] == "processes":
             result = run_ddb_processes(filename, fn, fn_args, timeout)
+        elif args["--concurrency"] == "pool":
+            result = run_ddb_pool(filename, fn, fn_args, timeout)
         else:
             result = run_ddb_local(filename, fn, fn_args, timeout)
 
+    elif args["--storage"] == "sqlite":
+        from ..run.sqlite import run_sqlite, run_sqlite_pool
+
+        if args["--concurrency"] not in ("threads", "pool"):
+            exit_problem(
+                f"Can't use {args['--concurrency']} with sqlite storage",
+                "Use threads or pool.",
+            )
+        path = _sqlite_path(cfg)
+        if args["--concurrency"] == "pool":
+            result = run_sqlite_pool(filename, fn, fn_args, timeout, path)
+        else:
+            result = run_sqlite(filename, fn, fn_args, timeout, path)
+
+    elif args["--storage"] == "redis":
+        try:
+            from ..run.redis import run_redis, run_redis_pool
+        except ImportError:
+            exit_problem(
+                "Redis storage needs the redis package",
+                "Install it with `pip install teal-lang[redis]`.",
+            )
+
+        if args["--concurrency"] not in ("threads", "pool"):
+            exit_problem(
+                f"Can't use {args['--concurrency']} with redis storage",
+                "Use threads or pool.",
+            )
+        if args["--concurrency"] == "pool":
+            result = run_redis_pool(filename, fn, fn_args, timeout)
+        else:
+            result = run_redis(filename, fn, fn_args, timeout)
+
     else:
         raise ValueError(args["--storage"])
 
@@ -166,13 +229,18 @@ def _run(args):
 
 def _asm(args):
     """Compile a file and print the assembly"""
-    from ..load import compile_file
+    from ..teal_compiler import tl_compile
+    from ..teal_parser.parser import tl_parse
 
-    exe = compile_file(Path(args["FILE"]))
+    # Always compile (not from the exe cache), to report what the optimiser did
+    filename = args["FILE"]
+    exe = tl_compile(tl_parse(filename, Path(filename).read_text()), count_saved=True)
     print(neutral("\nBYTECODE:"))
     exe.listing()
     print(neutral("\nBINDINGS:\n"))
     exe.bindings_table()
+    print(neutral("\nOPTIMISED:\n"))
+    exe.optimisation_table()
     print()
 
 
@@ -313,39 +381,81 @@ def _invoke(args, cfg):
         print("(Continuing async...)")
 
 
-@need_cfg
-def _events(args, cfg):
+def _sqlite_path(cfg):
+    """Get the SQLite database for local sessions (in the project data dir)
+
+    teal.toml isn't needed to run things locally, so CFG may be None.
+    """
+    from ..controllers import sqlite
+
+    if cfg is None:
+        return sqlite.DEFAULT_PATH
+    return cfg.project.data_dir / sqlite.DB_FILENAME
+
+
+def _sqlite_session(args):
+    """Get a controller for SESSION_ID (or the latest session) in SQLite"""
+    from ..controllers import sqlite
+
+    path = _sqlite_path(_load_cfg_if_any(args))
+    session_id = args["SESSION_ID"] or sqlite.latest_session_id(path)
+    if session_id is None:
+        raise UserResolvableError(
+            f"No sessions found in {path}.",
+            "Run something with `teal FILE -s sqlite` first.",
+        )
+    return sqlite.DataController.with_session_id(session_id, path)
+
+
+def _events(args):
     from . import in_own, in_hosted
 
-    sid = utils.get_session_id(args, cfg)
-    api = _get_instance_api(cfg)
+    if args["--storage"] == "sqlite":
+        from ..run.sqlite import get_events
+
+        controller = _sqlite_session(args)
+        sid = controller.session_id
+        get_data = partial(get_events, controller)
+    else:
+        cfg = config.load(args)
+        sid = utils.get_session_id(args, cfg)
+        api = _get_instance_api(cfg)
+        get_data = partial(api.get_events, sid)
 
     if args["--json"]:
         # Don't show the spinner in JSON mode
-        data = api.get_events(sid)
+        data = get_data()
         print(json.dumps(data, indent=2))
     else:
         with spin(f"Getting events {dim(sid)}"):
-            data = api.get_events(sid)
+            data = get_data()
         if args["--unified"]:
             ui.print_events_unified(data)
         else:
             ui.print_events_by_machine(data)
 
 
-@need_cfg
-def _stdout(args, cfg):
+def _stdout(args):
     from . import in_own, in_hosted
 
-    sid = utils.get_session_id(args, cfg)
-    api = _get_instance_api(cfg)
+    if args["--storage"] == "sqlite":
+        from ..run.sqlite import get_output
+
+        controller = _sqlite_session(args)
+        sid = controller.session_id
+        get_data = partial(get_output, controller)
+    else:
+        cfg = config.load(args)
+        sid = utils.get_session_id(args, cfg)
+        api = _get_instance_api(cfg)
+        get_data = partial(api.get_stdout, sid)
 
     if args["--json"]:
-        data = api.get_stdout(sid)
+        data = get_data()
         print(json.dumps(data, indent=2))
     else:
         with spin(f"Getting stdout {dim(sid)}") as sp:
-            data = api.get_stdout(sid)
+            data = get_data()
             sp.ok(TICK)
         ui.print_outputs(data)
 
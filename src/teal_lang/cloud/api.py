@@ -79,17 +79,29 @@ class TealInstanceApi:
         data = _call_cloud_api(self._deploy_config, FnEventHandler, payload)
         return SessionInfo(**data)
 
+    def _get_all_pages(self, cls, session_id: str, key: str) -> dict:
+        """Call a paginated API function, joining the KEY list of each page"""
+        data = _call_cloud_api(self._deploy_config, cls, {"session_id": session_id})
+        while data.get("next"):
+            page = _call_cloud_api(
+                self._deploy_config,
+                cls,
+                {"session_id": session_id, "next": data["next"]},
+            )
+            data[key] += page[key]
+            data["next"] = page.get("next")
+        return data
+
     def get_stdout(self, session_id: str) -> dict:
         # TODO structure this result
-        return _call_cloud_api(
-            self._deploy_config, FnGetOutput, {"session_id": session_id}
-        )
+        data = self._get_all_pages(FnGetOutput, session_id, "output")
+        # Output is stored per thread
+        data["output"].sort(key=lambda item: item["time"])
+        return data
 
     def get_events(self, session_id: str):
         # TODO structure this result
-        return _call_cloud_api(
-            self._deploy_config, FnGetEvents, {"session_id": session_id}
-        )
+        return self._get_all_pages(FnGetEvents, session_id, "events")
 
     def get_logs(self, session_id: str):
         raise NotImplementedError
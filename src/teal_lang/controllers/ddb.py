@@ -6,7 +6,7 @@ session.
 
 Data per session:
 - futures (resolved, value, chain, continuations - machine, offset)
-- machines (probe logs, state - ip, stopped flag, stacks, and bindings)
+- machines (probe logs, state - ip, stopped flag, stacks, and local variables)
 
 Data exchange points:
 - machine forks (State of new machine set to point at the fork IP)
@@ -17,12 +17,15 @@ Data exchange points:
 - machine stops (upload the State)
 - machine continues (download the State)
 """
+import contextlib
 import functools
 import logging
+import secrets
 import sys
+import threading
 import time
 import warnings
-from typing import List, Tuple
+from typing import Iterator, List, Tuple
 
 from ..machine import future as fut
 from ..machine.controller import Controller, ControllerError
@@ -52,16 +55,47 @@ except ModuleNotFoundError:
 LOG = logging.getLogger(__name__)
 
 
+class _WriteBehind(threading.local):
+    """Items written by this (Python) thread, but not yet saved
+
+    Activation records allocated by this thread are private to it until the
+    next sync point - their pointers can't be known by any other machine until
+    a new thread is created (which is a sync point). So they are read and
+    modified here, and only saved (if they are still alive) when synced.
+
+    Machine states are written once per sync instead of on every set_state.
+    """
+
+    def __init__(self):
+        self.arecs = {}  # ptr -> ActivationRecord (None until set)
+        self.states = {}  # vmid -> State
+
+
+class _IdLease:
+    """A block of IDs reserved from a META counter, handed out locally"""
+
+    def __init__(self):
+        self.next = 0
+        self.end = 0
+
+
 class DataController(Controller):
     supports_plugins = True
 
     @classmethod
-    def with_new_session(cls):
-        """Create a data controller for a new session"""
+    def with_new_session(cls, codec: str = db.DEFAULT_CODEC):
+        """Create a data controller for a new session
+
+        codec: How machine data is stored ("json" or "binary")
+        """
+        try:
+            db_cls = db.SESSION_ITEM_CLASSES[codec]
+        except KeyError as exc:
+            raise ControllerError(f"Unknown codec: {codec}") from exc
         base_session = db.init_base_session()
-        this_session = db.new_session()
-        LOG.info("Created new session, %s", this_session.session_id)
-        return cls(this_session, base_session)
+        this_session = db.new_session(db_cls)
+        LOG.info("Created new session, %s (%s)", this_session.session_id, codec)
+        return cls(this_session, base_session, db_cls=db_cls)
 
     @classmethod
     def with_session_id(cls, session_id: str, db_cls=db.SessionItem):
@@ -71,11 +105,17 @@ class DataController(Controller):
         except db_cls.DoesNotExist as exc:
             raise ControllerError("Session does not exist") from exc
         LOG.info("Reloaded session %s", session_id)
+        # Use the same codec as the session was created with
+        codec = this_session.meta.codec or db_cls.codec_name
+        db_cls = db.SESSION_ITEM_CLASSES[codec]
         return cls(this_session, base_session, db_cls=db_cls)
 
     def __init__(self, this_session, base_session, db_cls=db.SessionItem):
         self.SI = db_cls
         self.session_id = this_session.session_id
+        self._cache = _WriteBehind()
+        self._leases = dict(num_threads=_IdLease(), num_arecs=_IdLease())
+        self._lease_lock = threading.Lock()
         if base_session.meta.exe:
             self.executable = Executable.deserialise(base_session.meta.exe)
         elif this_session.meta.exe:
@@ -101,39 +141,52 @@ class DataController(Controller):
         item = self._qry(group, item_id)
         return db.SessionLocker(item)
 
+    def _update_meta(self, *actions):
+        """Atomically update META, returning the updated item
+
+        META is only ever modified this way (never saved whole), so concurrent
+        updates to different fields don't overwrite each other.
+        """
+        s = self.SI(self.session_id, META)
+        s.update(actions=list(actions))
+        return s
+
+    def _lease_id(self, counter: str) -> int:
+        """Get a new ID from COUNTER, reserving a new block if necessary"""
+        with self._lease_lock:
+            lease = self._leases[counter]
+            if lease.next == lease.end:
+                attr = getattr(self.SI.meta, counter)
+                s = self._update_meta(attr.set(attr + db.ID_LEASE_SIZE))
+                lease.end = getattr(s.meta, counter)
+                lease.next = lease.end - db.ID_LEASE_SIZE
+            lease.next += 1
+            return lease.next - 1
+
     def set_executable(self, exe):
         self.executable = exe
-        s = self._qry(META)
-        s.meta.exe = exe.serialise()
-        s.save()
+        self._update_meta(self.SI.meta.exe.set(exe.serialise()))
         LOG.info("Updated session code")
 
     def set_entrypoint(self, fn_name: str):
-        s = self._qry(META)
-        s.meta.entrypoint = fn_name
-        s.save()
+        self._update_meta(self.SI.meta.entrypoint.set(fn_name))
 
     ## Threads
 
     def new_thread(self) -> int:
         """Create a new thread, returning the thead ID"""
-        with self._lock_item(META):
-            s = self._qry(META)
-            vmid = s.meta.num_threads
-            s.meta.num_threads += 1
-            s.meta.stopped.append(False)
-            s.save()
-
-        db.new_session_item(self.session_id, f"{STATE}:{vmid}", state=State([])).save()
+        vmid = self._lease_id("num_threads")
+        self._cache.states[vmid] = State([])
         db.new_session_item(
-            self.session_id, f"{FUTURE}:{vmid}", future=fut.Future()
+            self.session_id, f"{FUTURE}:{vmid}", self.SI, future=fut.Future()
         ).save()
         return vmid
 
     def get_thread_ids(self) -> List[int]:
         """Get a list of thread IDs in this session"""
         s = self._qry(META)
-        return list(range(s.meta.num_threads))
+        # Leased IDs that were never used aren't included
+        return sorted(int(vmid) for vmid in s.meta.stopped)
 
     def get_top_level_future(self):
         return self.get_future(0)
@@ -141,24 +194,72 @@ class DataController(Controller):
     def is_top_level(self, vmid):
         return vmid == 0
 
+    def _num_running(self) -> int:
+        s = self.SI.get(
+            self.session_id,
+            META,
+            consistent_read=True,
+            attributes_to_get=["meta.num_running"],
+        )
+        return s.meta.num_running
+
     def all_stopped(self):
-        s = self._qry(META)
-        return all(s.meta.stopped)
+        return self._num_running() == 0
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        """Long-poll the number of running threads until it reaches zero
+
+        Only the counter is read (not the whole META item), and the polling
+        interval backs off from db.WAIT_POLL to db.WAIT_POLL_MAX.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = db.WAIT_POLL
+        while self._num_running() > 0:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            time.sleep(interval)
+            interval = min(interval * 2, db.WAIT_POLL_MAX)
+        return True
 
     def set_stopped(self, vmid, stopped: bool):
-        with self._lock_item(META):
-            s = self._qry(META)
-            s.meta.stopped[vmid] = stopped
-            s.save()
+        # num_running counts runs, not threads: a waiting thread may be resumed
+        # (by the thread resolving its future) before it has finished stopping.
+        count = self.SI.meta.num_running
+        self._update_meta(
+            self.SI.meta.stopped[str(vmid)].set(stopped),
+            count.set(count + (-1 if stopped else 1)),
+        )
 
     def set_state(self, vmid, state):
         # NOTE: no locking required, no inter-thread state access allowed
-        s = self._qry(STATE, vmid)
-        s.state = state
-        s.save()
+        self._cache.states[vmid] = state
 
     def get_state(self, vmid):
-        return self._qry(STATE, vmid).state
+        try:
+            return self._cache.states[vmid]
+        except KeyError:
+            return self._qry(STATE, vmid).state
+
+    def sync(self):
+        """Save the items cached by this thread (see _WriteBehind)"""
+        cache = self._cache
+        items = [
+            db.new_session_item(self.session_id, f"{AREC}:{ptr}", self.SI, arec=rec)
+            for ptr, rec in cache.arecs.items()
+            if rec is not None
+        ] + [
+            db.new_session_item(self.session_id, f"{STATE}:{vmid}", self.SI, state=st)
+            for vmid, st in cache.states.items()
+        ]
+        if items:
+            with self.SI.batch_write() as batch:
+                for item in items:
+                    batch.save(item)
+        cache.arecs.clear()
+        cache.states.clear()
 
     ## controller properties
 
@@ -169,22 +270,7 @@ class DataController(Controller):
 
     @broken.setter
     def broken(self, value):
-        try:
-            with self._lock_item(META):
-                s = self._qry(META)
-                s.meta.broken = True
-                s.save()
-        except db.LockTimeout:
-            # If a thread dies while updating META, this will timeout. However,
-            # in that case, broken is True and we *should* ignore the lock and
-            # carry on. If it's broken, the lock doesn't matter anyway.
-            # Hopefully this isn't a genuine race condition.
-            if value:
-                s = self._qry(META)
-                s.meta.broken = True
-                s.save()
-            else:
-                raise
+        self._update_meta(self.SI.meta.broken.set(value))
 
     @property
     def result(self):
@@ -193,68 +279,109 @@ class DataController(Controller):
 
     @result.setter
     def result(self, value):
-        with self._lock_item(META):
-            s = self._qry(META)
-            s.meta.result = value
-            s.save()
+        self._update_meta(self.SI.meta.result.set(value))
 
     ## arecs
 
     def new_arec(self):
-        with self._lock_item(META):
-            s = self._qry(META)
-            ptr = s.meta.num_arecs
-            s.meta.num_arecs += 1
-            s.save()
+        if db.AREC_IDS == "random":
+            ptr = secrets.randbits(120)  # fits in a DynamoDB number
+        else:
+            ptr = self._lease_id("num_arecs")
+        self._cache.arecs[ptr] = None
         return ptr
 
     def set_arec(self, ptr, rec):
+        if ptr in self._cache.arecs:
+            self._cache.arecs[ptr] = rec
+            return
         try:
             s = self._qry(AREC, ptr)
             s.arec = rec
         except ControllerError:
-            s = db.new_session_item(self.session_id, f"{AREC}:{ptr}", arec=rec)
+            s = db.new_session_item(self.session_id, f"{AREC}:{ptr}", self.SI, arec=rec)
         s.save()
 
     def get_arec(self, ptr):
+        if ptr in self._cache.arecs:
+            return self._cache.arecs[ptr]
         return self._qry(AREC, ptr).arec
 
+    # Reference counts are changed with atomic updates, which return the new
+    # count - so pop_arec needs no lock.
+
     def increment_ref(self, ptr):
-        s = self._qry(AREC, ptr)
+        if ptr in self._cache.arecs:
+            self._cache.arecs[ptr].ref_count += 1
+            return
+        s = self.SI(self.session_id, f"{AREC}:{ptr}")
         s.update(actions=[self.SI.arec.ref_count.set(self.SI.arec.ref_count + 1)])
 
     def decrement_ref(self, ptr):
-        s = self._qry(AREC, ptr)
+        if ptr in self._cache.arecs:
+            self._cache.arecs[ptr].ref_count -= 1
+            return self._cache.arecs[ptr]
+        s = self.SI(self.session_id, f"{AREC}:{ptr}")
         s.update(actions=[self.SI.arec.ref_count.set(self.SI.arec.ref_count - 1)])
         return s.arec
 
     def delete_arec(self, ptr):
-        s = self._qry(AREC, ptr)
-        s.arec.deleted = True
+        if ptr in self._cache.arecs:
+            # Never saved, and now garbage - so it never needs to be
+            del self._cache.arecs[ptr]
+            return
+        s = self.SI(self.session_id, f"{AREC}:{ptr}")
+        s.update(actions=[self.SI.arec.deleted.set(True)])
 
     def lock_arec(self, ptr):
-        return self._lock_item(AREC, ptr)
+        return contextlib.nullcontext()
 
     ## probes
 
-    def set_probe_data(self, vmid, probe):
-        # FIXME - 400k limit on item size is quite easy to break with events and
-        # logs.
-        events = [item.serialise() for item in probe.events]
-        s = self._qry(PEVENTS)
-        s.update(actions=[self.SI.pevents.set(self.SI.pevents.append(events))])
+    def _new_shards(self, group, vmid, records: list) -> list:
+        """Make new shard items of GROUP holding RECORDS (see new_shard_id)"""
+        return [
+            db.new_session_item(
+                self.session_id,
+                db.new_shard_id(group, vmid),
+                self.SI,
+                **{group: records[i : i + db.SHARD_SIZE]},
+            )
+            for i in range(0, len(records), db.SHARD_SIZE)
+        ]
+
+    def iter_shards(self, group, start_after=None) -> Iterator[Tuple[str, list]]:
+        """Iterate over the shards of GROUP, as (item ID, records) tuples
+
+        Shards are fetched a page at a time, as they're needed. If START_AFTER
+        (a shard item ID) is given, start with the shard after it.
+        """
+        # Every shard ID is between "<group>:" and "<group>;"
+        first = start_after or f"{group}:"
+        items = self.SI.query(
+            self.session_id,
+            self.SI.item_id.between(first, f"{group};"),
+            consistent_read=True,
+        )
+        for s in items:
+            if s.item_id != start_after:
+                yield s.item_id, getattr(s, group)
 
-        logs = [item.serialise() for item in probe.logs]
-        s = self._qry(PLOGS)
-        s.update(actions=[self.SI.plogs.set(self.SI.plogs.append(logs))])
+    def set_probe_data(self, vmid, probe):
+        items = self._new_shards(
+            PEVENTS, vmid, [item.serialise() for item in probe.events]
+        ) + self._new_shards(PLOGS, vmid, [item.serialise() for item in probe.logs])
+        with self.SI.batch_write() as batch:
+            for item in items:
+                batch.save(item)
 
     def get_probe_logs(self):
-        s = self._qry(PLOGS)
-        return [ProbeLog.deserialise(item) for item in s.plogs]
+        for _, records in self.iter_shards(PLOGS):
+            yield from (ProbeLog.deserialise(item) for item in records)
 
     def get_probe_events(self):
-        s = self._qry(PEVENTS)
-        return [ProbeEvent.deserialise(item) for item in s.pevents]
+        for _, records in self.iter_shards(PEVENTS):
+            yield from (ProbeEvent.deserialise(item) for item in records)
 
     ## futures
 
@@ -262,46 +389,69 @@ class DataController(Controller):
         s = self._qry(FUTURE, vmid)
         return s.future
 
+    # Everything that writes a future must increment its version (see
+    # update_future)
+
     def set_future(self, vmid, future: fut.Future):
         s = self._qry(FUTURE, vmid)
         s.future = future
+        s.version += 1
         s.save()
 
     def add_continuation(self, fut_ptr, vmid):
-        s = self._qry(FUTURE, fut_ptr)
+        s = self.SI(self.session_id, f"{FUTURE}:{fut_ptr}")
         s.update(
             actions=[
                 self.SI.future.continuations.set(
                     self.SI.future.continuations.append([vmid])
-                )
+                ),
+                self.SI.version.set(self.SI.version + 1),
             ]
         )
 
     def set_future_chain(self, fut_ptr, chain):
-        s = self._qry(FUTURE, fut_ptr)
-        s.update(actions=[self.SI.future.chain.set(chain)])
+        s = self.SI(self.session_id, f"{FUTURE}:{fut_ptr}")
+        s.update(
+            actions=[
+                self.SI.future.chain.set(chain),
+                self.SI.version.set(self.SI.version + 1),
+            ]
+        )
 
     def lock_future(self, ptr):
         return self._lock_item(FUTURE, ptr)
 
+    def update_future(self, vmid, modify):
+        """Read-modify-write a future, with optimistic concurrency
+
+        The future is only saved if its version hasn't changed since it was
+        read. If it has, MODIFY is tried again (after a short, random delay).
+        """
+        for attempt in range(db.CAS_RETRIES):
+            s = self._qry(FUTURE, vmid)
+            changed, result = modify(s.future)
+            if not changed or db.save_if_unchanged(s):
+                return result
+            LOG.info("Conflict updating future %s (attempt %d)", vmid, attempt)
+            db.backoff(attempt)
+        raise db.UpdateConflict(f"Couldn't update future {vmid}")
+
     ## stdout
 
     def get_stdout(self):
-        s = self._qry(STDOUT)
-        return [StdoutItem.deserialise(item) for item in s.stdout]
+        for _, records in self.iter_shards(STDOUT):
+            yield from (StdoutItem.deserialise(item) for item in records)
 
     def write_stdout(self, item):
         # Avoid empty strings (DynamoDB can't handle them)
         if item.text:
             sys.stdout.write(item.text)
-            s = self._qry(STDOUT)
-            s.update(
-                actions=[self.SI.stdout.set(self.SI.stdout.append([item.serialise()]))]
-            )
+            (shard,) = self._new_shards(STDOUT, item.thread, [item.serialise()])
+            shard.save()
 
     @property  # Legacy. TODO: remove
     def stdout(self):
-        return self.get_stdout()
+        return list(self.get_stdout())
 
     ## plugin API
 
@@ -318,7 +468,7 @@ class DataController(Controller):
         ).save()
         # Create the actual future
         db.new_session_item(
-            self.session_id, f"{FUTURE}:{future_id}", future=fut.Future(),
+            self.session_id, f"{FUTURE}:{future_id}", self.SI, future=fut.Future(),
         ).save()
         return future_id
 
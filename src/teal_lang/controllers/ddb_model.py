@@ -2,8 +2,10 @@
 
 import base64
 import dataclasses
+import itertools
 import logging
 import os
+import random
 import threading
 import time
 import uuid
@@ -13,6 +15,7 @@ from typing import List
 
 from botocore.exceptions import ClientError
 from pynamodb.attributes import (
+    BinaryAttribute,
     BooleanAttribute,
     JSONAttribute,
     ListAttribute,
@@ -21,13 +24,15 @@ from pynamodb.attributes import (
     UnicodeAttribute,
     UTCDateTimeAttribute,
 )
-from pynamodb.exceptions import UpdateError, TableDoesNotExist
+from pynamodb.exceptions import PutError, UpdateError, TableDoesNotExist
 from pynamodb.models import Model
 
 from ..exceptions import TealError
+from ..machine import codec
+from ..machine import types as mt
 from ..machine.arec import ActivationRecord
 from ..machine.future import Future
-from ..machine.state import State
+from ..machine.state import State, lazy_frame
 
 LOG = logging.getLogger(__name__)
 
@@ -39,6 +44,28 @@ if "DYNAMODB_ENDPOINT" not in os.environ and "USE_LIVE_AWS" not in os.environ:
 # Get the session item time-to-live
 ITEM_TTL = int(os.getenv("TEAL_SESSION_TTL", 0))  # TTL=0 means don't expire
 
+# Serialisation format for new sessions ("json" or "binary")
+DEFAULT_CODEC = os.getenv("TEAL_CODEC", "json")
+
+# Thread and activation record IDs are reserved from counters in the session
+# META item, this many at a time
+ID_LEASE_SIZE = int(os.getenv("TEAL_ID_LEASE_SIZE", 16))
+
+# How to allocate activation record IDs: "lease" (from the META counter), or
+# "random" (120-bit random numbers, needing no counter at all)
+AREC_IDS = os.getenv("TEAL_AREC_IDS", "lease")
+
+# Conditional writes that lose a race are retried (after a random delay of up to
+# CAS_BACKOFF seconds, doubling each time, up to CAS_MAX_BACKOFF) this many times
+CAS_RETRIES = 10
+CAS_BACKOFF = 0.005
+CAS_MAX_BACKOFF = 0.25
+
+# Waiting for a session to finish polls a small counter, starting quickly (to
+# notice short sessions finishing) and backing off (to save read capacity).
+WAIT_POLL = 0.01
+WAIT_POLL_MAX = 0.5
+
 # Default Teal sessions table name
 DEFAULT_TABLE_NAME = "TealSessions"
 
@@ -55,6 +82,22 @@ PLOGS = "plogs"
 PEVENTS = "pevents"
 STDOUT = "stdout"
 
+# Probe logs, probe events and stdout are stored in "shards" - items with IDs
+# "<group>:<vmid>:<seq>", each holding up to this many records (in the attribute
+# with the same name as the group)
+SHARD_SIZE = 100
+
+_shard_seq = itertools.count()
+
+
+def new_shard_id(group: str, vmid) -> str:
+    """Item ID for a new shard of GROUP, written by machine VMID
+
+    The shards of one machine sort in the order they were written.
+    """
+    seq = next(_shard_seq) % 10000
+    return f"{group}:{vmid}:{time.time_ns():020d}{seq:04d}"
+
 
 class FutureAttribute(MapAttribute):
     resolved = BooleanAttribute(default=False)
@@ -75,7 +118,7 @@ class ARecAttribute(MapAttribute):
     dynamic_chain = NumberAttribute(null=True)
     vmid = NumberAttribute(null=True)
     call_site = NumberAttribute(null=True)
-    bindings = MapAttribute(default=dict)
+    locals = ListAttribute(default=list)
     deleted = BooleanAttribute(default=False)
 
     def serialize(self, value):
@@ -85,11 +128,63 @@ class ARecAttribute(MapAttribute):
         return ActivationRecord.deserialise(super().deserialize(value).as_dict())
 
 
+def _nested_binary(value: bytes) -> bytes:
+    """Decode binary data that was nested in a MapAttribute
+
+    pynamodb base64 encodes binary values itself, and DynamoDB then encodes
+    them again. Top-level values are decoded twice on the way back, but values
+    nested in a map are only decoded once.
+    """
+    return value if value.startswith(codec.MAGIC) else base64.b64decode(value)
+
+
+class BinaryFutureAttribute(FutureAttribute):
+    """A Future, with the value stored in the binary format"""
+
+    value = BinaryAttribute(null=True)
+
+    def serialize(self, value):
+        data = dict(
+            continuations=value.continuations,
+            chain=value.chain,
+            resolved=value.resolved,
+            value=codec.dumps_lazily(value.value) if value.value is not None else None,
+        )
+        return MapAttribute.serialize(self, data)
+
+    def deserialize(self, value):
+        data = MapAttribute.deserialize(self, value).as_dict()
+        if data.get("value", None) is not None:
+            data["value"] = codec.loads(_nested_binary(data["value"]))
+        return Future(**data)
+
+
+class BinaryARecAttribute(ARecAttribute):
+    """An ActivationRecord, with the locals stored in the binary format"""
+
+    locals = BinaryAttribute(null=True)
+
+    def serialize(self, value):
+        data = {f.name: getattr(value, f.name) for f in dataclasses.fields(value)}
+        data["function"] = value.function.serialise()
+        data["locals"] = codec.dumps_lazily(value.locals)
+        return MapAttribute.serialize(self, data)
+
+    def deserialize(self, value):
+        data = MapAttribute.deserialize(self, value).as_dict()
+        data["function"] = mt.TlType.deserialise(data["function"])
+        if data.get("locals", None) is not None:
+            data["locals"] = lazy_frame(codec.loads(_nested_binary(data["locals"])))
+        return ActivationRecord(**data)
+
+
 class MetaAttribute(MapAttribute):
+    codec = UnicodeAttribute(null=True)
     num_threads = NumberAttribute(default=0)
     num_arecs = NumberAttribute(default=0)
     entrypoint = UnicodeAttribute(null=True)
-    stopped = ListAttribute(default=list)
+    stopped = MapAttribute(default=dict)  # str(vmid) -> bool
+    num_running = NumberAttribute(default=0)  # threads not stopped
     exe = MapAttribute(null=True)
     result = JSONAttribute(null=True)
     broken = BooleanAttribute(default=False)
@@ -111,6 +206,16 @@ class StateAttribute(TealDataAttribute):
     value_cls = State
 
 
+class BinaryStateAttribute(BinaryAttribute):
+    """State stored in the binary format"""
+
+    def serialize(self, value):
+        return super().serialize(codec.dumps(value))
+
+    def deserialize(self, value):
+        return codec.loads(super().deserialize(value))
+
+
 class SessionItem(Model):
     class Meta:
         table_name = os.environ.get("DYNAMODB_TABLE", DEFAULT_TABLE_NAME)
@@ -119,7 +224,8 @@ class SessionItem(Model):
 
     session_id = UnicodeAttribute(hash_key=True)
     item_id = UnicodeAttribute(range_key=True)
-    locked = BooleanAttribute(default=False)
+    version = NumberAttribute(default=0)  # incremented by conditional saves
+    lock_expiry = NumberAttribute(null=True)  # see SessionLocker
     # TODO create LSI on created_at
     created_at = UTCDateTimeAttribute()
     updated_at = UTCDateTimeAttribute()
@@ -136,6 +242,42 @@ class SessionItem(Model):
     future = FutureAttribute(null=True)
     state = StateAttribute(null=True)
 
+    codec_name = "json"
+
+
+class BinarySessionItem(SessionItem):
+    """Session items storing machine data in the binary format
+
+    Only the bulky Teal data is binary - the fields that are updated in place
+    (e.g. ref_count, continuations) are the same as in SessionItem.
+    """
+
+    class Meta(SessionItem.Meta):
+        pass
+
+    arec = BinaryARecAttribute(null=True)
+    future = BinaryFutureAttribute(null=True)
+    state = BinaryStateAttribute(null=True)
+
+    codec_name = "binary"
+
+
+# Session item model for each codec
+SESSION_ITEM_CLASSES = {cls.codec_name: cls for cls in (SessionItem, BinarySessionItem)}
+
+
+def _reset_connections():
+    """Make new connections in a forked process (see executors.multiprocess)
+
+    Otherwise, the pooled HTTP connections are shared with the parent process,
+    and requests from the two can get each other's responses.
+    """
+    for cls in SESSION_ITEM_CLASSES.values():
+        cls._connection = None
+
+
+os.register_at_fork(after_in_child=_reset_connections)
+
 
 ###
 
@@ -165,12 +307,12 @@ def set_base_exe(exe):
     base_session.save()
 
 
-def new_session_item(sid, item_id, **extra) -> SessionItem:
+def new_session_item(sid, item_id, db_cls=SessionItem, **extra) -> SessionItem:
     """Helper to make a new item with given session_id, item_id and extra data
 
     Sets the housekeeping fields (TTL, created_at, expires_on, etc).
     """
-    return SessionItem(
+    return db_cls(
         session_id=sid,
         item_id=item_id,
         created_at=datetime.now(),
@@ -180,17 +322,13 @@ def new_session_item(sid, item_id, **extra) -> SessionItem:
     )
 
 
-def new_session() -> SessionItem:
+def new_session(db_cls=SessionItem) -> SessionItem:
     """Create a new session, returning the 'meta' item for it"""
     base_session = SessionItem.get(BASE_SESSION_HASH_KEY, META)
     sid = str(uuid.uuid4())
 
-    s = new_session_item(sid, META, meta=MetaAttribute())
+    s = new_session_item(sid, META, db_cls, meta=MetaAttribute(codec=db_cls.codec_name))
     s.save()
-    # Create the empty placeholders for the collections
-    new_session_item(sid, PLOGS, plogs=[]).save()
-    new_session_item(sid, PEVENTS, pevents=[]).save()
-    new_session_item(sid, STDOUT, stdout=[]).save()
 
     # Record the new session for cheap retrieval later
     SessionItem(
@@ -224,25 +362,61 @@ def list_sessions(cls=SessionItem) -> List[str]:
 ###
 
 
-def try_lock(session, thread_lock) -> bool:
-    """Try to acquire a lock on an item, returning True if successful"""
+def is_conditional_failure(exc: Exception) -> bool:
+    """Whether EXC is due to a write's condition not holding"""
+    cause = getattr(exc, "cause", None)
+    if isinstance(cause, ClientError):
+        code = cause.response["Error"].get("Code")
+        return code == "ConditionalCheckFailedException"
+    return False
+
+
+def backoff(attempt: int):
+    """Wait before retrying a conflicting write (exponential, full jitter)"""
+    delay = min(CAS_MAX_BACKOFF, CAS_BACKOFF * 2 ** attempt)
+    time.sleep(random.uniform(0, delay))
+
+
+class UpdateConflict(TealError):
+    """Too many concurrent modifications to an item"""
+
+
+def save_if_unchanged(item: SessionItem):
+    """Save ITEM, but only if it hasn't been changed since it was read
+
+    Returns whether it was saved. The item's version is incremented.
+    """
+    version = item.version
+    item.version = version + 1
+    try:
+        item.save(condition=(SessionItem.version == version))
+        return True
+    except PutError as exc:
+        if is_conditional_failure(exc):
+            return False
+        raise
+
+
+def try_lock(session, thread_lock, expiry: float) -> bool:
+    """Try to acquire a lock on an item until EXPIRY, returning True if successful"""
     if not thread_lock.acquire(blocking=False):
         return False
 
     try:
         session.update(
-            [SessionItem.locked.set(True)], condition=(SessionItem.locked == False)
+            [SessionItem.lock_expiry.set(expiry)],
+            condition=(
+                SessionItem.lock_expiry.does_not_exist()
+                | (SessionItem.lock_expiry < time.time())
+            ),
         )
         return True
 
     except UpdateError as e:
         thread_lock.release()
-        if isinstance(e.cause, ClientError):
-            code = e.cause.response["Error"].get("Code")
-            LOG.info("Failed to lock: %s", code)
-            if code == "ConditionalCheckFailedException":
-                return False
-            raise
+        if is_conditional_failure(e):
+            LOG.info("Failed to lock %s", session)
+            return False
         raise
 
 
@@ -253,13 +427,20 @@ class LockTimeout(TealError):
 class SessionLocker(AbstractContextManager):
     """Lock an item for modification (re-entrant for chain_resolve)
 
+    The lock is a lease: it expires after LEASE seconds, so a holder that
+    crashes can't block the item for longer than that. Prefer conditional
+    writes (save_if_unchanged) - this is only for operations that really need
+    mutual exclusion.
+
     https://docs.python.org/3/library/contextlib.html#reentrant-context-managers
     """
 
-    def __init__(self, session, timeout=2.0):
+    def __init__(self, session, timeout=2.0, lease=10.0):
         self.session = session
         self.timeout = timeout
+        self.lease = lease
         self._thread_lock = threading.Lock()
+        self._expiry = None
         self.lock_count = {}
 
     def __enter__(self):
@@ -273,13 +454,19 @@ class SessionLocker(AbstractContextManager):
             return
 
         start = time.time()
-        while not try_lock(self.session, self._thread_lock):
-            time.sleep(0.01)
+        attempt = 0
+        while True:
+            expiry = time.time() + self.lease
+            if try_lock(self.session, self._thread_lock, expiry):
+                break
             if time.time() - start > self.timeout:
                 t = time.time() % 1000.0
                 LOG.debug(f"{t:.3f} :: Timeout getting lock")
                 raise LockTimeout
+            backoff(attempt)
+            attempt += 1
 
+        self._expiry = expiry
         self.lock_count[tid] = 1
 
         t = time.time() % 1000.0
@@ -299,7 +486,15 @@ class SessionLocker(AbstractContextManager):
         assert self.lock_count[tid] == 0
 
         LOG.debug(f"%d :: Releasing %s...", time.time() % 1000.0, self.session)
-        self.session.update(
-            [SessionItem.locked.set(False)], condition=(SessionItem.locked == True)
-        )
-        self._thread_lock.release()
+        try:
+            # Only if the lease hasn't expired and been taken by someone else
+            self.session.update(
+                [SessionItem.lock_expiry.remove()],
+                condition=(SessionItem.lock_expiry == self._expiry),
+            )
+        except UpdateError as e:
+            if not is_conditional_failure(e):
+                raise
+            LOG.warning("Lock on %s expired before it was released", self.session)
+        finally:
+            self._thread_lock.release()
@@ -13,18 +13,26 @@ from ..machine.controller import Controller
 # https://docs.python.org/3/library/logging.html#logging.basicConfig
 LOG = logging.getLogger(__name__)
 
+# Futures and arecs are locked by stripe (ptr modulo this), rather than all
+# sharing one lock, so threads resolving different futures don't contend.
+LOCK_STRIPES = 64
+
 
 class DataController(Controller):
     def __init__(self):
         self._machine_future = {}
         self._machine_state = {}
         self._machine_stopped = {}
+        self._num_running = 0  # see set_stopped
         self._machine_idx = 0  # always increasing machine counter
         self._arec_idx = 0  # always increasing arec counter
         self._probe_logs = []
         self._probe_events = []
         self._arecs = {}
-        self._lock = threading.RLock()
+        self._ids_lock = threading.Lock()
+        self._future_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._arec_locks = [threading.RLock() for _ in range(LOCK_STRIPES)]
+        self._stopped_cond = threading.Condition()
         self.session_id = 0  # constant for local
         self.executable = None
         self.stdout = []  # shared standard output
@@ -40,8 +48,9 @@ class DataController(Controller):
     ## Threads
 
     def new_thread(self):
-        vmid = self._machine_idx
-        self._machine_idx += 1
+        with self._ids_lock:
+            vmid = self._machine_idx
+            self._machine_idx += 1
         return vmid
 
     def get_thread_ids(self) -> List[int]:
@@ -54,10 +63,20 @@ class DataController(Controller):
         return vmid == 0
 
     def all_stopped(self):
-        return all(self._machine_stopped.values())
+        return self._num_running == 0
 
     def set_stopped(self, vmid, stopped: bool):
-        self._machine_stopped[vmid] = stopped
+        # Count runs, not threads: a waiting thread may be resumed (by the
+        # thread resolving its future) before it has finished stopping.
+        with self._stopped_cond:
+            self._machine_stopped[vmid] = stopped
+            self._num_running += -1 if stopped else 1
+            if stopped:
+                self._stopped_cond.notify_all()
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        with self._stopped_cond:
+            return self._stopped_cond.wait_for(self.all_stopped, timeout)
 
     def get_state(self, vmid):
         return self._machine_state[vmid]
@@ -68,8 +87,9 @@ class DataController(Controller):
     ## arecs
 
     def new_arec(self) -> ARecPtr:
-        ptr = ARecPtr(self._arec_idx)
-        self._arec_idx += 1
+        with self._ids_lock:
+            ptr = ARecPtr(self._arec_idx)
+            self._arec_idx += 1
         return ptr
 
     def set_arec(self, ptr, rec):
@@ -79,8 +99,9 @@ class DataController(Controller):
         return self._arecs[ptr]
 
     def increment_ref(self, ptr):
-        self._arecs[ptr].ref_count += 1
-        return self._arecs[ptr].ref_count
+        with self.lock_arec(ptr):
+            self._arecs[ptr].ref_count += 1
+            return self._arecs[ptr].ref_count
 
     def decrement_ref(self, ptr):
         self._arecs[ptr].ref_count -= 1
@@ -89,8 +110,8 @@ class DataController(Controller):
     def delete_arec(self, ptr):
         self._arecs[ptr].deleted = True
 
-    def lock_arec(self, _):
-        return self._lock
+    def lock_arec(self, ptr):
+        return self._arec_locks[hash(ptr) % LOCK_STRIPES]
 
     ## probes
 
@@ -120,9 +141,8 @@ class DataController(Controller):
     def set_future_chain(self, fut_ptr, chain):
         self._machine_future[fut_ptr].chain = chain
 
-    def lock_future(self, _):
-        # Shared thread lock
-        return self._lock
+    def lock_future(self, vmid):
+        return self._future_locks[hash(vmid) % LOCK_STRIPES]
 
     ## stdout
 
@@ -0,0 +1,442 @@
+"""Redis backed storage
+
+Works with anything that speaks the Redis protocol (redis-server, or fakeredis
+for testing). Needs the `redis` package (pip install teal-lang[redis]).
+
+Every key in a session starts with "teal:<session ID>:". Futures are hashes
+(resolved, value, chain), with their continuations in a separate list, so
+that Lua scripts can work on them. Each future operation is then one atomic
+script, and one round trip:
+
+- get_or_wait: read the value, or add a continuation (WAIT)
+- finish: read the value, or chain to the future (CHAIN)
+- resolve_future: resolve the future and every future chained to it,
+  returning all of their continuations (RESOLVE)
+
+Thread and arec IDs, reference counts and the running thread count are
+changed with HINCRBY. When the running count reaches zero, a message is
+published, so wait_all_stopped doesn't poll. Standard output and probe data
+are streams.
+
+NOTE: RESOLVE follows chains to keys it isn't given, so sessions can't be
+spread over a Redis Cluster.
+"""
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+import uuid
+from datetime import datetime
+from typing import List, Tuple
+
+import redis
+
+from ..machine import codec
+from ..machine import future as fut
+from ..machine import types as mt
+from ..machine.controller import Controller, ControllerError
+from ..machine.probe import ProbeEvent, ProbeLog
+from ..machine.state import strict
+from ..machine.stdout_item import StdoutItem
+
+LOG = logging.getLogger(__name__)
+
+REDIS_URL = os.getenv("TEAL_REDIS_URL", "redis://localhost:6379/0")
+
+# Maximum time (seconds) to wait for a "stopped" message before checking again
+WAIT_POLL_MAX = 0.5
+
+PLUGINS_KEY = "teal:plugins"
+
+# KEYS: future, continuations. ARGV: waiting thread.
+WAIT = """
+if redis.call("HGET", KEYS[1], "resolved") == "1" then
+  return {1, redis.call("HGET", KEYS[1], "value")}
+end
+redis.call("RPUSH", KEYS[2], ARGV[1])
+return {0}
+"""
+
+# KEYS: future. ARGV: thread to chain.
+CHAIN = """
+if redis.call("HGET", KEYS[1], "resolved") == "1" then
+  return {1, redis.call("HGET", KEYS[1], "value")}
+end
+redis.call("HSET", KEYS[1], "chain", ARGV[1])
+return {0}
+"""
+
+# ARGV: key prefix, future ID, value.
+RESOLVE = """
+local prefix, id, value = ARGV[1], ARGV[2], ARGV[3]
+local resolved, continuations = {}, {}
+while id do
+  local key = prefix .. "future:" .. id
+  redis.call("HSET", key, "resolved", "1", "value", value)
+  table.insert(resolved, id)
+  for _, vmid in ipairs(redis.call("LRANGE", prefix .. "conts:" .. id, 0, -1)) do
+    table.insert(continuations, vmid)
+  end
+  id = redis.call("HGET", key, "chain")
+end
+return {resolved, continuations}
+"""
+
+# KEYS: meta, stopped channel. ARGV: change in the number of running threads.
+SET_STOPPED = """
+local running = redis.call("HINCRBY", KEYS[1], "num_running", ARGV[1])
+if running == 0 then
+  redis.call("PUBLISH", KEYS[2], "stopped")
+end
+return running
+"""
+
+
+class DataController(Controller):
+    supports_plugins = True
+
+    @classmethod
+    def with_new_session(cls, client: redis.Redis = None):
+        """Create a data controller for a new session"""
+        client = client or redis.Redis.from_url(REDIS_URL)
+        session_id = str(uuid.uuid4())
+        ctrl = cls(session_id, client)
+        client.hset(
+            ctrl._key("meta"),
+            mapping=dict(
+                created_at=datetime.now().isoformat(),
+                num_threads=0,
+                num_arecs=0,
+                num_running=0,
+                broken=0,
+            ),
+        )
+        LOG.info("Created new session, %s", session_id)
+        return ctrl
+
+    @classmethod
+    def with_session_id(cls, session_id: str, client: redis.Redis = None):
+        client = client or redis.Redis.from_url(REDIS_URL)
+        ctrl = cls(session_id, client)
+        if not client.exists(ctrl._key("meta")):
+            raise ControllerError("Session does not exist")
+        exe = client.hget(ctrl._key("meta"), "exe")
+        if exe:
+            ctrl.executable = codec.loads(exe)
+        LOG.info("Reloaded session %s", session_id)
+        return ctrl
+
+    def __init__(self, session_id, client: redis.Redis):
+        self.session_id = session_id
+        self.executable = None
+        self._r = client
+        self._prefix = f"teal:{session_id}:"
+        self._wait = client.register_script(WAIT)
+        self._chain = client.register_script(CHAIN)
+        self._resolve = client.register_script(RESOLVE)
+        self._set_stopped = client.register_script(SET_STOPPED)
+
+    def _key(self, *parts) -> str:
+        return self._prefix + ":".join(str(p) for p in parts)
+
+    def _get_meta(self, field):
+        return self._r.hget(self._key("meta"), field)
+
+    def set_executable(self, exe):
+        self.executable = exe
+        self._r.hset(self._key("meta"), "exe", codec.dumps(exe))
+
+    def set_entrypoint(self, fn_name: str):
+        self._r.hset(self._key("meta"), "entrypoint", fn_name)
+
+    ## Threads
+
+    def new_thread(self) -> int:
+        return self._r.hincrby(self._key("meta"), "num_threads", 1) - 1
+
+    def get_thread_ids(self) -> List[int]:
+        return list(range(int(self._get_meta("num_threads"))))
+
+    def get_top_level_future(self):
+        return self.get_future(0)
+
+    def is_top_level(self, vmid):
+        return vmid == 0
+
+    def all_stopped(self):
+        return int(self._get_meta("num_running")) == 0
+
+    def set_stopped(self, vmid, stopped: bool):
+        # Count runs, not threads (see local.DataController.set_stopped)
+        keys = [self._key("meta"), self._key("stopped")]
+        self._set_stopped(keys=keys, args=[-1 if stopped else 1])
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        """Wait for a "stopped" message (see SET_STOPPED)"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        pubsub = self._r.pubsub(ignore_subscribe_messages=True)
+        # Subscribe before checking, so that no message can be missed
+        pubsub.subscribe(self._key("stopped"))
+        try:
+            while not self.all_stopped():
+                wait = WAIT_POLL_MAX
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                pubsub.get_message(timeout=wait)
+            return True
+        finally:
+            pubsub.close()
+
+    def get_state(self, vmid):
+        data = self._r.hget(self._key("state"), vmid)
+        if data is None:
+            raise ControllerError(f"No state for thread {vmid}")
+        return codec.loads(data)
+
+    def set_state(self, vmid, state):
+        self._r.hset(self._key("state"), vmid, codec.dumps(state))
+
+    ## controller properties
+
+    @property
+    def broken(self):
+        return self._get_meta("broken") == b"1"
+
+    @broken.setter
+    def broken(self, value):
+        self._r.hset(self._key("meta"), "broken", int(value))
+
+    @property
+    def result(self):
+        value = self._get_meta("result")
+        return None if value is None else json.loads(value)
+
+    @result.setter
+    def result(self, value):
+        self._r.hset(self._key("meta"), "result", json.dumps(value))
+
+    ## arecs
+
+    # Reference counts are kept in their own hash, and changed with HINCRBY,
+    # which returns the new count - so pop_arec needs no lock.
+
+    def new_arec(self):
+        return self._r.hincrby(self._key("meta"), "num_arecs", 1) - 1
+
+    def set_arec(self, ptr, rec):
+        pipe = self._r.pipeline()
+        pipe.hset(self._key("arec"), ptr, codec.dumps(rec))
+        pipe.hset(self._key("refs"), ptr, rec.ref_count)
+        pipe.execute()
+
+    def _load_arec(self, ptr, data, ref_count, deleted):
+        if data is None:
+            raise ControllerError(f"No activation record {ptr}")
+        rec = codec.loads(data)
+        rec.ref_count = int(ref_count)
+        rec.deleted = bool(deleted)
+        return rec
+
+    def get_arec(self, ptr):
+        pipe = self._r.pipeline(transaction=False)
+        pipe.hget(self._key("arec"), ptr)
+        pipe.hget(self._key("refs"), ptr)
+        pipe.sismember(self._key("deleted"), ptr)
+        return self._load_arec(ptr, *pipe.execute())
+
+    def increment_ref(self, ptr):
+        return self._r.hincrby(self._key("refs"), ptr, 1)
+
+    def decrement_ref(self, ptr):
+        pipe = self._r.pipeline(transaction=False)
+        pipe.hget(self._key("arec"), ptr)
+        pipe.hincrby(self._key("refs"), ptr, -1)
+        pipe.sismember(self._key("deleted"), ptr)
+        return self._load_arec(ptr, *pipe.execute())
+
+    def delete_arec(self, ptr):
+        self._r.sadd(self._key("deleted"), ptr)
+
+    def lock_arec(self, ptr):
+        return contextlib.nullcontext()
+
+    ## probes
+
+    def _add_records(self, pipe, stream, items):
+        for item in items:
+            pipe.xadd(self._key(stream), {"record": json.dumps(item.serialise())})
+
+    def _get_records(self, stream) -> list:
+        return [
+            json.loads(fields[b"record"])
+            for _, fields in self._r.xrange(self._key(stream))
+        ]
+
+    def set_probe_data(self, vmid, probe):
+        pipe = self._r.pipeline(transaction=False)
+        self._add_records(pipe, "pevents", probe.events)
+        self._add_records(pipe, "plogs", probe.logs)
+        pipe.execute()
+
+    def get_probe_logs(self):
+        return [ProbeLog.deserialise(item) for item in self._get_records("plogs")]
+
+    def get_probe_events(self):
+        return [ProbeEvent.deserialise(item) for item in self._get_records("pevents")]
+
+    ## futures
+
+    def _future_keys(self, future_id) -> Tuple[str, str]:
+        return self._key("future", future_id), self._key("conts", future_id)
+
+    def _read_future(self, conn, future_id) -> fut.Future:
+        key, conts_key = self._future_keys(future_id)
+        data = conn.hgetall(key)
+        if not data:
+            raise ControllerError(f"No future {future_id}")
+        value = data.get(b"value")
+        chain = data.get(b"chain")
+        return fut.Future(
+            continuations=[int(vmid) for vmid in conn.lrange(conts_key, 0, -1)],
+            chain=None if chain is None else int(chain),
+            resolved=data.get(b"resolved") == b"1",
+            value=None if value is None else codec.loads(value),
+        )
+
+    def _write_future(self, pipe, future_id, future: fut.Future):
+        key, conts_key = self._future_keys(future_id)
+        fields = dict(resolved=int(future.resolved))
+        if future.value is not None:
+            fields["value"] = codec.dumps_lazily(future.value)
+        if future.chain is not None:
+            fields["chain"] = future.chain
+        pipe.delete(key, conts_key)
+        pipe.hset(key, mapping=fields)
+        if future.continuations:
+            pipe.rpush(conts_key, *future.continuations)
+
+    def get_future(self, vmid):
+        return self._read_future(self._r, vmid)
+
+    def set_future(self, vmid, future: fut.Future):
+        pipe = self._r.pipeline()
+        self._write_future(pipe, vmid, future)
+        pipe.execute()
+
+    def add_continuation(self, fut_ptr, vmid):
+        self._r.rpush(self._key("conts", fut_ptr), vmid)
+
+    def set_future_chain(self, fut_ptr, chain):
+        self._r.hset(self._key("future", fut_ptr), "chain", chain)
+
+    def lock_future(self, ptr):
+        return self._r.lock(self._key("lock", ptr))
+
+    def update_future(self, vmid, modify):
+        """Read-modify-write a future, with optimistic concurrency (WATCH)
+
+        MODIFY is tried again if the future changes before it's saved.
+        """
+
+        def update(pipe):
+            future = self._read_future(pipe, vmid)
+            changed, result = modify(future)
+            pipe.multi()
+            if changed:
+                self._write_future(pipe, vmid, future)
+            return result
+
+        return self._r.transaction(
+            update, *self._future_keys(vmid), value_from_callable=True
+        )
+
+    def resolve_future(self, vmid, value):
+        """Resolve a machine future, and any dependent futures (atomically)"""
+        if isinstance(value, mt.TlFuturePtr):
+            raise TypeError(value)
+
+        resolved, continuations = self._resolve(
+            args=[self._prefix, vmid, codec.dumps_lazily(value)]
+        )
+        continuations = [int(c) for c in continuations]
+        if any(self.is_top_level(int(f)) for f in resolved if f.isdigit()):
+            self.result = mt.to_py_type(strict(value))
+
+        LOG.info("Resolved %d to %s. Continuations: %s", vmid, value, continuations)
+        return continuations
+
+    def finish(self, vmid, value) -> list:
+        if not isinstance(value, mt.TlFuturePtr):
+            return value, self.resolve_future(vmid, value)
+
+        if type(vmid) is not int:
+            raise TypeError(vmid)
+
+        # VALUE is another future - chain this machine's future to it, unless
+        # it has resolved.
+        key, _ = self._future_keys(value.vmid)
+        resolved, *next_value = self._chain(keys=[key], args=[vmid])
+        if resolved:
+            next_value = codec.loads(next_value[0])
+            return next_value, self.resolve_future(vmid, next_value)
+        LOG.info("Chaining %s to %s", vmid, value)
+        return None, []
+
+    def get_or_wait(self, vmid, future_ptr):
+        if not isinstance(future_ptr, mt.TlFuturePtr):
+            raise TypeError(future_ptr)
+
+        if type(vmid) is not int:
+            raise TypeError(vmid)
+
+        resolved, *value = self._wait(
+            keys=self._future_keys(future_ptr.vmid), args=[vmid]
+        )
+        if resolved:
+            LOG.info("%s has resolved", future_ptr)
+            return True, codec.loads(value[0])
+        LOG.info("%d waiting on %s", vmid, future_ptr)
+        return False, None
+
+    ## stdout
+
+    def get_stdout(self):
+        return [StdoutItem.deserialise(item) for item in self._get_records("stdout")]
+
+    def write_stdout(self, item):
+        sys.stdout.write(item.text)
+        self._r.xadd(self._key("stdout"), {"record": json.dumps(item.serialise())})
+
+    @property
+    def stdout(self):
+        return self.get_stdout()
+
+    ## plugin API
+
+    def supports_plugin(self, name: str):
+        return True
+
+    def add_plugin_future(self, plugin_name: str, plugin_value_id: str) -> str:
+        """Add a special kind of future which is resolved by a plugin"""
+        future_id = f"{plugin_name}:{plugin_value_id}"
+        pipe = self._r.pipeline()
+        # Record which session the plugin should resume
+        pipe.hset(PLUGINS_KEY, future_id, self.session_id)
+        self._write_future(pipe, future_id, fut.Future())
+        pipe.execute()
+        return future_id
+
+    @classmethod
+    def find_plugin_future(
+        cls, plugin_name: str, plugin_value_id: str, client: redis.Redis = None
+    ) -> Tuple[str, str]:
+        client = client or redis.Redis.from_url(REDIS_URL)
+        future_id = f"{plugin_name}:{plugin_value_id}"
+        session_id = client.hget(PLUGINS_KEY, future_id)
+        if session_id is None:
+            raise ControllerError("Future does not exist")
+        return (session_id.decode(), future_id)
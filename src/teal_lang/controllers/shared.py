@@ -0,0 +1,339 @@
+"""In-memory storage shared between processes
+
+Everything is kept in one anonymous shared memory mapping (the "arena"), made
+when the controller is created. Processes forked after that (see
+executors.multiprocess) inherit the mapping and the locks, so they all see
+the same session, with no database and no manager process.
+
+Arena layout:
+- header: int64 counters (thread IDs, arec IDs, running threads, ...)
+- index tables, one per kind of item: the heap offset of each item, by ID
+- heap: items, each a length and then the item's data. Space is allocated by
+  bumping HEAP_TOP, and never freed: an updated item is written to new space,
+  and its index entry pointed at it.
+
+Machine data (states, arecs and futures) is stored with the binary codec.
+Other items (stdout, probe data and the result) are pickled.
+
+Index entries are read and written under a lock from a small table of
+process-shared locks, chosen by hashing the item's kind and ID. The same locks
+are used for lock_arec. Futures are updated with optimistic concurrency
+instead (see update_future).
+"""
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import struct
+import sys
+from typing import List, Tuple
+
+from ..machine import codec
+from ..machine import future as fut
+from ..machine.arec import ARecPtr
+from ..machine.controller import Controller, ControllerError
+
+LOG = logging.getLogger(__name__)
+
+# Shared memory only works with processes that inherit it
+FORK = multiprocessing.get_context("fork")
+
+ARENA_SIZE = int(os.getenv("TEAL_SHARED_MEMORY_MB", 256)) * 2 ** 20
+LOCK_STRIPES = 64
+
+# Header fields
+NUM_THREADS = 0
+NUM_ARECS = 1
+NUM_RUNNING = 2
+HEAP_TOP = 3
+BROKEN = 4
+NUM_STDOUT = 5
+NUM_PLOGS = 6
+NUM_PEVENTS = 7
+HEADER_SIZE = 16 * 8
+
+# Item kinds, and the number of IDs each can hold
+STATE = 0
+FUTURE = 1
+AREC = 2
+STDOUT = 3
+PLOGS = 4
+PEVENTS = 5
+RESULT = 6
+CAPACITY = {
+    STATE: 2 ** 18,
+    FUTURE: 2 ** 18,
+    AREC: 2 ** 18,
+    STDOUT: 2 ** 20,
+    PLOGS: 2 ** 18,
+    PEVENTS: 2 ** 18,
+    RESULT: 1,
+}
+
+INT64 = struct.Struct("q")
+
+
+class ArenaFull(ControllerError):
+    """There is no space left in shared memory"""
+
+
+class DataController(Controller):
+    def __init__(self, size=ARENA_SIZE):
+        self._tables = {}
+        offset = HEADER_SIZE
+        for kind, capacity in CAPACITY.items():
+            self._tables[kind] = offset
+            offset += capacity * INT64.size
+        self._heap_start = offset
+        if size <= self._heap_start:
+            raise ArenaFull(f"Shared memory must be bigger than {offset} bytes")
+        self._mem = mmap.mmap(-1, size)
+        self._size = size
+        self._set_counter(HEAP_TOP, self._heap_start)
+        self._meta_lock = FORK.Lock()
+        self._stopped_cond = FORK.Condition(self._meta_lock)
+        self._locks = [FORK.RLock() for _ in range(LOCK_STRIPES)]
+        self.session_id = 0  # constant for local
+        self.executable = None
+
+    def set_executable(self, exe):
+        # Inherited by forked processes, so it doesn't need to be shared
+        self.executable = exe
+
+    def set_entrypoint(self, fn_name: str):
+        pass  # N/A for local
+
+    ## arena
+
+    def _counter(self, field) -> int:
+        return INT64.unpack_from(self._mem, field * INT64.size)[0]
+
+    def _set_counter(self, field, value):
+        INT64.pack_into(self._mem, field * INT64.size, value)
+
+    def _add_counter(self, field, delta) -> int:
+        """Add DELTA to a header counter, returning its old value"""
+        with self._meta_lock:
+            value = self._counter(field)
+            self._set_counter(field, value + delta)
+        return value
+
+    def _lock(self, kind, idx):
+        return self._locks[hash((kind, idx)) % LOCK_STRIPES]
+
+    def _entry(self, kind, idx) -> int:
+        """Get the position of index entry IDX of KIND"""
+        if not 0 <= idx < CAPACITY[kind]:
+            raise ArenaFull(f"Too many items of kind {kind} (ID {idx})")
+        return self._tables[kind] + idx * INT64.size
+
+    def _put(self, kind, idx, data: bytes, expect=None) -> bool:
+        """Write an item, returning whether it was written
+
+        If EXPECT is given, only write it if the item's offset is still EXPECT
+        (i.e. it hasn't been written since it was read - see _read).
+        """
+        entry = self._entry(kind, idx)
+        offset = self._add_counter(HEAP_TOP, INT64.size + len(data))
+        end = offset + INT64.size + len(data)
+        if end > self._size:
+            raise ArenaFull(
+                f"Shared memory is full ({self._size} bytes). "
+                "Set TEAL_SHARED_MEMORY_MB to use more."
+            )
+        INT64.pack_into(self._mem, offset, len(data))
+        self._mem[offset + INT64.size : end] = data
+        with self._lock(kind, idx):
+            current = INT64.unpack_from(self._mem, entry)[0]
+            if expect is not None and current != expect:
+                return False
+            INT64.pack_into(self._mem, entry, offset)
+        return True
+
+    def _read(self, kind, idx) -> Tuple[int, bytes]:
+        """Read an item, returning its offset in the heap and its data"""
+        entry = self._entry(kind, idx)
+        with self._lock(kind, idx):
+            offset = INT64.unpack_from(self._mem, entry)[0]
+        if not offset:
+            raise ControllerError(f"Item {kind}:{idx} does not exist")
+        (length,) = INT64.unpack_from(self._mem, offset)
+        start = offset + INT64.size
+        return offset, self._mem[start : start + length]
+
+    def _get(self, kind, idx) -> bytes:
+        return self._read(kind, idx)[1]
+
+    def _append(self, kind, counter, obj):
+        self._put(kind, self._add_counter(counter, 1), pickle.dumps(obj))
+
+    def _items(self, kind, counter) -> list:
+        # An item may have been counted but not written yet
+        result = []
+        for idx in range(self._counter(counter)):
+            try:
+                result.append(pickle.loads(self._get(kind, idx)))
+            except ControllerError:
+                pass
+        return result
+
+    ## Threads
+
+    def new_thread(self):
+        return self._add_counter(NUM_THREADS, 1)
+
+    def get_thread_ids(self) -> List[int]:
+        return list(range(self._counter(NUM_THREADS)))
+
+    def get_top_level_future(self):
+        return self.get_future(0)
+
+    def is_top_level(self, vmid):
+        return vmid == 0
+
+    def all_stopped(self):
+        return self._counter(NUM_RUNNING) == 0
+
+    def set_stopped(self, vmid, stopped: bool):
+        # Count runs, not threads (see local.DataController.set_stopped)
+        with self._stopped_cond:
+            self._set_counter(
+                NUM_RUNNING, self._counter(NUM_RUNNING) + (-1 if stopped else 1)
+            )
+            if stopped:
+                self._stopped_cond.notify_all()
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        with self._stopped_cond:
+            return self._stopped_cond.wait_for(self.all_stopped, timeout)
+
+    def get_state(self, vmid):
+        return codec.loads(self._get(STATE, vmid))
+
+    def set_state(self, vmid, state):
+        self._put(STATE, vmid, codec.dumps(state))
+
+    ## controller properties
+
+    @property
+    def broken(self):
+        return bool(self._counter(BROKEN))
+
+    @broken.setter
+    def broken(self, value):
+        self._set_counter(BROKEN, int(value))
+
+    @property
+    def result(self):
+        try:
+            return pickle.loads(self._get(RESULT, 0))
+        except ControllerError:
+            return None
+
+    @result.setter
+    def result(self, value):
+        self._put(RESULT, 0, pickle.dumps(value))
+
+    ## arecs
+
+    def new_arec(self) -> ARecPtr:
+        return ARecPtr(self._add_counter(NUM_ARECS, 1))
+
+    def set_arec(self, ptr, rec):
+        self._put(AREC, ptr, codec.dumps(rec))
+
+    def get_arec(self, ptr):
+        return codec.loads(self._get(AREC, ptr))
+
+    def increment_ref(self, ptr):
+        with self.lock_arec(ptr):
+            rec = self.get_arec(ptr)
+            rec.ref_count += 1
+            self.set_arec(ptr, rec)
+            return rec.ref_count
+
+    def decrement_ref(self, ptr):
+        with self.lock_arec(ptr):
+            rec = self.get_arec(ptr)
+            rec.ref_count -= 1
+            self.set_arec(ptr, rec)
+            return rec
+
+    def delete_arec(self, ptr):
+        with self.lock_arec(ptr):
+            rec = self.get_arec(ptr)
+            rec.deleted = True
+            self.set_arec(ptr, rec)
+
+    def lock_arec(self, ptr):
+        return self._lock(AREC, ptr)
+
+    ## probes
+
+    def set_probe_data(self, vmid, probe):
+        if probe.logs:
+            self._append(PLOGS, NUM_PLOGS, list(probe.logs))
+        if probe.events:
+            self._append(PEVENTS, NUM_PEVENTS, list(probe.events))
+
+    def get_probe_logs(self):
+        return [log for logs in self._items(PLOGS, NUM_PLOGS) for log in logs]
+
+    def get_probe_events(self):
+        return [e for events in self._items(PEVENTS, NUM_PEVENTS) for e in events]
+
+    ## futures
+
+    def get_future(self, val):
+        if not isinstance(val, int):
+            raise TypeError(val)
+        return codec.loads(self._get(FUTURE, val))
+
+    def set_future(self, vmid, future: fut.Future):
+        self._put(FUTURE, vmid, codec.dumps(future))
+
+    def add_continuation(self, fut_ptr, vmid):
+        def add(future):
+            future.continuations.append(vmid)
+            return True, None
+
+        self.update_future(fut_ptr, add)
+
+    def set_future_chain(self, fut_ptr, chain):
+        def set_chain(future):
+            future.chain = chain
+            return True, None
+
+        self.update_future(fut_ptr, set_chain)
+
+    def lock_future(self, vmid):
+        return self._lock(FUTURE, vmid)
+
+    def update_future(self, vmid, modify):
+        """Read-modify-write a future, with optimistic concurrency
+
+        Every write moves an item to a new offset, so the offset is its
+        version: the future is only saved if it hasn't moved since it was
+        read. If it has, MODIFY is tried again.
+        """
+        while True:
+            offset, data = self._read(FUTURE, vmid)
+            future = codec.loads(data)
+            changed, result = modify(future)
+            if not changed or self._put(FUTURE, vmid, codec.dumps(future), offset):
+                return result
+            LOG.info("Conflict updating future %s", vmid)
+
+    ## stdout
+
+    def get_stdout(self):
+        return self._items(STDOUT, NUM_STDOUT)
+
+    @property
+    def stdout(self):
+        return self.get_stdout()
+
+    def write_stdout(self, item):
+        sys.stdout.write(item.text)
+        self._append(STDOUT, NUM_STDOUT, item)
@@ -0,0 +1,473 @@
+"""SQLite backed storage, for durable sessions on one machine
+
+Sessions are kept in a SQLite database file (in WAL mode, so readers don't
+block the writer), and survive the process that ran them. Any number of
+threads and processes can use the same database.
+
+Each Python thread (and forked process) uses its own connection, in autocommit
+mode. The sqlite3 module keeps prepared statements per connection, so the SQL
+for the hot paths is kept constant.
+
+Critical sections (lock_arec, lock_future) are IMMEDIATE transactions, which
+hold the database's write lock. Futures are updated with optimistic
+concurrency instead (see update_future), like the DynamoDB controller.
+"""
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import List, Tuple
+
+from ..config_classes import DEFAULT_DATA_DIR
+from ..machine import codec
+from ..machine import future as fut
+from ..machine.controller import Controller, ControllerError
+from ..machine.probe import ProbeEvent, ProbeLog
+from ..machine.stdout_item import StdoutItem
+
+LOG = logging.getLogger(__name__)
+
+DB_FILENAME = "sessions.db"
+DEFAULT_PATH = Path(os.getenv("TEAL_SQLITE_DB", Path(DEFAULT_DATA_DIR, DB_FILENAME)))
+
+# Seconds to wait for another connection's write lock
+BUSY_TIMEOUT = 30.0
+
+# Number of times to try updating a future (see update_future)
+CAS_RETRIES = 100
+
+# wait_all_stopped polling interval (seconds), doubling up to the max
+WAIT_POLL = 0.005
+WAIT_POLL_MAX = 0.1
+
+# Kinds of records
+STDOUT = "stdout"
+PLOGS = "plogs"
+PEVENTS = "pevents"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    exe BLOB,
+    entrypoint TEXT,
+    num_threads INTEGER NOT NULL DEFAULT 0,
+    num_arecs INTEGER NOT NULL DEFAULT 0,
+    num_running INTEGER NOT NULL DEFAULT 0,
+    broken INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+);
+CREATE TABLE IF NOT EXISTS states (
+    session_id TEXT,
+    vmid INTEGER,
+    state BLOB NOT NULL,
+    PRIMARY KEY (session_id, vmid)
+);
+CREATE TABLE IF NOT EXISTS futures (
+    session_id TEXT,
+    future_id TEXT,
+    version INTEGER NOT NULL DEFAULT 0,
+    future BLOB NOT NULL,
+    PRIMARY KEY (session_id, future_id)
+);
+CREATE TABLE IF NOT EXISTS arecs (
+    session_id TEXT,
+    ptr INTEGER,
+    ref_count INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    arec BLOB NOT NULL,
+    PRIMARY KEY (session_id, ptr)
+);
+CREATE TABLE IF NOT EXISTS records (
+    session_id TEXT,
+    kind TEXT,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS records_by_kind ON records (session_id, kind);
+CREATE TABLE IF NOT EXISTS plugin_futures (
+    future_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL
+);
+"""
+
+GET_STATE = "SELECT state FROM states WHERE session_id = ? AND vmid = ?"
+SET_STATE = (
+    "INSERT OR REPLACE INTO states (session_id, vmid, state) VALUES (?, ?, ?)"
+)
+GET_FUTURE = (
+    "SELECT future, version FROM futures WHERE session_id = ? AND future_id = ?"
+)
+NEW_FUTURE = (
+    "INSERT OR REPLACE INTO futures (session_id, future_id, future) "
+    "VALUES (?, ?, ?)"
+)
+SET_FUTURE = (
+    "UPDATE futures SET future = ?, version = version + 1 "
+    "WHERE session_id = ? AND future_id = ?"
+)
+SET_FUTURE_IF_UNCHANGED = SET_FUTURE + " AND version = ?"
+GET_AREC = (
+    "SELECT arec, ref_count, deleted FROM arecs WHERE session_id = ? AND ptr = ?"
+)
+SET_AREC = (
+    "INSERT OR REPLACE INTO arecs (session_id, ptr, ref_count, deleted, arec) "
+    "VALUES (?, ?, ?, ?, ?)"
+)
+ADD_REF = (
+    "UPDATE arecs SET ref_count = ref_count + ? WHERE session_id = ? AND ptr = ?"
+)
+GET_REF = "SELECT ref_count FROM arecs WHERE session_id = ? AND ptr = ?"
+DELETE_AREC = "UPDATE arecs SET deleted = 1 WHERE session_id = ? AND ptr = ?"
+ADD_RECORD = "INSERT INTO records (session_id, kind, record) VALUES (?, ?, ?)"
+GET_RECORDS = (
+    "SELECT record FROM records WHERE session_id = ? AND kind = ? ORDER BY rowid"
+)
+GET_META = "SELECT {} FROM sessions WHERE session_id = ?"
+SET_META = "UPDATE sessions SET {} = ? WHERE session_id = ?"
+ADD_META = "UPDATE sessions SET {0} = {0} + ? WHERE session_id = ?"
+
+
+def connect(path) -> sqlite3.Connection:
+    """Open a database, creating it (and the tables) if necessary"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(
+        str(path), timeout=BUSY_TIMEOUT, isolation_level=None, cached_statements=256
+    )
+    conn.execute("PRAGMA journal_mode = WAL")
+    # Durable at checkpoints, rather than on every commit
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def latest_session_id(path=DEFAULT_PATH) -> str:
+    """Get the ID of the session created most recently, or None"""
+    with contextlib.closing(connect(path)) as db:
+        row = db.execute(
+            "SELECT session_id FROM sessions ORDER BY created_at DESC LIMIT 1"
+        ).fetchone()
+    return row[0] if row else None
+
+
+class _Connection(threading.local):
+    """This thread's connection, and how deeply it's in a transaction"""
+
+    def __init__(self):
+        self.conn = None
+        self.pid = None
+        self.depth = 0
+
+
+class DataController(Controller):
+    supports_plugins = True
+
+    @classmethod
+    def with_new_session(cls, path=DEFAULT_PATH):
+        """Create a data controller for a new session"""
+        session_id = str(uuid.uuid4())
+        with contextlib.closing(connect(path)) as db:
+            db.execute(
+                "INSERT INTO sessions (session_id, created_at) VALUES (?, ?)",
+                (session_id, datetime.now().isoformat()),
+            )
+        LOG.info("Created new session, %s", session_id)
+        return cls(session_id, path)
+
+    @classmethod
+    def with_session_id(cls, session_id: str, path=DEFAULT_PATH):
+        ctrl = cls(session_id, path)
+        row = ctrl._db.execute(GET_META.format("exe"), (session_id,)).fetchone()
+        if not row:
+            raise ControllerError("Session does not exist")
+        if row[0]:
+            ctrl.executable = codec.loads(row[0])
+        LOG.info("Reloaded session %s", session_id)
+        return ctrl
+
+    def __init__(self, session_id, path=DEFAULT_PATH):
+        self.session_id = session_id
+        self.path = path
+        self.executable = None
+        self._local = _Connection()
+
+    @property
+    def _db(self) -> sqlite3.Connection:
+        local = self._local
+        # Connections can't be shared between threads, or with forked processes
+        if local.conn is None or local.pid != os.getpid():
+            local.conn = connect(self.path)
+            local.pid = os.getpid()
+            local.depth = 0
+        return local.conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Hold the write lock until the outermost transaction ends"""
+        db = self._db
+        local = self._local
+        if local.depth == 0:
+            db.execute("BEGIN IMMEDIATE")
+        local.depth += 1
+        try:
+            yield db
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                db.execute("ROLLBACK")
+            raise
+        local.depth -= 1
+        if local.depth == 0:
+            db.execute("COMMIT")
+
+    def _get_meta(self, column):
+        row = self._db.execute(GET_META.format(column), (self.session_id,)).fetchone()
+        if not row:
+            raise ControllerError(f"Session {self.session_id} does not exist")
+        return row[0]
+
+    def _set_meta(self, column, value):
+        self._db.execute(SET_META.format(column), (value, self.session_id))
+
+    def _next_id(self, counter) -> int:
+        with self._transaction() as db:
+            db.execute(ADD_META.format(counter), (1, self.session_id))
+            return self._get_meta(counter) - 1
+
+    def set_executable(self, exe):
+        self.executable = exe
+        self._set_meta("exe", codec.dumps(exe))
+
+    def set_entrypoint(self, fn_name: str):
+        self._set_meta("entrypoint", fn_name)
+
+    ## Threads
+
+    def new_thread(self) -> int:
+        return self._next_id("num_threads")
+
+    def get_thread_ids(self) -> List[int]:
+        return list(range(self._get_meta("num_threads")))
+
+    def get_top_level_future(self):
+        return self.get_future(0)
+
+    def is_top_level(self, vmid):
+        return vmid == 0
+
+    def all_stopped(self):
+        return self._get_meta("num_running") == 0
+
+    def set_stopped(self, vmid, stopped: bool):
+        # Count runs, not threads (see local.DataController.set_stopped)
+        self._db.execute(
+            ADD_META.format("num_running"), (-1 if stopped else 1, self.session_id)
+        )
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        """Poll the number of running threads until it reaches zero"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = WAIT_POLL
+        while not self.all_stopped():
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                interval = min(interval, remaining)
+            time.sleep(interval)
+            interval = min(interval * 2, WAIT_POLL_MAX)
+        return True
+
+    def get_state(self, vmid):
+        row = self._db.execute(GET_STATE, (self.session_id, vmid)).fetchone()
+        if not row:
+            raise ControllerError(f"No state for thread {vmid}")
+        return codec.loads(row[0])
+
+    def set_state(self, vmid, state):
+        self._db.execute(SET_STATE, (self.session_id, vmid, codec.dumps(state)))
+
+    ## controller properties
+
+    @property
+    def broken(self):
+        return bool(self._get_meta("broken"))
+
+    @broken.setter
+    def broken(self, value):
+        self._set_meta("broken", int(value))
+
+    @property
+    def result(self):
+        value = self._get_meta("result")
+        return None if value is None else json.loads(value)
+
+    @result.setter
+    def result(self, value):
+        self._set_meta("result", json.dumps(value))
+
+    ## arecs
+
+    # Reference counts (and the deleted flag) are kept in their own columns, so
+    # they can be changed without decoding the arec.
+
+    def new_arec(self):
+        return self._next_id("num_arecs")
+
+    def set_arec(self, ptr, rec):
+        self._db.execute(
+            SET_AREC,
+            (self.session_id, ptr, rec.ref_count, int(rec.deleted), codec.dumps(rec)),
+        )
+
+    def get_arec(self, ptr):
+        row = self._db.execute(GET_AREC, (self.session_id, ptr)).fetchone()
+        if not row:
+            raise ControllerError(f"No activation record {ptr}")
+        rec = codec.loads(row[0])
+        rec.ref_count = row[1]
+        rec.deleted = bool(row[2])
+        return rec
+
+    def increment_ref(self, ptr):
+        with self._transaction() as db:
+            db.execute(ADD_REF, (1, self.session_id, ptr))
+            return db.execute(GET_REF, (self.session_id, ptr)).fetchone()[0]
+
+    def decrement_ref(self, ptr):
+        with self._transaction() as db:
+            db.execute(ADD_REF, (-1, self.session_id, ptr))
+            return self.get_arec(ptr)
+
+    def delete_arec(self, ptr):
+        self._db.execute(DELETE_AREC, (self.session_id, ptr))
+
+    def lock_arec(self, ptr):
+        return self._transaction()
+
+    ## probes
+
+    def _add_records(self, kind, items):
+        self._db.executemany(
+            ADD_RECORD,
+            [(self.session_id, kind, json.dumps(item.serialise())) for item in items],
+        )
+
+    def _get_records(self, kind) -> list:
+        rows = self._db.execute(GET_RECORDS, (self.session_id, kind))
+        return [json.loads(record) for (record,) in rows]
+
+    def set_probe_data(self, vmid, probe):
+        with self._transaction():
+            self._add_records(PEVENTS, probe.events)
+            self._add_records(PLOGS, probe.logs)
+
+    def get_probe_logs(self):
+        return [ProbeLog.deserialise(item) for item in self._get_records(PLOGS)]
+
+    def get_probe_events(self):
+        return [ProbeEvent.deserialise(item) for item in self._get_records(PEVENTS)]
+
+    ## futures
+
+    def _read_future(self, future_id) -> Tuple[fut.Future, int]:
+        row = self._db.execute(GET_FUTURE, (self.session_id, str(future_id))).fetchone()
+        if not row:
+            raise ControllerError(f"No future {future_id}")
+        return codec.loads(row[0]), row[1]
+
+    def get_future(self, vmid):
+        return self._read_future(vmid)[0]
+
+    def set_future(self, vmid, future: fut.Future):
+        data = codec.dumps(future)
+        cur = self._db.execute(SET_FUTURE, (data, self.session_id, str(vmid)))
+        if not cur.rowcount:
+            self._db.execute(NEW_FUTURE, (self.session_id, str(vmid), data))
+
+    def add_continuation(self, fut_ptr, vmid):
+        def add(future):
+            future.continuations.append(vmid)
+            return True, None
+
+        self.update_future(fut_ptr, add)
+
+    def set_future_chain(self, fut_ptr, chain):
+        def set_chain(future):
+            future.chain = chain
+            return True, None
+
+        self.update_future(fut_ptr, set_chain)
+
+    def lock_future(self, ptr):
+        return self._transaction()
+
+    def update_future(self, vmid, modify):
+        """Read-modify-write a future, with optimistic concurrency
+
+        The future is only saved if its version hasn't changed since it was
+        read. If it has, MODIFY is tried again.
+        """
+        for attempt in range(CAS_RETRIES):
+            future, version = self._read_future(vmid)
+            changed, result = modify(future)
+            if not changed:
+                return result
+            cur = self._db.execute(
+                SET_FUTURE_IF_UNCHANGED,
+                (codec.dumps(future), self.session_id, str(vmid), version),
+            )
+            if cur.rowcount:
+                return result
+            LOG.info("Conflict updating future %s (attempt %d)", vmid, attempt)
+        raise ControllerError(f"Couldn't update future {vmid}")
+
+    ## stdout
+
+    def get_stdout(self):
+        return [StdoutItem.deserialise(item) for item in self._get_records(STDOUT)]
+
+    def write_stdout(self, item):
+        sys.stdout.write(item.text)
+        self._add_records(STDOUT, [item])
+
+    @property
+    def stdout(self):
+        return self.get_stdout()
+
+    ## plugin API
+
+    def supports_plugin(self, name: str):
+        return True
+
+    def add_plugin_future(self, plugin_name: str, plugin_value_id: str) -> str:
+        """Add a special kind of future which is resolved by a plugin"""
+        future_id = f"{plugin_name}:{plugin_value_id}"
+        with self._transaction() as db:
+            # Record which session the plugin should resume
+            db.execute(
+                "INSERT OR REPLACE INTO plugin_futures VALUES (?, ?)",
+                (future_id, self.session_id),
+            )
+            self.set_future(future_id, fut.Future())
+        return future_id
+
+    @classmethod
+    def find_plugin_future(
+        cls, plugin_name: str, plugin_value_id: str, path=DEFAULT_PATH
+    ) -> Tuple[str, str]:
+        future_id = f"{plugin_name}:{plugin_value_id}"
+        with contextlib.closing(connect(path)) as db:
+            row = db.execute(
+                "SELECT session_id FROM plugin_futures WHERE future_id = ?",
+                (future_id,),
+            ).fetchone()
+        if not row:
+            raise ControllerError("Future does not exist")
+        return (row[0], future_id)
@@ -0,0 +1,192 @@
+"""Run teal threads as coroutines on one asyncio event loop
+
+Every teal thread is an asyncio task. A machine steps through instructions
+until it would block, and then suspends, letting other threads run:
+
+- sleep() is an asyncio timer.
+- Foreign functions defined with `async def` are awaited. Others are run in
+  the event loop's default thread pool.
+- Waiting on an unresolved future suspends on an asyncio.Future, which is set
+  when the teal future resolves (instead of stopping the machine and invoking
+  a new one).
+
+So thousands of I/O-bound teal threads can run in one process. Use with the
+in-memory controller: DynamoDB requests would block the event loop.
+
+NOTE: The standard output of foreign functions isn't captured (it goes
+straight to sys.stdout), because they run concurrently.
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import sys
+import threading
+
+from ..exceptions import UserResolvableError
+from ..machine import types as mt
+from ..machine.instructionset import Sleep, Wait
+from ..machine.machine import ForeignError, TlMachine, shortstr
+
+LOG = logging.getLogger(__name__)
+
+
+class Deadlock(UserResolvableError):
+    """Every thread is waiting on a future that can't resolve"""
+
+    def __init__(self, vmid):
+        super().__init__(
+            f"Thread {vmid} is waiting on a future that will never resolve",
+            "Check for threads that wait on each other.",
+        )
+
+
+class AsyncMachine(TlMachine):
+    """A TlMachine that suspends instead of blocking (see run_coroutine)"""
+
+    def load_thread(self, vmid):
+        super().load_thread(vmid)
+        self._suspended = None  # (awaitable, function to call with its result)
+
+    def _suspend(self, awaitable, on_done):
+        """Stop stepping until AWAITABLE is done, then call ON_DONE(result)"""
+        self._suspended = (awaitable, on_done)
+        self.state.stopped = True
+
+    async def run_coroutine(self):
+        """Like run, but await whatever the machine suspends on"""
+        while True:
+            self.probe.event("run")
+            self.state.stopped = False
+            finished_ok = self._run_until_stopped()
+            while finished_ok and self._suspended:
+                awaitable, on_done = self._suspended
+                self._suspended = None
+                try:
+                    result = await awaitable
+                except Exception as exc:
+                    resume = functools.partial(_reraise, exc)
+                else:
+                    resume = functools.partial(on_done, result)
+                self.state.stopped = False
+                finished_ok = self._run_until_stopped(resume)
+            self._stop(finished_ok)
+            if self._continuation is None:
+                break
+            self.load_thread(self._continuation)
+
+    def _call_foreign(self, foreign_f, py_args):
+        self._suspend(_call_python(foreign_f, py_args), self._push_foreign_result)
+
+    def _push_foreign_result(self, py_result):
+        self.state.ds_push(mt.to_teal_type(py_result))
+
+    def _sleep(self, operand):
+        t = self.state.ds_peek(0)
+        self._suspend(asyncio.sleep(t), lambda _: None)
+
+    def _wait(self, operand):
+        val = self.state.ds_peek(0)
+        if not isinstance(val, mt.TlFuturePtr):
+            return TlMachine.handlers[Wait.opcode](self, operand)
+
+        self.dc.sync()
+        resolved, result = self.dc.get_or_wait(self.vmid, val)
+        if resolved:
+            self.probe.log(f"{val} resolved, got {shortstr(result)}")
+            self.state.ds_set(0, result)
+        else:
+            self.probe.log(f"Waiting for {val}")
+            # Like stopping: the thread resolving the future marks this one as
+            # running again, and invokes it (see Invoker.invoke).
+            self.dc.set_stopped(self.vmid, True)
+            self.state.ip -= 1  # repeat the Wait when woken up
+            self._suspend(self.invoker.wakeup(self.vmid), lambda _: None)
+
+    handlers = list(TlMachine.handlers)
+    handlers[Sleep.opcode] = _sleep
+    handlers[Wait.opcode] = _wait
+
+    # sleep called by value (e.g. `s = sleep; s(1)`) mustn't block either
+    builtin_handlers = dict(TlMachine.builtin_handlers, sleep=_sleep)
+
+
+def _reraise(exc):
+    raise exc
+
+
+async def _call_python(fn, args):
+    """Call a foreign function without blocking the event loop"""
+    try:
+        if inspect.iscoroutinefunction(fn):
+            return await fn(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(fn, *args))
+    except Exception as e:
+        raise ForeignError(e) from e
+
+
+class Invoker:
+    def __init__(self, data_controller):
+        self.data_controller = data_controller
+        self.exception = None
+        self._tasks = set()
+        self._wakeups = {}  # vmid -> asyncio.Future, for waiting threads
+
+    def can_continue_inline(self):
+        # Continuations are woken up by invoke(), not run by the finishing
+        # thread.
+        return False
+
+    def invoke(self, vmid, run_async=True):
+        """Start (or wake up) thread VMID
+
+        If run_async is False, run the event loop until every thread is done.
+        """
+        if vmid in self._wakeups:
+            self._wakeups.pop(vmid).set_result(None)
+        elif run_async:
+            self._start(vmid)
+        else:
+            asyncio.run(self._run_all(vmid))
+
+    def wakeup(self, vmid) -> asyncio.Future:
+        """Get a future for thread VMID to wait on until it's invoked again"""
+        future = asyncio.get_running_loop().create_future()
+        self._wakeups[vmid] = future
+        self._check_deadlock()
+        return future
+
+    async def _run_all(self, vmid):
+        self._start(vmid)
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
+
+    def _start(self, vmid):
+        task = asyncio.get_running_loop().create_task(self._run(vmid))
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        self._check_deadlock()
+
+    def _check_deadlock(self):
+        """If every running thread is waiting to be woken up, none ever will be"""
+        if self._wakeups and len(self._wakeups) == len(self._tasks):
+            for vmid, future in self._wakeups.items():
+                LOG.warning("Thread %d is deadlocked", vmid)
+                self.data_controller.set_stopped(vmid, False)
+                future.set_exception(Deadlock(vmid))
+            self._wakeups.clear()
+
+    async def _run(self, vmid):
+        try:
+            await AsyncMachine(vmid, self).run_coroutine()
+        except Exception:
+            # Same as an uncaught exception in executors.thread
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            self.exception = threading.ExceptHookArgs(
+                [exc_type, exc_value, exc_tb, threading.current_thread()]
+            )
+            LOG.exception("Thread %d died", vmid)
@@ -9,6 +9,10 @@ import botocore
 # Teal "resume" lambda handler name. Should be set by the Teal deployment scripts.
 RESUME_FN_NAME = os.environ["RESUME_FN_NAME"]
 
+# A finishing thread only resumes a continuation in the same lambda if there's
+# at least this much time left (ms). Otherwise, a new lambda is invoked.
+INLINE_MIN_REMAINING_MS = int(os.getenv("TEAL_INLINE_MIN_REMAINING_MS", 60000))
+
 
 LOG = logging.getLogger(__name__)
 
@@ -20,10 +24,23 @@ def get_lambda_client():
 
 
 class Invoker:
-    def __init__(self, data_controller):
+    def __init__(self, data_controller, context=None):
         self.data_controller = data_controller
         self.resume_fn_name = RESUME_FN_NAME
         self.exception = None
+        self.context = context  # the lambda context object
+
+    def can_continue_inline(self):
+        """Whether there's enough lambda time left to resume a continuation
+
+        Caution: the continuation may still need more time than is left, and if
+        the lambda times out, that thread is lost. Tune this with
+        TEAL_INLINE_MIN_REMAINING_MS (or set it very high to disable it).
+        """
+        if self.context is None:
+            return False
+        remaining = self.context.get_remaining_time_in_millis()
+        return remaining >= INLINE_MIN_REMAINING_MS
 
     def invoke(self, vmid, run_async=True):
         client = get_lambda_client()
@@ -1,7 +1,7 @@
 """Run with multiple processes - sort of emulates AWS Lambda"""
 import multiprocessing
 
-from ..controllers import ddb as ddb_controller
+from ..controllers import shared as shared_controller
 from ..machine.machine import TlMachine
 
 
@@ -10,21 +10,38 @@ class Invoker:
         self.data_controller = data_controller
         self.exception = None
 
+    def can_continue_inline(self):
+        return True
+
     def invoke(self, vmid, run_async=True):
-        event = dict(
-            # --
-            session_id=self.data_controller.session_id,
-            vmid=vmid,
-        )
-        p = multiprocessing.Process(target=resume_handler, args=(event,))
+        if isinstance(self.data_controller, shared_controller.DataController):
+            # The new process inherits the controller's shared memory
+            p = shared_controller.FORK.Process(
+                target=resume_shared, args=(self.data_controller, vmid)
+            )
+        else:
+            event = dict(
+                # --
+                session_id=self.data_controller.session_id,
+                vmid=vmid,
+            )
+            p = multiprocessing.Process(target=resume_handler, args=(event,))
         p.start()
 
 
 def resume_handler(event):
     # TODO catch exceptions and send them back!
+    from ..controllers import ddb as ddb_controller
+
     session_id = event["session_id"]
     vmid = event["vmid"]
     controller = ddb_controller.DataController.with_session_id(session_id)
     invoker = Invoker(controller)
     machine = TlMachine(vmid, invoker)
     machine.run()
+
+
+def resume_shared(controller, vmid):
+    invoker = Invoker(controller)
+    machine = TlMachine(vmid, invoker)
+    machine.run()
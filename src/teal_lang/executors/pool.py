@@ -0,0 +1,59 @@
+"""Run teal threads on a bounded pool of Python threads
+
+Unlike executors.thread, which starts a new Python thread (and TlMachine) for
+every teal thread, a fixed number of workers take teal threads from a queue.
+Each worker keeps its TlMachine, so the executable's Python imports are only
+done once per worker.
+"""
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ..machine.machine import TlMachine
+
+LOG = logging.getLogger(__name__)
+
+# Number of worker threads. None means the ThreadPoolExecutor default.
+POOL_WORKERS = int(os.getenv("TEAL_POOL_WORKERS", 0)) or None
+
+
+class Invoker:
+    def __init__(self, data_controller, max_workers=POOL_WORKERS):
+        self.data_controller = data_controller
+        self.exception = None
+        self._pool = ThreadPoolExecutor(max_workers, thread_name_prefix="teal")
+        self._worker = threading.local()
+
+    def can_continue_inline(self):
+        return True
+
+    def close(self):
+        """Let the workers exit once they're idle (see run_and_wait)"""
+        # Don't wait: after a timeout, a worker may still be running a thread
+        self._pool.shutdown(wait=False)
+
+    def invoke(self, vmid, run_async=True):
+        LOG.info(f"Invoking {vmid} (queued? {run_async})")
+        if run_async:
+            self._pool.submit(self._run, vmid)
+        else:
+            self._run(vmid)
+
+    def _run(self, vmid):
+        """Run teal thread VMID with this worker's machine"""
+        try:
+            machine = getattr(self._worker, "machine", None)
+            if machine is None:
+                machine = self._worker.machine = TlMachine(vmid, self)
+            else:
+                machine.load_thread(vmid)
+            machine.run()
+        except Exception:
+            # Same as an uncaught exception in executors.thread
+            exc_type, exc_value, exc_tb = sys.exc_info()
+            self.exception = threading.ExceptHookArgs(
+                [exc_type, exc_value, exc_tb, threading.current_thread()]
+            )
+            raise
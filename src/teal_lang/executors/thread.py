@@ -18,6 +18,10 @@ class Invoker:
     def _threading_excepthook(self, args):
         self.exception = args
 
+    def can_continue_inline(self):
+        """Whether a finishing thread may resume a continuation itself"""
+        return True
+
     def invoke(self, vmid, run_async=True):
         LOG.info(f"Invoking {vmid} (new thread? {run_async})")
         m = TlMachine(vmid, self)
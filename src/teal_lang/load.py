@@ -1,28 +1,117 @@
-"""Top-level utilities for loading Teal code"""
+"""Top-level utilities for loading Teal code
+
+Compiled executables are cached, keyed by source_key: in each process (see
+machine.executable.cache_executable), and on disk in CACHE_DIR if it's set
+(TEAL_EXE_CACHE, or the CLI sets it to a directory in the project's data
+directory).
+"""
+import hashlib
+import logging
 import os
 import sys
+import tempfile
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 
+from . import __version__
 from .teal_compiler.compiler import TealCompileError
 from .cli.interface import bad, neutral
-from .machine.executable import Executable
+from .machine import codec
+from .machine.executable import Executable, cache_executable, cached_executable
 from .teal_compiler import tl_compile
 from .teal_parser.parser import TealParseError, tl_parse
 
+LOG = logging.getLogger(__name__)
+
+CACHE_DIRNAME = "exe_cache"  # in a project's data directory
+CACHE_DIR = None  # type: Optional[Path]
+if os.getenv("TEAL_EXE_CACHE"):
+    CACHE_DIR = Path(os.environ["TEAL_EXE_CACHE"])
+
+# Source that determines the compiler output, relative to this package
+COMPILER_SOURCES = ["teal_parser", "teal_compiler", "machine/instructionset.py"]
+
+
+@lru_cache
+def compiler_version() -> str:
+    """Identify the compiler, including any local changes to its source"""
+    root = Path(__file__).parent
+    h = hashlib.sha256(__version__.encode())
+    for name in COMPILER_SOURCES:
+        path = root / name
+        for filename in sorted(path.glob("*.py")) if path.is_dir() else [path]:
+            h.update(filename.read_bytes())
+    return h.hexdigest()
+
+
+def source_key(text: str) -> str:
+    """Get the cache key for Teal source TEXT"""
+    h = hashlib.sha256(compiler_version().encode())
+    h.update(text.encode())
+    return h.hexdigest()
+
+
+def _disk_cache_file(cache_dir: Path, key: str) -> Path:
+    return cache_dir / f"{key}.tlb"
+
+
+def _load_from_disk(cache_dir: Path, key: str) -> Optional[Executable]:
+    try:
+        data = _disk_cache_file(cache_dir, key).read_bytes()
+    except FileNotFoundError:
+        return None
+    try:
+        exe = codec.loads(data)
+    except codec.CodecError as exc:
+        LOG.warning("Ignoring bad cached executable %s: %s", key, exc)
+        return None
+    exe.source_key = key
+    return exe
+
+
+def _save_to_disk(cache_dir: Path, exe: Executable):
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Write and rename, so other processes never see half a file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir)
+    with os.fdopen(fd, "wb") as f:
+        f.write(codec.dumps(exe))
+    os.replace(tmp, _disk_cache_file(cache_dir, exe.source_key))
+
+
+def _compile(filename, text: str, cache_dir: Optional[Path]) -> Executable:
+    key = source_key(text)
+    exe = cached_executable(key)
+    if exe is not None:
+        return exe
+
+    if cache_dir:
+        exe = _load_from_disk(cache_dir, key)
+        if exe is not None:
+            LOG.info("Loaded %s from the cache", filename)
+
+    if exe is None:
+        debug_lex = os.getenv("DEBUG_LEX", False)
+        exe = tl_compile(tl_parse(filename, text, debug_lex=debug_lex))
+        exe.source_key = key
+        if cache_dir:
+            _save_to_disk(cache_dir, exe)
+
+    cache_executable(exe)
+    return exe
+
 
-def compile_text(text: str) -> Executable:
+def compile_text(text: str, cache_dir: Optional[Path] = None) -> Executable:
     "Parse and compile a Teal program"
-    return tl_compile(
-        tl_parse("<unknown>", text, debug_lex=os.getenv("DEBUG_LEX", False))
-    )
+    return _compile("<unknown>", text, cache_dir or CACHE_DIR)
 
 
-def compile_file(filename: Path) -> Executable:
+def compile_file(filename: Path, cache_dir: Optional[Path] = None) -> Executable:
     "Compile a Teal file, creating an Executable ready to be used"
     with open(filename, "r") as f:
         text = f.read()
 
-    return tl_compile(tl_parse(filename, text, debug_lex=os.getenv("DEBUG_LEX", False)))
+    return _compile(filename, text, cache_dir or CACHE_DIR)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
 """Activation Records"""
 
 from dataclasses import dataclass
-from typing import Dict, Union
+from typing import List, Optional, Union
 
 from ..machine import types as mt
+from .state import deserialise_frame, serialise_frame
 from .teal_serialisable import TealSerialisable
 
 ARecPtr = int
@@ -20,7 +21,7 @@ class ActivationRecord(TealSerialisable):
     function: mt.TlFunctionPtr  # ....... Owner function
     vmid: int  # ......................
     # parameters: List[mt.TlType]  # ...... Function parameters
-    bindings: Dict[str, mt.TlType]  # ... Local bindings
+    locals: List[Optional[mt.TlType]]  # Local variable slots
     # result: mt.TlType  # ................ Function return value
     ref_count: int  # ................ Number of places this AR is used
     dynamic_chain: Union[ARecPtr, None] = None  # caller activation record
@@ -30,15 +31,11 @@ class ActivationRecord(TealSerialisable):
     def serialise(self):
         d = super().serialise()
         d["function"] = d["function"].serialise()
-        d["bindings"] = {
-            name: value.serialise() for name, value in d["bindings"].items()
-        }
+        d["locals"] = serialise_frame(d["locals"])
         return d
 
     @classmethod
     def deserialise(cls, d):
         d["function"] = mt.TlType.deserialise(d["function"])
-        d["bindings"] = {
-            name: mt.TlType.deserialise(value) for name, value in d["bindings"].items()
-        }
+        d["locals"] = deserialise_frame(d["locals"])
         return super().deserialise(d)
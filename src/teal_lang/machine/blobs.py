@@ -0,0 +1,143 @@
+"""Content-addressed storage for big values
+
+Big values (long lists and strings) are copied into every State, Future and
+activation record they pass through, which makes storage items big (and
+DynamoDB items have a size limit). If a blob store is configured, values
+that encode to at least THRESHOLD bytes are saved in the store instead,
+under the SHA-256 digest of their encoding, and items just hold a reference
+(state.TlBlobRef). Identical values are stored once.
+
+References are only resolved when the machine uses them (they're lazy values,
+see state.LazyValue), and resolved values are cached in each process.
+
+Configure with:
+- TEAL_BLOB_STORE: a directory, or s3://bucket/prefix (set AWS_ENDPOINT to use
+  an S3-compatible store, e.g. MinIO)
+- TEAL_BLOB_THRESHOLD: the minimum size of a stored value, in bytes
+"""
+
+import hashlib
+import logging
+import os
+import tempfile
+from functools import lru_cache
+from pathlib import Path
+from typing import Optional
+
+from ..exceptions import UnexpectedError
+
+LOG = logging.getLogger(__name__)
+
+THRESHOLD = int(os.getenv("TEAL_BLOB_THRESHOLD", 16 * 1024))
+CACHE_SIZE = 256  # number of resolved values kept in each process
+
+
+class BlobError(UnexpectedError):
+    """A blob can't be stored or loaded"""
+
+
+class BlobStore:
+    """Base class for blob stores"""
+
+    def __init__(self):
+        self._stored = set()  # digests known to be in the store
+
+    def put(self, data: bytes) -> str:
+        """Store DATA (if it isn't already), returning its digest"""
+        digest = hashlib.sha256(data).hexdigest()
+        if digest not in self._stored:
+            self.write(digest, data)
+            self._stored.add(digest)
+        return digest
+
+    def get(self, digest: str) -> bytes:
+        raise NotImplementedError
+
+    def write(self, digest: str, data: bytes):
+        raise NotImplementedError
+
+
+class DirectoryBlobStore(BlobStore):
+    """Blobs in files, in a local directory"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = Path(path)
+
+    def _file(self, digest) -> Path:
+        return self.path / digest[:2] / digest
+
+    def get(self, digest):
+        try:
+            return self._file(digest).read_bytes()
+        except FileNotFoundError:
+            raise BlobError(f"Blob {digest} not found in {self.path}") from None
+
+    def write(self, digest, data):
+        filename = self._file(digest)
+        if filename.exists():
+            return
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        # Write and rename, so the blob is never seen half-written
+        fd, tmp = tempfile.mkstemp(dir=filename.parent)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+
+
+class S3BlobStore(BlobStore):
+    """Blobs in an S3 (or S3-compatible) bucket"""
+
+    def __init__(self, bucket, prefix="", client=None):
+        super().__init__()
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        if client is None:
+            import boto3
+
+            client = boto3.client("s3", endpoint_url=os.getenv("AWS_ENDPOINT"))
+        self.client = client
+
+    def get(self, digest):
+        key = self.prefix + digest
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            raise BlobError(f"Blob {digest} not found in s3://{self.bucket}") from None
+
+    def write(self, digest, data):
+        # Content-addressed, so overwriting is harmless
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + digest, Body=data)
+
+
+def from_url(url: str) -> BlobStore:
+    """Make a blob store from a directory path, or s3://bucket/prefix"""
+    if url.startswith("s3://"):
+        bucket, _, prefix = url[len("s3://") :].partition("/")
+        return S3BlobStore(bucket, prefix)
+    return DirectoryBlobStore(url)
+
+
+STORE = None  # type: Optional[BlobStore]
+if os.getenv("TEAL_BLOB_STORE"):
+    STORE = from_url(os.environ["TEAL_BLOB_STORE"])
+
+
+def offload(data: bytes) -> Optional[str]:
+    """Store encoded value DATA if it's big enough, returning its digest"""
+    if STORE is None or len(data) < THRESHOLD:
+        return None
+    digest = STORE.put(data)
+    LOG.debug("Stored %d byte blob %s", len(data), digest)
+    return digest
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def load(digest: str):
+    """Get the value (a TlType) stored with DIGEST"""
+    # Teal values are immutable, so they can be shared from the cache
+    from . import codec
+
+    if STORE is None:
+        raise BlobError(f"Can't load blob {digest}: TEAL_BLOB_STORE is not set")
+    return codec.loads(STORE.get(digest))
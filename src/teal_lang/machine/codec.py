@@ -0,0 +1,563 @@
+"""Binary serialisation format
+
+A compact alternative to the JSON-able `serialise()` methods, for State (and
+its Frames), ActivationRecord, Future, Executable and all TlTypes (and plain
+Python lists, dicts and scalars of them).
+
+Layout of an encoded object:
+
+    MAGIC VERSION <string table> <value>
+
+- The string table is a varint count followed by each string (varint byte
+  length + UTF-8 bytes). Every string in the value (Teal strings, symbols,
+  names, ...) is written once in the table and referred to by its index.
+
+- Every value starts with a one-byte type tag. Integers are zigzag varints,
+  floats are 8 byte IEEE doubles, and containers are a varint length followed
+  by their elements.
+
+Records (State etc) are written as a tag followed by their fields in a fixed
+order, so there are no field names in the output.
+
+Big lists and hashes on a State's stack or in its frames, or in a Future, are
+written as a nested encoding (with its own string table), preceded by its
+length in bytes. They are decoded lazily (see state.LazyValue): decoding the
+State just slices out the bytes, and an untouched value is written back as it
+was. If a blob store is configured, the biggest are saved there instead, and
+written as a reference (see blobs).
+"""
+
+import struct
+
+from ..exceptions import UnexpectedError
+from . import blobs, instructionset
+from . import types as mt
+from .arec import ActivationRecord
+from .executable import Executable
+from .future import Future
+from .instruction import Instruction
+from .state import (
+    Frame,
+    LazyFrame,
+    LazyJsonValue,
+    LazyValue,
+    State,
+    TlBlobRef,
+    is_big,
+    lazy_frame,
+)
+
+MAGIC = b"TLB"
+VERSION = 3
+# Version 1 has no lazy values, and executables before version 3 have no
+# source_key
+SUPPORTED_VERSIONS = (1, 2, 3)
+
+# Python values
+PY_NONE = 0x00
+PY_FALSE = 0x01
+PY_TRUE = 0x02
+PY_INT = 0x03
+PY_FLOAT = 0x04
+PY_STR = 0x05
+PY_LIST = 0x06
+PY_DICT = 0x07
+
+# Teal values
+TL_NULL = 0x10
+TL_TRUE = 0x11
+TL_FALSE = 0x12
+TL_INT = 0x13
+TL_FLOAT = 0x14
+TL_STRING = 0x15
+TL_SYMBOL = 0x16
+TL_INSTRUCTION = 0x17
+TL_FUTURE_PTR = 0x18
+TL_QUOTE = 0x19
+TL_LIST = 0x1A
+TL_HASH = 0x1B
+TL_FUNCTION_PTR = 0x1C
+TL_FOREIGN_PTR = 0x1D
+
+# Records
+STATE = 0x20
+AREC = 0x21
+FUTURE = 0x22
+EXECUTABLE = 0x23
+INSTRUCTION = 0x24
+FRAME = 0x25
+LAZY = 0x26
+BLOB_REF = 0x27
+
+_DOUBLE = struct.Struct("<d")
+
+
+class CodecError(UnexpectedError):
+    """Data can't be encoded or decoded"""
+
+
+class _Encoder:
+    def __init__(self):
+        self.out = bytearray()
+        self.strings = {}
+
+    def uint(self, n: int):
+        out = self.out
+        if n < 0x80:
+            out.append(n)
+            return
+        while n > 0x7F:
+            out.append((n & 0x7F) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def sint(self, n: int):
+        self.uint(n << 1 if n >= 0 else (-n << 1) - 1)
+
+    def string(self, s: str):
+        idx = self.strings.get(s)
+        if idx is None:
+            idx = self.strings[s] = len(self.strings)
+        self.uint(idx)
+
+    def tagged_string(self, tag: int, s: str):
+        self.out.append(tag)
+        self.string(str.__str__(s))
+
+    def value(self, obj):
+        """Encode any supported object"""
+        try:
+            encode = _ENCODERS[type(obj)]
+        except KeyError:
+            raise CodecError(f"Can't encode {type(obj)}") from None
+        encode(self, obj)
+
+    def seq(self, tag: int, items):
+        self.out.append(tag)
+        self.uint(len(items))
+        encoders = _ENCODERS
+        try:
+            for item in items:
+                encoders[type(item)](self, item)
+        except KeyError:
+            raise CodecError(f"Can't encode {type(item)}") from None
+
+    def finish(self) -> bytes:
+        header = _Encoder()
+        header.out += MAGIC
+        header.out.append(VERSION)
+        header.uint(len(self.strings))
+        for s in self.strings:
+            data = s.encode("utf-8")
+            header.uint(len(data))
+            header.out += data
+        return bytes(header.out + self.out)
+
+
+def _enc_int(e, obj, tag=PY_INT):
+    e.out.append(tag)
+    n = int(obj)
+    e.uint(n << 1 if n >= 0 else (-n << 1) - 1)
+
+
+def _enc_tl_int(e, obj):
+    n = int(obj)
+    n = n << 1 if n >= 0 else (-n << 1) - 1
+    if n < 0x80:
+        e.out += bytes((TL_INT, n))
+    else:
+        e.out.append(TL_INT)
+        e.uint(n)
+
+
+def _enc_tl_string(e, obj):
+    idx = e.strings.get(obj)
+    if idx is None:
+        idx = e.strings[str.__str__(obj)] = len(e.strings)
+    if idx < 0x80:
+        e.out += bytes((TL_STRING, idx))
+    else:
+        e.out.append(TL_STRING)
+        e.uint(idx)
+
+
+def _enc_float(e, obj, tag=PY_FLOAT):
+    e.out.append(tag)
+    e.out += _DOUBLE.pack(obj)
+
+
+def _enc_dict(e, obj):
+    e.out.append(PY_DICT)
+    e.uint(len(obj))
+    for k, v in obj.items():
+        e.value(k)
+        e.value(v)
+
+
+def _enc_tl_hash(e, obj):
+    e.out.append(TL_HASH)
+    e.uint(len(obj))
+    for k, v in obj.items():
+        e.value(k)
+        e.value(v)
+
+
+def _enc_function_ptr(e, obj):
+    e.tagged_string(TL_FUNCTION_PTR, obj.identifier)
+    e.value(obj.stack_ptr)
+
+
+def _enc_foreign_ptr(e, obj):
+    e.tagged_string(TL_FOREIGN_PTR, obj.identifier)
+    e.string(obj.module)
+    e.string(obj.qualified_name)
+
+
+def _enc_quote(e, obj):
+    e.out.append(TL_QUOTE)
+    e.value(obj.data)
+
+
+def _enc_future_ptr(e, obj):
+    e.out.append(TL_FUTURE_PTR)
+    e.value(obj.value)
+
+
+def _enc_lazy(e, data: bytes):
+    e.out.append(LAZY)
+    e.uint(len(data))
+    e.out += data
+
+
+def _enc_maybe_lazy(e, obj):
+    """Encode a value, lazily or in the blob store if it's big"""
+    if not is_big(obj):
+        e.value(obj)
+        return
+    data = dumps(obj)
+    digest = blobs.offload(data)
+    if digest is None:
+        _enc_lazy(e, data)
+    else:
+        e.tagged_string(BLOB_REF, digest)
+
+
+def _enc_lazily(e, items):
+    """Encode a list of values, making big ones lazy"""
+    e.out.append(PY_LIST)
+    e.uint(len(items))
+    for item in items:
+        _enc_maybe_lazy(e, item)
+
+
+def _enc_state(e, obj: State):
+    e.out.append(STATE)
+    e.uint(obj.ip)
+    e.value(obj.stopped)
+    e.value(obj.error_msg)
+    _enc_lazily(e, obj._ds)
+    e.seq(PY_LIST, obj.frames)
+
+
+def _enc_frame(e, obj: Frame):
+    e.out.append(FRAME)
+    e.value(obj.function)
+    e.value(obj.call_site)
+    e.value(obj.arec_ptr)
+    _enc_lazily(e, obj.locals)
+
+
+def _enc_arec(e, obj: ActivationRecord):
+    e.out.append(AREC)
+    e.value(obj.function)
+    e.value(obj.vmid)
+    e.value(obj.ref_count)
+    e.value(obj.dynamic_chain)
+    e.value(obj.call_site)
+    e.value(obj.deleted)
+    _enc_lazily(e, obj.locals)
+
+
+def _enc_future(e, obj: Future):
+    e.out.append(FUTURE)
+    e.value(obj.resolved)
+    e.value(obj.chain)
+    _enc_maybe_lazy(e, obj.value)
+    e.seq(PY_LIST, obj.continuations)
+
+
+def _enc_instruction(e, obj: Instruction):
+    e.tagged_string(INSTRUCTION, obj.name)
+    e.seq(PY_LIST, obj.operands)
+    e.seq(PY_LIST, obj.source)
+
+
+def _enc_executable(e, obj: Executable):
+    e.out.append(EXECUTABLE)
+    e.value(obj.locations)
+    e.value(obj.bindings)
+    e.value(obj.local_names)
+    e.seq(PY_LIST, obj.code)
+    e.value(obj.source_key)
+
+
+_ENCODERS = {
+    type(None): lambda e, _: e.out.append(PY_NONE),
+    bool: lambda e, obj: e.out.append(PY_TRUE if obj else PY_FALSE),
+    int: _enc_int,
+    float: _enc_float,
+    str: lambda e, obj: e.tagged_string(PY_STR, obj),
+    list: lambda e, obj: e.seq(PY_LIST, obj),
+    LazyFrame: lambda e, obj: e.seq(PY_LIST, obj),
+    tuple: lambda e, obj: e.seq(PY_LIST, obj),
+    dict: _enc_dict,
+    mt.TlNull: lambda e, _: e.out.append(TL_NULL),
+    mt.TlTrue: lambda e, _: e.out.append(TL_TRUE),
+    mt.TlFalse: lambda e, _: e.out.append(TL_FALSE),
+    mt.TlInt: _enc_tl_int,
+    mt.TlFloat: lambda e, obj: _enc_float(e, obj, TL_FLOAT),
+    mt.TlString: _enc_tl_string,
+    mt.TlSymbol: lambda e, obj: e.tagged_string(TL_SYMBOL, obj),
+    mt.TlInstruction: lambda e, obj: e.tagged_string(TL_INSTRUCTION, obj),
+    mt.TlFuturePtr: _enc_future_ptr,
+    mt.TlQuote: _enc_quote,
+    mt.TlList: lambda e, obj: e.seq(TL_LIST, obj),
+    mt.TlHash: _enc_tl_hash,
+    mt.TlFunctionPtr: _enc_function_ptr,
+    mt.TlForeignPtr: _enc_foreign_ptr,
+    State: _enc_state,
+    Frame: _enc_frame,
+    ActivationRecord: _enc_arec,
+    Future: _enc_future,
+    Instruction: _enc_instruction,
+    Executable: _enc_executable,
+    LazyJsonValue: lambda e, obj: e.value(obj.force()),
+    TlBlobRef: lambda e, obj: e.tagged_string(BLOB_REF, obj.payload),
+}
+_ENCODERS.update({cls: _enc_instruction for cls in instructionset.OPCODES})
+
+
+class _Decoder:
+    def __init__(self, data: bytes):
+        if data[: len(MAGIC)] != MAGIC:
+            raise CodecError("Not binary Teal data")
+        if data[len(MAGIC)] not in SUPPORTED_VERSIONS:
+            raise CodecError(f"Unsupported binary format version {data[len(MAGIC)]}")
+        self.data = data
+        self.version = data[len(MAGIC)]
+        self.pos = len(MAGIC) + 1
+        self.strings = []
+        for _ in range(self.uint()):
+            size = self.uint()
+            self.strings.append(data[self.pos : self.pos + size].decode("utf-8"))
+            self.pos += size
+        self.tl_strings = [None] * len(self.strings)
+
+    def uint(self) -> int:
+        data = self.data
+        pos = self.pos
+        b = data[pos]
+        if b < 0x80:
+            self.pos = pos + 1
+            return b
+        result = shift = 0
+        while True:
+            b = data[pos]
+            pos += 1
+            result |= (b & 0x7F) << shift
+            if b < 0x80:
+                self.pos = pos
+                return result
+            shift += 7
+
+    def sint(self) -> int:
+        n = self.uint()
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1)
+
+    def string(self) -> str:
+        return self.strings[self.uint()]
+
+    def tl_string(self):
+        # Teal strings are immutable, so one object per table entry is enough
+        idx = self.uint()
+        obj = self.tl_strings[idx]
+        if obj is None:
+            obj = self.tl_strings[idx] = mt.TlString(self.strings[idx])
+        return obj
+
+    def double(self) -> float:
+        (value,) = _DOUBLE.unpack_from(self.data, self.pos)
+        self.pos += _DOUBLE.size
+        return value
+
+    def value(self):
+        tag = self.data[self.pos]
+        self.pos += 1
+        return _DECODERS[tag](self)
+
+    def items(self) -> list:
+        value = self.value
+        return [value() for _ in range(self.uint())]
+
+    def pairs(self) -> list:
+        return [(self.value(), self.value()) for _ in range(self.uint())]
+
+    def blob(self) -> bytes:
+        size = self.uint()
+        start = self.pos
+        self.pos += size
+        return self.data[start : self.pos]
+
+
+class LazyBinaryValue(LazyValue):
+    """A value encoded with dumps"""
+
+    __slots__ = ()
+
+    def force(self):
+        return loads(self.payload)
+
+
+_ENCODERS[LazyBinaryValue] = lambda e, obj: _enc_lazy(e, obj.payload)
+
+
+def _dec_tl_int(d) -> mt.TlInt:
+    # Inlined zigzag varint (most ints are small)
+    pos = d.pos
+    n = d.data[pos]
+    if n < 0x80:
+        d.pos = pos + 1
+    else:
+        n = d.uint()
+    return mt.TlInt((n >> 1) if not n & 1 else -((n + 1) >> 1))
+
+
+def _dec_state(d) -> State:
+    s = State([])
+    s.ip = d.uint()
+    s.stopped = d.value()
+    s.error_msg = d.value()
+    s._ds = d.value()
+    s.frames = d.value()
+    s.locals = s.frames[-1].locals if s.frames else []
+    return s
+
+
+def _dec_frame(d) -> Frame:
+    function = d.value()
+    call_site = d.value()
+    arec_ptr = d.value()
+    return Frame(function, lazy_frame(d.value()), call_site, arec_ptr)
+
+
+def _dec_arec(d) -> ActivationRecord:
+    return ActivationRecord(
+        function=d.value(),
+        vmid=d.value(),
+        ref_count=d.value(),
+        dynamic_chain=d.value(),
+        call_site=d.value(),
+        deleted=d.value(),
+        locals=lazy_frame(d.value()),
+    )
+
+
+def _dec_future(d) -> Future:
+    resolved = d.value()
+    chain = d.value()
+    value = d.value()
+    continuations = d.value()
+    return Future(
+        continuations=continuations, chain=chain, resolved=resolved, value=value
+    )
+
+
+def _dec_instruction(d) -> Instruction:
+    cls = getattr(instructionset, d.string())
+    operands = d.value()
+    source = d.value()
+    return cls(*operands, source=source)
+
+
+def _dec_executable(d) -> Executable:
+    locations = d.value()
+    bindings = d.value()
+    local_names = d.value()
+    code = d.value()
+    source_key = d.value() if d.version >= 3 else None
+    return Executable(
+        locations=locations,
+        bindings=bindings,
+        code=code,
+        attributes=None,
+        local_names=local_names,
+        source_key=source_key,
+    )
+
+
+_DECODER_TABLE = {
+    PY_NONE: lambda d: None,
+    PY_FALSE: lambda d: False,
+    PY_TRUE: lambda d: True,
+    PY_INT: lambda d: d.sint(),
+    PY_FLOAT: lambda d: d.double(),
+    PY_STR: lambda d: d.string(),
+    PY_LIST: lambda d: d.items(),
+    PY_DICT: lambda d: dict(d.pairs()),
+    TL_NULL: lambda d: mt.TlNull(),
+    TL_TRUE: lambda d: mt.TlTrue(),
+    TL_FALSE: lambda d: mt.TlFalse(),
+    TL_INT: _dec_tl_int,
+    TL_FLOAT: lambda d: mt.TlFloat(d.double()),
+    TL_STRING: lambda d: d.tl_string(),
+    TL_SYMBOL: lambda d: mt.TlSymbol(d.string()),
+    TL_INSTRUCTION: lambda d: mt.TlInstruction(d.string()),
+    TL_FUTURE_PTR: lambda d: mt.TlFuturePtr(d.value()),
+    TL_QUOTE: lambda d: mt.TlQuote(d.value()),
+    TL_LIST: lambda d: mt.TlList(d.items()),
+    TL_HASH: lambda d: mt.TlHash(d.pairs()),
+    TL_FUNCTION_PTR: lambda d: mt.TlFunctionPtr(d.string(), d.value()),
+    TL_FOREIGN_PTR: lambda d: mt.TlForeignPtr(d.string(), d.string(), d.string()),
+    STATE: _dec_state,
+    FRAME: _dec_frame,
+    LAZY: lambda d: LazyBinaryValue(d.blob()),
+    BLOB_REF: lambda d: TlBlobRef(d.string()),
+    AREC: _dec_arec,
+    FUTURE: _dec_future,
+    INSTRUCTION: _dec_instruction,
+    EXECUTABLE: _dec_executable,
+}
+
+
+def _bad_tag(d):
+    raise CodecError(f"Unknown type tag {d.data[d.pos - 1]:#x}")
+
+
+# Indexed by tag
+_DECODERS = [_DECODER_TABLE.get(tag, _bad_tag) for tag in range(256)]
+
+
+def dumps(obj) -> bytes:
+    """Encode OBJ in the binary format"""
+    e = _Encoder()
+    e.value(obj)
+    return e.finish()
+
+
+def dumps_lazily(obj) -> bytes:
+    """Encode OBJ (a value, or a list of them), making big values lazy"""
+    e = _Encoder()
+    if isinstance(obj, list):
+        _enc_lazily(e, obj)
+    else:
+        _enc_maybe_lazy(e, obj)
+    return e.finish()
+
+
+def loads(data: bytes):
+    """Decode data created by dumps"""
+    d = _Decoder(bytes(data))
+    obj = d.value()
+    if d.pos != len(d.data):
+        raise CodecError("Trailing data")
+    return obj
@@ -1,6 +1,7 @@
 """Placeholder for the controller class"""
 
 import logging
+import time
 from typing import List
 
 from ..exceptions import UnexpectedError
@@ -8,7 +9,7 @@ from . import types as mt
 from .arec import ActivationRecord
 from .future import Future
 from .probe import Probe
-from .state import State
+from .state import Frame, State, strict
 from .thread_failure import StackTraceItem, ThreadFailure
 
 LOG = logging.getLogger(__name__)
@@ -25,6 +26,26 @@ class Controller:
     def supports_plugin(self, name: str):
         return False
 
+    def sync(self):
+        """Save any data cached by this controller
+
+        Called at sync points: when a thread is created, before waiting on or
+        resolving a future, and when a machine stops. No-op by default.
+        """
+
+    def wait_all_stopped(self, timeout=None) -> bool:
+        """Wait until all threads have stopped, or TIMEOUT seconds have passed
+
+        Returns whether all threads have stopped. Polls all_stopped by default,
+        but subclasses should wait for a notification if they can.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.all_stopped():
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
     def toplevel_machine(self, fn_ptr: mt.TlFunctionPtr, args):
         """Create a top-level machine"""
         vmid = self.new_thread()
@@ -33,7 +54,7 @@ class Controller:
             dynamic_chain=None,
             vmid=vmid,
             call_site=None,
-            bindings={},
+            locals=self.executable.new_frame(fn_ptr.identifier),
             ref_count=1,
         )
         self.set_entrypoint(fn_ptr.identifier)
@@ -48,7 +69,7 @@ class Controller:
             dynamic_chain=caller_arec_ptr,
             vmid=vmid,
             call_site=caller_ip - 1,
-            bindings={},
+            locals=self.executable.new_frame(fn_ptr.identifier),
             ref_count=1,
         )
         self._init_thread(vmid, fn_ptr, args, arec)
@@ -58,12 +79,16 @@ class Controller:
         state = State(args)
         entrypoint_ip = self.executable.locations[fn_ptr.identifier]
         ptr = self.push_arec(vmid, arec)
-        state.current_arec_ptr = ptr
+        # The entry frame is always shared, as it links back to the caller
+        frame = Frame(fn_ptr, arec.locals, arec.call_site, arec_ptr=ptr)
+        state.frames = [frame]
+        state.locals = frame.locals
         state.ip = entrypoint_ip
         self.set_state(vmid, state)
         future = Future()
         self.set_future(vmid, future)
         self.set_stopped(vmid, False)
+        self.sync()
         return vmid
 
     ##
@@ -73,7 +98,7 @@ class Controller:
         # NOTE: if it's not resolved, value will be None
         value = self.get_top_level_future().value
         try:
-            return mt.to_py_type(value)
+            return mt.to_py_type(strict(value))
         except TypeError as exc:  # it's None or TlFunctionPtr, for example
             LOG.info(f"Can't return {value} ({type(value)}), returning None")
             return None
@@ -111,23 +136,40 @@ class Controller:
 
     ##
 
+    def update_future(self, vmid, modify):
+        """Atomically read-modify-write the future of machine VMID
+
+        MODIFY is called with the Future, and may change it in place. It must
+        return a tuple (changed, result): whether the future was changed (and
+        so must be saved), and the value to return.
+
+        By default this holds lock_future. Controllers may do it differently
+        (e.g. with optimistic concurrency), in which case MODIFY may be called
+        more than once.
+        """
+        with self.lock_future(vmid):
+            future = self.get_future(vmid)
+            changed, result = modify(future)
+            if changed:
+                self.set_future(vmid, future)
+        return result
+
     def resolve_future(self, vmid, value):
         """Resolve a machine future, and any dependent futures"""
         if isinstance(value, mt.TlFuturePtr):
             raise TypeError(value)
 
-        with self.lock_future(vmid):
-            future = self.get_future(vmid)
+        def resolve(future):
             future.resolved = True
             future.value = value
-            self.set_future(vmid, future)
+            return True, (list(future.continuations), future.chain)
 
-            continuations = future.continuations
-            if future.chain:
-                continuations += self.resolve_future(future.chain, value)
+        continuations, chain = self.update_future(vmid, resolve)
+        if chain is not None:
+            continuations += self.resolve_future(chain, value)
 
         if self.is_top_level(vmid):
-            self.result = mt.to_py_type(value)
+            self.result = mt.to_py_type(strict(value))
 
         LOG.info("Resolved %d to %s. Continuations: %s", vmid, value, continuations)
         return continuations
@@ -147,15 +189,17 @@ class Controller:
         # Otherwise, VALUE is another future, and we can only resolve this machine's
         # future if VALUE has also resolved. If VALUE hasn't resolved, we "chain"
         # this machine's future to it.
-        next_future_id = value.vmid
-        with self.lock_future(next_future_id):
-            next_future = self.get_future(next_future_id)
-            if next_future.resolved:
-                return (next_future.value, self.resolve_future(vmid, next_future.value))
-            else:
-                LOG.info("Chaining %s to %s", vmid, value)
-                self.set_future_chain(next_future_id, vmid)
-                return None, []
+        def chain(future):
+            if future.resolved:
+                return False, (True, future.value)
+            future.chain = vmid
+            return True, (False, None)
+
+        resolved, next_value = self.update_future(value.vmid, chain)
+        if resolved:
+            return next_value, self.resolve_future(vmid, next_value)
+        LOG.info("Chaining %s to %s", vmid, value)
+        return None, []
 
     def get_or_wait(self, vmid, future_ptr):
         """Get the value of a future in the stack, or add a continuation
@@ -170,23 +214,24 @@ class Controller:
         if type(vmid) is not int:
             raise TypeError(vmid)
 
-        with self.lock_future(future_ptr.vmid):
-            future = self.get_future(future_ptr.vmid)
+        def wait(future):
             if future.resolved:
-                value = future.value
-                LOG.info("%s has resolved: %s", future_ptr, value)
-            else:
-                value = None
-                self.add_continuation(future_ptr.vmid, vmid)
-                LOG.info("%d waiting on %s", vmid, future_ptr)
-                future = self.get_future(future_ptr.vmid)
+                return False, (True, future.value)
+            future.continuations.append(vmid)
+            return True, (False, None)
 
-        return future.resolved, value
+        resolved, value = self.update_future(future_ptr.vmid, wait)
+        if resolved:
+            LOG.info("%s has resolved: %s", future_ptr, value)
+        else:
+            LOG.info("%d waiting on %s", vmid, future_ptr)
+        return resolved, value
 
     ##
 
     def stop(self, vmid, finished_ok):
         """Signal that a machine has stopped running"""
+        self.sync()
         if not finished_ok:
             self.broken = True
         self.set_stopped(vmid, True)
@@ -214,32 +259,40 @@ class Controller:
         """Get a stack trace for a thread"""
         trace = []
         state = self.get_state(vmid)
-        arec_ptr = state.current_arec_ptr
-        arec = self.get_arec(arec_ptr)
+        frames = state.frames
+        if not frames:
+            return trace
 
         # Push the current frame
         trace.append(
             StackTraceItem(
                 caller_thread=vmid,
                 caller_ip=state.ip - 1,  # minus 1: IP is pre-advanced
-                caller_fn=arec.function.identifier,
+                caller_fn=frames[-1].function.identifier,
             )
         )
 
-        # And then all parents
-        while True:
-            arec = self.get_arec(arec_ptr)
-            if arec.dynamic_chain is not None:
-                parent = self.get_arec(arec.dynamic_chain)
-                trace.append(
-                    StackTraceItem(
-                        caller_thread=parent.vmid,
-                        caller_ip=arec.call_site,
-                        caller_fn=parent.function.identifier,
-                    )
+        # Then the callers in this thread
+        for i in range(len(frames) - 1, 0, -1):
+            trace.append(
+                StackTraceItem(
+                    caller_thread=vmid,
+                    caller_ip=frames[i].call_site,
+                    caller_fn=frames[i - 1].function.identifier,
                 )
-            else:
-                break
-            arec_ptr = arec.dynamic_chain
+            )
+
+        # And then all parents, in other threads
+        arec = self.get_arec(frames[0].arec_ptr)
+        while arec.dynamic_chain is not None:
+            parent = self.get_arec(arec.dynamic_chain)
+            trace.append(
+                StackTraceItem(
+                    caller_thread=parent.vmid,
+                    caller_ip=arec.call_site,
+                    caller_fn=parent.function.identifier,
+                )
+            )
+            arec = parent
 
         return list(reversed(trace))
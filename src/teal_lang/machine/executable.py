@@ -1,33 +1,150 @@
 """The Teal Machine Executable class"""
 
-from dataclasses import dataclass
-from typing import Any, Dict, List
+import sys
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Any, Dict, List, Optional
 
 from ..cli import interface as ui
 from . import instructionset
 from .instruction import Instruction
-from .types import TlType
+from .types import TlSymbol, TlType
+
+
+def link_operands(instr: Instruction):
+    """Decode the operands of an instruction into plain Python values
+
+    - int operands are unwrapped from TlInt
+    - symbols become interned strings (ready to be used as binding keys)
+    - everything else (e.g. PushV values) is left as-is
+
+    Returns None for no operands, the value for one, or a tuple for several.
+    """
+    ops = instr.operands
+    op_types = instr.op_types or []
+    decoded = []
+    for idx, o in enumerate(ops):
+        if idx < len(op_types) and op_types[idx] is int:
+            decoded.append(int(o))
+        elif isinstance(o, TlSymbol):
+            decoded.append(sys.intern(str(o)))
+        else:
+            decoded.append(o)
+
+    if not decoded:
+        return None
+    elif len(decoded) == 1:
+        return decoded[0]
+    else:
+        return tuple(decoded)
+
+
+class LinkedCode:
+    """Executable code, pre-decoded into parallel arrays for the machine
+
+    The instruction at position N is opcodes[N], with operand operands[N] (see
+    link_operands). The original instructions are kept for tracing.
+    """
+
+    def __init__(self, code: List[Instruction]):
+        self.instructions = code
+        self.opcodes = [i.opcode for i in code]
+        self.operands = [link_operands(i) for i in code]
+
+    def __len__(self):
+        return len(self.opcodes)
+
+
+# Executables by source_key, so each one is only built once per process
+CACHE_SIZE = 32
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cached_executable(source_key: str) -> Optional["Executable"]:
+    """Get the Executable compiled from the source with SOURCE_KEY, if cached"""
+    with _cache_lock:
+        exe = _cache.get(source_key, None)
+        if exe is not None:
+            _cache.move_to_end(source_key)
+        return exe
+
+
+def cache_executable(exe: "Executable"):
+    """Keep EXE (which must have a source_key) in the in-process cache"""
+    with _cache_lock:
+        _cache[exe.source_key] = exe
+        _cache.move_to_end(exe.source_key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
 
 
 @dataclass
 class Executable:
-    """Teal executable"""
+    """Teal executable
+
+    Executables are not modified once they are compiled, so one may be shared
+    by any number of sessions (see cache_executable).
+    """
 
     bindings: Dict[str, TlType]
     locations: Dict[str, int]
     code: List[Instruction]
     attributes: dict
+    local_names: Dict[str, List[str]] = field(default_factory=dict)
+    # Identifies the source and compiler version (see load.source_key)
+    source_key: Optional[str] = None
+    # Instructions saved by the optimiser in each function (not serialised)
+    saved_instructions: Dict[str, int] = field(default_factory=dict)
+
+    @cached_property
+    def linked(self) -> LinkedCode:
+        """The code in linked form, built once per Executable"""
+        return LinkedCode(self.code)
+
+    @cached_property
+    def frame_sizes(self) -> Dict[str, int]:
+        """Number of local variable slots needed by each function"""
+        return {name: len(slots) for name, slots in self.local_names.items()}
+
+    def new_frame(self, identifier: str) -> list:
+        """Make an empty (all None) list of local variable slots for a function"""
+        return [None] * self.frame_sizes.get(identifier, 0)
+
+    def function_at(self, ip: int) -> str:
+        """Get the identifier of the function containing the instruction at IP"""
+        return max(
+            (loc, name) for name, loc in self.locations.items() if loc <= ip
+        )[1]
+
+    def local_name(self, ip: int, slot: int) -> str:
+        """Get the name of local variable SLOT in the function containing IP"""
+        return self.local_names[self.function_at(ip)][slot]
 
     def listing(self) -> str:
         """Get a pretty assembly listing string"""
         print(" /")
+        funcname = None
         for i, instr in enumerate(self.code):
             if i in self.locations.values():
                 funcname = next(
                     k for k in self.locations.keys() if self.locations[k] == i
                 )
                 print(" | " + ui.primary(f";; {funcname}:"))
-            print(f" | {i:4} | {instr}")
+            if isinstance(
+                instr,
+                (
+                    instructionset.LoadLocal,
+                    instructionset.StoreLocal,
+                    instructionset.PopLocal,
+                ),
+            ):
+                name = self.local_names[funcname][instr.operands[0]]
+                print(f" | {i:4} | {instr}" + ui.dim(f"  ; {name}"))
+            else:
+                print(f" | {i:4} | {instr}")
         print(" \\")
 
     def bindings_table(self):
@@ -40,20 +157,57 @@ class Executable:
             k = ui.primary(k)
             print(f" {k} {dots} {v}")
 
+    def optimisation_table(self):
+        """Get a pretty table of the instructions saved in each function"""
+        saved = {k: v for k, v in self.saved_instructions.items() if v}
+        if not saved:
+            print(" Nothing to optimise")
+            return
+        spacing = max(len(x) for x in saved.keys()) + 3
+        k = "FUNCTION"
+        print(f" {k: <{spacing + 2}}SAVED")
+        for k, v in saved.items():
+            dots = "." * (spacing - len(k))
+            k = ui.primary(k)
+            print(f" {k} {dots} {v}")
+
     def serialise(self) -> dict:
         """Serialise the executable into a JSON-able dict"""
         code = [i.serialise() for i in self.code]
         bindings = {name: val.serialise() for name, val in self.bindings.items()}
-        return dict(locations=self.locations, bindings=bindings, code=code)
+        return dict(
+            locations=self.locations,
+            bindings=bindings,
+            code=code,
+            local_names=self.local_names,
+            source_key=self.source_key,
+        )
 
     @classmethod
     def deserialise(cls, obj: dict):
-        """Deserialise the dict created by serialise"""
+        """Deserialise the dict created by serialise
+
+        If the same source has already been compiled or deserialised in this
+        process, that Executable is returned instead.
+        """
+        source_key = obj["source_key"] if "source_key" in obj else None
+        if source_key:
+            exe = cached_executable(source_key)
+            if exe is not None:
+                return exe
         code = [Instruction.deserialise(i, instructionset) for i in obj["code"]]
         bindings = {
             name: TlType.deserialise(val) for name, val in obj["bindings"].items()
         }
         # FIXME attributes
-        return cls(
-            locations=obj["locations"], bindings=bindings, code=code, attributes=None
+        exe = cls(
+            locations=obj["locations"],
+            bindings=bindings,
+            code=code,
+            attributes=None,
+            local_names=obj["local_names"] if "local_names" in obj else {},
+            source_key=source_key,
         )
+        if source_key:
+            cache_executable(exe)
+        return exe
@@ -1,6 +1,6 @@
 """Machine futures"""
 
-from . import types as mt
+from .state import deserialise_lazily, serialise_value
 
 # Alias
 _SerialisedFuture = dict
@@ -16,7 +16,7 @@ class Future:
         self.value = value
 
     def serialise(self) -> _SerialisedFuture:
-        value = self.value.serialise() if self.value else None
+        value = serialise_value(self.value) if self.value is not None else None
         return dict(
             continuations=self.continuations,
             chain=self.chain,
@@ -27,7 +27,7 @@ class Future:
     @classmethod
     def deserialise(cls, data: _SerialisedFuture):
         if data.get("value", None):
-            data["value"] = mt.TlType.deserialise(data["value"])
+            data["value"] = deserialise_lazily(data["value"])
         return cls(**data)
 
     def __repr__(self):
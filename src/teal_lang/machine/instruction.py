@@ -29,6 +29,7 @@ class BadOperandsType(UnexpectedError):
 class Instruction:
     """A Teal Machine bytecode instruction"""
 
+    opcode = None  # assigned in instructionset
     num_ops = None
     op_types = None
     check_op_types = True
@@ -84,7 +85,7 @@ class Instruction:
     def __repr__(self):
         ops = ", ".join(map(str, self.operands))
         name = self.name.upper()
-        return f"{name:8} {ops}"
+        return f"{name:10} {ops}"
 
     def __eq__(self, other):
         return type(self) == type(other) and all(
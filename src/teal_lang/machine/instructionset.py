@@ -140,20 +140,33 @@ class PushV(I):
     op_types = [mt.TlType]
 
 
-class Bind(I):
-    """Take the top value off the stack and bind it to a register
+class StoreLocal(I):
+    """Bind the top value on the stack to a local variable slot (leaving it there)
+
+    Local variables are resolved to slot indices at compile time. Each function
+    frame is a list of slots.
+    """
+
+    op_types = [int]
 
-    Maybe - if the given binding doesn't exist in the current binding stack,
-    each parent stack will be searched until a matching binding is found. That'd
-    make this machine far more dynamic! And make compilation harder.
 
+class PopLocal(I):
+    """Bind the top value on the stack to a local variable slot, and remove it
+
+    The same as StoreLocal followed by Pop (see teal_compiler.peephole).
     """
 
-    op_types = [mt.TlSymbol]
+    op_types = [int]
 
 
-class PushB(I):
-    """Push a bound value onto the stack"""
+class LoadLocal(I):
+    """Push the value of a local variable slot onto the stack"""
+
+    op_types = [int]
+
+
+class LoadGlobal(I):
+    """Push the value of a global (executable) binding onto the stack"""
 
     op_types = [mt.TlSymbol]
 
@@ -276,3 +289,54 @@ class GetSessionId(I):
 
 class GetThreadId(I):
     """Get the current thread ID"""
+
+
+##± Builtins ±##################################################################
+
+# Names that can be called like functions, and the instruction implementing each
+
+BUILTINS = {
+    "future": Future,
+    "print": Print,
+    "sleep": Sleep,
+    "atomp": Atomp,
+    "nullp": Nullp,
+    "list": List,
+    "conc": Conc,
+    "append": Append,
+    "first": First,
+    "rest": Rest,
+    "length": Length,
+    "hash": Hash,
+    "get": HGet,
+    "set": HSet,
+    "nth": Nth,
+    "==": Eq,
+    "+": Plus,
+    # "-": Minus
+    "*": Multiply,
+    ">": GreaterThan,
+    "<": LessThan,
+    "&&": OpAnd,
+    "||": OpOr,
+    "parse_float": ParseFloat,
+    "signal": Signal,
+    "sid": GetSessionId,
+    "tid": GetThreadId,
+}
+
+
+##± Opcodes ±###################################################################
+
+# Every instruction type gets a small integer opcode, in definition order. The
+# machine uses it to index a handler table directly, rather than resolving the
+# handler from the instruction type on every step.
+
+OPCODES = [
+    cls
+    for cls in list(globals().values())
+    if isinstance(cls, type) and issubclass(cls, I) and cls is not I
+]
+
+for _opcode, _cls in enumerate(OPCODES):
+    _cls.opcode = _opcode
@@ -12,7 +12,6 @@ import os
 import sys
 import time
 import traceback
-from functools import singledispatchmethod
 from io import StringIO
 from typing import Any, Dict, List
 
@@ -20,11 +19,11 @@ from ..exceptions import TealError, UserResolvableError, UnexpectedError
 from . import types as mt
 from .arec import ActivationRecord
 from .controller import Controller
-from .executable import Executable
+from .executable import Executable, link_operands
 from .instruction import Instruction
 from .instructionset import *
 from .probe import Probe
-from .state import State
+from .state import Frame, State
 from .stdout_item import StdoutItem
 from .foreign import import_python_function
 
@@ -47,7 +46,25 @@ class ForeignError(UserResolvableError):
         super().__init__(str(exc), tb)
 
 
-def traverse(o, tree_types=(list, tuple)):
+# Instruction type -> handler function, filled in by @handles
+_HANDLERS = {}
+
+
+def handles(instr_type):
+    """Register a TlMachine method as the handler for an instruction type"""
+
+    def _register(fn):
+        _HANDLERS[instr_type] = fn
+        return fn
+
+    return _register
+
+
+def _not_implemented(machine, operand):
+    raise NotImplementedError(operand)
+
+
+def traverse(o, tree_types=(list, tuple, mt.TlList)):
     """Traverse an arbitrarily nested list"""
     if isinstance(o, tree_types):
         for value in o:
@@ -77,46 +94,16 @@ class TlMachine:
 
     """
 
-    builtins = {
-        "future": Future,
-        "print": Print,
-        "sleep": Sleep,
-        "atomp": Atomp,
-        "nullp": Nullp,
-        "list": List,
-        "conc": Conc,
-        "append": Append,
-        "first": First,
-        "rest": Rest,
-        "length": Length,
-        "hash": Hash,
-        "get": HGet,
-        "set": HSet,
-        "nth": Nth,
-        "==": Eq,
-        "+": Plus,
-        # "-": Minus
-        "*": Multiply,
-        ">": GreaterThan,
-        "<": LessThan,
-        "&&": OpAnd,
-        "||": OpOr,
-        "parse_float": ParseFloat,
-        "signal": Signal,
-        "sid": GetSessionId,
-        "tid": GetThreadId,
-    }
+    builtins = BUILTINS
 
     def __init__(self, vmid, invoker):
-        self._steps = 0
-        self.vmid = vmid
         self.invoker = invoker
         self.dc = invoker.data_controller
-        self.state = self.dc.get_state(self.vmid)
-        self.probe = Probe(self.vmid)
         self.exe = self.dc.executable
         if not self.exe:
             raise UnexpectedError("No executable, can't start thread.")
+        self.code = self.exe.linked
+        self.trace_steps = bool(os.getenv("TEAL_TRACE_STEPS", False))
         self._foreign = {
             name: import_python_function(val.identifier, val.module)
             for name, val in self.exe.bindings.items()
@@ -125,6 +112,16 @@ class TlMachine:
         LOG.debug("locations %s", self.exe.locations.keys())
         LOG.debug("foreign %s", self._foreign.keys())
         # No entrypoint argument - just set the IP in the state
+        self.load_thread(vmid)
+
+    def load_thread(self, vmid):
+        """Prepare to run thread VMID (keeping the executable and imports)"""
+        self._steps = 0
+        self.vmid = vmid
+        self.state = self.dc.get_state(vmid)
+        self.probe = Probe(vmid)
+        self._continuation = None  # thread to resume in this context
+        self._waiting = False  # stopped at a Wait (state already saved)
 
     @property
     def stopped(self):
@@ -136,20 +133,45 @@ class TlMachine:
 
     def step(self):
         """Execute the current instruction and increment the IP"""
-        if self.state.ip >= len(self.exe.code):
+        ip = self.state.ip
+        if ip >= len(self.code):
             raise UnexpectedError("Instruction Pointer out of bounds")
-        instr = self.exe.code[self.state.ip]
-        self.probe.event(
-            "step",
-            ip=self.state.ip,
-            instr=str(instr),
-            ops=str(instr.operands),
-            top_of_stack=shortstr(self.state._ds[-3:]),
-        )
+        if self.trace_steps:
+            instr = self.code.instructions[ip]
+            self.probe.event(
+                "step",
+                ip=ip,
+                instr=str(instr),
+                ops=str(instr.operands),
+                top_of_stack=shortstr(self.state._ds[-3:]),
+            )
         self.state.ip += 1  # NOTE - IP incremented before evaluation
-        self.evali(instr)
+        self.handlers[self.code.opcodes[ip]](self, self.code.operands[ip])
         self._steps += 1  # Counts successfully completed steps
 
+    def _run_untraced(self):
+        """Step through instructions until stopped, without tracing
+
+        This is the same as calling step() in a loop, with everything it needs
+        hoisted into locals.
+        """
+        opcodes = self.code.opcodes
+        operands = self.code.operands
+        num_instructions = len(opcodes)
+        handlers = self.handlers
+        state = self.state
+        steps = 0
+        try:
+            while not state.stopped:
+                ip = state.ip
+                if ip >= num_instructions:
+                    raise UnexpectedError("Instruction Pointer out of bounds")
+                state.ip = ip + 1  # NOTE - IP incremented before evaluation
+                handlers[opcodes[ip]](self, operands[ip])
+                steps += 1
+        finally:
+            self._steps += steps
+
     def run(self):
         """Step through instructions until stopped, or an error occurs
 
@@ -160,47 +182,74 @@ class TlMachine:
 
         There are two "expected" kinds of errors - a Foreign function error, and
         a Rust "panic!" style error (general error).
+
+        Set TEAL_TRACE_STEPS to record a probe event for every step. This is
+        very slow, and off by default.
+
+        If the thread finishes and the invoker lets it resume a continuation in
+        this context (see Return), that thread is run next, and so on.
         """
-        self.probe.event("run")
-        broken = False
+        while True:
+            self._run_thread()
+            if self._continuation is None:
+                break
+            LOG.info("%d continuing with %d", self.vmid, self._continuation)
+            self.load_thread(self._continuation)
 
+    def _run_thread(self):
+        """Run the current thread until it stops (see run)"""
+        self.probe.event("run")
         self.state.stopped = False
-        while not self.state.stopped:
-            try:
-                self.step()
-            except TealError as exc:
-                broken = True
-                self.state.stopped = True
-                self.state.error_msg = str(exc)
-                # TODO maybe dump the "core"
-                break
-            except Exception as exc:
-                # It's important to catch *all* errors so that other threads
-                # don't continue waiting for this to return.
-                broken = True
-                self.state.stopped = True
-                msg = f"Unexpected Exception:\n\n" + "".join(
-                    traceback.format_exception(*sys.exc_info())
-                )
-                self.state.error_msg = msg
-                break
+        finished_ok = self._run_until_stopped()
+        self._stop(finished_ok)
+
+    def _run_until_stopped(self, resume=None) -> bool:
+        """Step through instructions until stopped, catching any error
 
+        RESUME, if given, is called first (in the same error context). Returns
+        whether the machine stopped without an error.
+        """
+        try:
+            if resume:
+                resume()
+            if self.trace_steps:
+                while not self.state.stopped:
+                    self.step()
+            else:
+                self._run_untraced()
+        except TealError as exc:
+            self.state.stopped = True
+            self.state.error_msg = str(exc)
+            # TODO maybe dump the "core"
+            return False
+        except Exception as exc:
+            # It's important to catch *all* errors so that other threads
+            # don't continue waiting for this to return.
+            self.state.stopped = True
+            msg = f"Unexpected Exception:\n\n" + "".join(
+                traceback.format_exception(*sys.exc_info())
+            )
+            self.state.error_msg = msg
+            return False
+        return True
+
+    def _stop(self, finished_ok: bool):
+        """Save the thread's data and tell the controller that it has stopped"""
         self.probe.event("stop", steps=self._steps)
-        self.dc.set_state(self.vmid, self.state)
+        if not self._waiting:
+            self.dc.set_state(self.vmid, self.state)
         self.dc.set_probe_data(self.vmid, self.probe)
         # This order is important. dc.stop must come last to avoid race
         # conditions in us setting/the user reading the state and probe data
-        self.dc.stop(self.vmid, finished_ok=not broken)
+        self.dc.stop(self.vmid, finished_ok=finished_ok)
 
-    @singledispatchmethod
     def evali(self, i: Instruction):
         """Evaluate instruction"""
-        raise NotImplementedError(i)
+        return self.handlers[i.opcode](self, link_operands(i))
 
-    @evali.register
-    def _(self, i: Bind):
-        """Bind the top value on the data stack to a name"""
-        ptr = str(i.operands[0])
+    @handles(StoreLocal)
+    def _(self, operand):
+        """Bind the top value on the data stack to a local variable slot"""
         try:
             val = self.state.ds_peek(0)
         except IndexError as exc:
@@ -212,98 +261,85 @@ class TlMachine:
             )
         if not isinstance(val, mt.TlType):
             raise UnexpectedError(f"Bad value to Bind: {val} ({type(val)})")
-        self.state.bindings[ptr] = val
-
-    @evali.register
-    def _(self, i: PushB):
-        """Push the value bound to a name onto the data stack"""
-        # The value on the stack must be a Symbol, which is used to find a
-        # function to call. Binding precedence:
-        #
-        # local binding -> exe global bindings -> builtins
-        sym = i.operands[0]
-        if not isinstance(sym, mt.TlSymbol):
-            raise UnexpectedError(str(ValueError(sym, type(sym))))
-
-        ptr = str(sym)
-        if ptr in self.state.bindings:
-            val = self.state.bindings[ptr]
-        elif ptr in self.exe.bindings:
-            val = self.exe.bindings[ptr]
-        elif ptr in TlMachine.builtins:
-            val = mt.TlInstruction(ptr)
-        else:
-            # FIXME should be a compile time check
-            raise UserResolvableError(f"'{ptr}' is not defined", "")
+        self.state.locals[operand] = val
 
-        self.state.ds_push(val)
+    @handles(PopLocal)
+    def _(self, operand):
+        """Bind the top value on the data stack to a local slot, and remove it"""
+        self.handlers[StoreLocal.opcode](self, operand)
+        self.state.ds_pop()
 
-    @evali.register
-    def _(self, i: PushV):
-        val = i.operands[0]
+    @handles(LoadLocal)
+    def _(self, operand):
+        val = self.state.locals[operand]
+        if val is None:
+            name = self.exe.local_name(self.state.ip - 1, operand)
+            raise UserResolvableError(f"'{name}' is used before it is defined", "")
         self.state.ds_push(val)
 
-    @evali.register
-    def _(self, i: Pop):
+    @handles(LoadGlobal)
+    def _(self, operand):
+        self.state.ds_push(self.exe.bindings[operand])
+
+    @handles(PushV)
+    def _(self, operand):
+        self.state.ds_push(operand)
+
+    @handles(Pop)
+    def _(self, operand):
         self.state.ds_pop()
 
-    @evali.register
-    def _(self, i: Jump):
-        distance = i.operands[0]
-        self.state.ip += distance
+    @handles(Jump)
+    def _(self, operand):
+        self.state.ip += operand
 
-    @evali.register
-    def _(self, i: JumpIf):
-        distance = i.operands[0]
+    @handles(JumpIf)
+    def _(self, operand):
         a = self.state.ds_pop()
         # "true" means anything that's not False or Null
         if not isinstance(a, (mt.TlNull, mt.TlFalse)):
-            self.state.ip += distance
+            self.state.ip += operand
 
-    @evali.register
-    def _(self, i: Return):
+    @handles(Return)
+    def _(self, operand):
         # Only return if there's somewhere to go to, and it's in the same thread
-        current_arec = self.dc.pop_arec(self.state.current_arec_ptr)
-        if current_arec.dynamic_chain is not None:
-            new_arec = self.dc.get_arec(current_arec.dynamic_chain)
-            if new_arec.vmid == self.vmid:
-                self.probe.event("return")
-                self.state.current_arec_ptr = current_arec.dynamic_chain  # the new AR
-                self.state.ip = current_arec.call_site + 1
-                self.state.bindings = new_arec.bindings
-                return
+        frames = self.state.frames
+        frame = frames.pop()
+        if frame.arec_ptr is not None:
+            self.dc.pop_arec(frame.arec_ptr)
+        if frames:
+            self.probe.event("return")
+            self.state.ip = frame.call_site + 1
+            self.state.locals = frames[-1].locals
+            return
 
         # Otherwise, this thread has finished!
         self.state.stopped = True
         value = self.state.ds_peek(0)
         self.probe.log(f"Returning value: {shortstr(value)}")
+        self.dc.sync()
         value, continuations = self.dc.finish(self.vmid, value)
         for machine in continuations:
             self.dc.set_stopped(machine, False)
-            # FIXME - invoke all of the machines except the last one. That
-            # one, just run in this context. Save one invocation. Caution:
-            # tricky with Lambda timeouts.
+        # Resume the last continuation in this context, if the invoker can
+        # afford it (e.g. enough Lambda time is left), saving an invocation.
+        if continuations and self.invoker.can_continue_inline():
+            *continuations, self._continuation = continuations
+        for machine in continuations:
             self.invoker.invoke(machine)
 
-    @evali.register
-    def _(self, i: Call):
+    @handles(Call)
+    def _(self, operand):
         # Arguments for the function must already be on the stack
-        num_args = i.operands[0]
-        # The value to call will have been retrieved earlier by PushB.
+        num_args = operand
+        # The value to call will already be on the stack too.
         fn = self.state.ds_pop()
 
         if isinstance(fn, mt.TlFunctionPtr):
             self.probe.event("call", function=str(fn))
-            self.state.bindings = {}
-            arec = ActivationRecord(
-                function=fn,
-                vmid=self.vmid,
-                dynamic_chain=self.state.current_arec_ptr,
-                call_site=self.state.ip - 1,
-                bindings=self.state.bindings,
-                ref_count=1,
-            )
-            self.state.current_arec_ptr = self.dc.push_arec(self.vmid, arec)
+            frame = Frame(fn, self.exe.new_frame(fn.identifier), self.state.ip - 1)
+            self.state.frames.append(frame)
+            self.state.locals = frame.locals
             self.state.ip = self.exe.locations[fn.identifier]
 
         elif isinstance(fn, mt.TlForeignPtr):
@@ -314,40 +350,42 @@ class TlMachine:
             # waiting for in the continuation
 
             py_args = list(map(mt.to_py_type, args))
-
-            # capture Python's standard output
-            sys.stdout = capstdout = StringIO()
-            try:
-                py_result = foreign_f(*py_args)
-            except Exception as e:
-                out = capstdout.getvalue()
-                self.dc.write_stdout(StdoutItem(self.vmid, out))
-                raise ForeignError(e) from e
-            finally:
-                sys.stdout = sys.__stdout__
-
-            # These aren't included in the finally clause because that really
-            # slows down the cleanup
-            out = capstdout.getvalue()
-            self.dc.write_stdout(StdoutItem(self.vmid, out))
-
-            result = mt.to_teal_type(py_result)
-            self.state.ds_push(result)
+            self._call_foreign(foreign_f, py_args)
 
         elif isinstance(fn, mt.TlInstruction):
             self.probe.event("call_builtin", function=str(fn))
-            instr = TlMachine.builtins[fn](num_args)
-            self.evali(instr)
+            self.builtin_handlers[fn](self, num_args)
 
         else:
             # FIXME this should be a compile time check
             raise UnexpectedError(f"Don't know how to call `{fn}' of type {type(fn)}.")
 
-    @evali.register
-    def _(self, i: ACall):
+    def _call_foreign(self, foreign_f, py_args):
+        """Call a Python function, and push the result"""
+        # capture Python's standard output
+        sys.stdout = capstdout = StringIO()
+        try:
+            py_result = foreign_f(*py_args)
+        except Exception as e:
+            out = capstdout.getvalue()
+            self.dc.write_stdout(StdoutItem(self.vmid, out))
+            raise ForeignError(e) from e
+        finally:
+            sys.stdout = sys.__stdout__
+
+        # These aren't included in the finally clause because that really
+        # slows down the cleanup
+        out = capstdout.getvalue()
+        self.dc.write_stdout(StdoutItem(self.vmid, out))
+
+        result = mt.to_teal_type(py_result)
+        self.state.ds_push(result)
+
+    @handles(ACall)
+    def _(self, operand):
         # Arguments for the function must already be on the stack
         # ACall can *only* call functions in self.locations (unlike Call)
-        num_args = i.operands[0]
+        num_args = operand
         fn_ptr = self.state.ds_pop()
 
         # FIXME ugh.
@@ -364,7 +402,7 @@ class TlMachine:
 
         args = reversed([self.state.ds_pop() for _ in range(num_args)])
         machine = self.dc.thread_machine(
-            self.state.current_arec_ptr, self.state.ip, fn_ptr, args
+            self._share_frames(), self.state.ip, fn_ptr, args
         )
         self.invoker.invoke(machine)
         future = mt.TlFuturePtr(machine)
@@ -372,25 +410,54 @@ class TlMachine:
         self.probe.event("fork", to_function=fn_ptr.identifier, to_thread=machine)
         self.state.ds_push(future)
 
-    @evali.register
-    def _(self, i: Wait):
+    def _share_frames(self):
+        """Make the call stack visible to other threads, returning its top
+
+        Frames are shared (as ActivationRecords) bottom up, so every shared
+        frame's caller is shared too. The entry frame always is.
+        """
+        frames = self.state.frames
+        caller_ptr = None
+        for frame in frames:
+            if frame.arec_ptr is None:
+                arec = ActivationRecord(
+                    function=frame.function,
+                    vmid=self.vmid,
+                    dynamic_chain=caller_ptr,
+                    call_site=frame.call_site,
+                    locals=frame.locals,
+                    ref_count=1,
+                )
+                frame.arec_ptr = self.dc.push_arec(self.vmid, arec)
+            caller_ptr = frame.arec_ptr
+        return caller_ptr
+
+    @handles(Wait)
+    def _(self, operand):
         val = self.state.ds_peek(0)
 
         if isinstance(val, mt.TlFuturePtr):
+            # Save the state to resume from (repeating this Wait) *before*
+            # adding the continuation: the thread that resolves the future may
+            # resume this one before this machine has stopped.
+            #
+            # NOTE: Wait cannot be a builtin for this to work! It must be an
+            # explicit instruction in the bytecode.
+            self.state.ip -= 1
+            self.state.stopped = True
+            self.dc.set_state(self.vmid, self.state)
+            self.dc.sync()
             resolved, result = self.dc.get_or_wait(self.vmid, val)
             if resolved:
+                self.state.ip += 1
+                self.state.stopped = False
                 self.probe.log(f"{val} resolved, got {shortstr(result)}")
                 self.state.ds_set(0, result)
             else:
                 self.probe.log(f"Waiting for {val}")
-                # repeat the Wait instruction again:
-                #
-                # NOTE: Wait cannot be a builtin for this to work! It must be an
-                # explicit instruction in the bytecode.
-                self.state.ip -= 1
-                self.state.stopped = True
-
-        elif isinstance(val, list) and any(
+                self._waiting = True  # the saved state is now owned elsewhere
+
+        elif isinstance(val, mt.TlList) and any(
             isinstance(elt, mt.TlFuturePtr) for elt in traverse(val)
         ):
             # The programmer is responsible for waiting on all elements
@@ -410,8 +477,8 @@ class TlMachine:
 
     ## "builtins":
 
-    @evali.register
-    def _(self, i: Future):
+    @handles(Future)
+    def _(self, operand):
         wrapped = str(self.state.ds_pop())
         plugin_name = str(self.state.ds_pop())
 
@@ -426,25 +493,24 @@ class TlMachine:
             self.probe.log("Skipping call to plugin - controller doesn't support it")
             self.state.ds_push(wrapped)
 
-    @evali.register
-    def _(self, i: Atomp):
+    @handles(Atomp)
+    def _(self, operand):
         val = self.state.ds_pop()
-        self.state.ds_push(tl_bool(not isinstance(val, list)))
+        self.state.ds_push(tl_bool(not isinstance(val, mt.TlList)))
 
-    @evali.register
-    def _(self, i: Nullp):
+    @handles(Nullp)
+    def _(self, operand):
         val = self.state.ds_pop()
         isnull = isinstance(val, mt.TlNull) or len(val) == 0
         self.state.ds_push(tl_bool(isnull))
 
-    @evali.register
-    def _(self, i: List):
-        num_args = i.operands[0]
-        elts = [self.state.ds_pop() for _ in range(num_args)]
+    @handles(List)
+    def _(self, operand):
+        elts = [self.state.ds_pop() for _ in range(operand)]
         self.state.ds_push(mt.TlList(reversed(elts)))
 
-    @evali.register
-    def _(self, i: Conc):
+    @handles(Conc)
+    def _(self, operand):
         b = self.state.ds_pop()
         a = self.state.ds_pop()
 
@@ -456,12 +522,12 @@ class TlMachine:
             raise UserResolvableError(f"b ({b}, {type(b)}) is not a list", "")
 
         if isinstance(a, mt.TlList):
-            self.state.ds_push(mt.TlList(a + b))
+            self.state.ds_push(a.concat(b))
         else:
-            self.state.ds_push(mt.TlList([a] + b))
+            self.state.ds_push(b.cons(a))
 
-    @evali.register
-    def _(self, i: Append):
+    @handles(Append)
+    def _(self, operand):
         b = self.state.ds_pop()
         a = self.state.ds_pop()
 
@@ -471,47 +537,46 @@ class TlMachine:
             # TODO compile time checks...
             raise UserResolvableError(f"{a} ({type(a)}) is not a list", "")
 
-        self.state.ds_push(mt.TlList(a + [b]))
+        self.state.ds_push(a.appended(b))
 
-    @evali.register
-    def _(self, i: First):
+    @handles(First)
+    def _(self, operand):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(lst[0])
 
-    @evali.register
-    def _(self, i: Rest):
+    @handles(Rest)
+    def _(self, operand):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
-        self.state.ds_push(lst[1:])
+        self.state.ds_push(lst.rest())
 
-    @evali.register
-    def _(self, i: Nth):
+    @handles(Nth)
+    def _(self, operand):
         n = self.state.ds_pop()
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(lst[n])
 
-    @evali.register
-    def _(self, i: Length):
+    @handles(Length)
+    def _(self, operand):
         lst = self.state.ds_pop()
         if not isinstance(lst, mt.TlList):
             raise UserResolvableError(f"{lst} ({type(lst)}) is not a list", "")
         self.state.ds_push(mt.TlInt(len(lst)))
 
-    @evali.register
-    def _(self, i: Hash):
-        num_args = i.operands[0]
+    @handles(Hash)
+    def _(self, operand):
         # convert list [a, b, c, d] (reversed) -> dict {a: b, c: d}
-        elts = [self.state.ds_pop() for _ in range(num_args)][::-1]
+        elts = [self.state.ds_pop() for _ in range(operand)][::-1]
         pairs = zip(elts[::2], elts[1::2])
         self.state.ds_push(mt.TlHash(pairs))
 
-    @evali.register
-    def _(self, i: HGet):
+    @handles(HGet)
+    def _(self, operand):
         key = self.state.ds_pop()
         obj = self.state.ds_pop()
         if not isinstance(obj, mt.TlHash):
@@ -522,44 +587,44 @@ class TlMachine:
             res = mt.TlNull()
         self.state.ds_push(res)
 
-    @evali.register
-    def _(self, i: HSet):
+    @handles(HSet)
+    def _(self, operand):
         value = self.state.ds_pop()
         key = self.state.ds_pop()
         obj = self.state.ds_pop()
         if not isinstance(obj, mt.TlHash):
             raise UserResolvableError(f"{obj} ({type(obj)}) is not a hash", "")
         # Create a new object, overwriting the old key
-        self.state.ds_push(mt.TlHash({**obj, key: value}))
+        self.state.ds_push(obj.set(key, value))
 
-    @evali.register
-    def _(self, i: Plus):
+    @handles(Plus)
+    def _(self, operand):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a + b))
 
-    @evali.register
-    def _(self, i: Multiply):
+    @handles(Multiply)
+    def _(self, operand):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         cls = new_number_type(a, b)
         self.state.ds_push(cls(a * b))
 
-    @evali.register
-    def _(self, i: Eq):
+    @handles(Eq)
+    def _(self, operand):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a == b))
 
-    @evali.register
-    def _(self, i: GreaterThan):
+    @handles(GreaterThan)
+    def _(self, operand):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a > b))
 
-    @evali.register
-    def _(self, i: LessThan):
+    @handles(LessThan)
+    def _(self, operand):
         a = self.state.ds_pop()
         b = self.state.ds_pop()
         self.state.ds_push(tl_bool(a < b))
@@ -571,8 +636,8 @@ class TlMachine:
                 f"Got {a.__tlname__} and {b.__tlname__}",
             )
 
-    @evali.register
-    def _(self, i: OpAnd):
+    @handles(OpAnd)
+    def _(self, operand):
         # FIXME no short-circuit behaviour
         a = self.state.ds_pop()
         b = self.state.ds_pop()
@@ -581,8 +646,8 @@ class TlMachine:
             tl_bool(isinstance(a, mt.TlTrue) and isinstance(b, mt.TlTrue))
         )
 
-    @evali.register
-    def _(self, i: OpOr):
+    @handles(OpOr)
+    def _(self, operand):
         # FIXME no short-circuit behaviour
         a = self.state.ds_pop()
         b = self.state.ds_pop()
@@ -591,26 +656,26 @@ class TlMachine:
             tl_bool(isinstance(a, mt.TlTrue) or isinstance(b, mt.TlTrue))
         )
 
-    @evali.register
-    def _(self, i: ParseFloat):
+    @handles(ParseFloat)
+    def _(self, operand):
         x = self.state.ds_pop()
         self.state.ds_push(mt.TlFloat(float(x)))
 
-    @evali.register
-    def _(self, i: Sleep):
+    @handles(Sleep)
+    def _(self, operand):
         t = self.state.ds_peek(0)
         time.sleep(t)
 
-    @evali.register
-    def _(self, i: Print):
+    @handles(Print)
+    def _(self, operand):
         # Leave the value in the stack - print() 'returns' the value printed
         val = self.state.ds_peek(0)
         # This should take a vmid - data stored is a tuple (vmid, str)
         # Could also store a timestamp...
         self.dc.write_stdout(StdoutItem(self.vmid, str(val) + "\n"))
 
-    @evali.register
-    def _(self, i: Signal):
+    @handles(Signal)
+    def _(self, operand):
         msg = self.state.ds_peek(0)
         val = self.state.ds_peek(1)
         self.dc.write_stdout(StdoutItem(self.vmid, f"\n[signal {val}]: {msg}\n"))
@@ -618,14 +683,22 @@ class TlMachine:
             raise UnhandledError(msg)
         # other kinds of signals don't need special handling
 
-    @evali.register
-    def _(self, i: GetSessionId):
+    @handles(GetSessionId)
+    def _(self, operand):
         self.state.ds_push(mt.TlString(self.dc.session_id))
 
-    @evali.register
-    def _(self, i: GetThreadId):
+    @handles(GetThreadId)
+    def _(self, operand):
         self.state.ds_push(mt.TlInt(self.vmid))
 
+    # Handler table, indexed by instruction opcode
+    handlers = [_HANDLERS.get(cls, _not_implemented) for cls in OPCODES]
+
+    # Handlers for builtins called by value (a TlInstruction), by name
+    builtin_handlers = {
+        name: _HANDLERS.get(cls, _not_implemented) for name, cls in BUILTINS.items()
+    }
+
     def __repr__(self):
         return f"<Machine {id(self)}>"
 
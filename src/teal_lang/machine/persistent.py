@@ -0,0 +1,293 @@
+"""Persistent (immutable, structurally shared) containers
+
+These back TlList and TlHash. "Modifying" one returns a new container that
+shares almost all of its structure with the original, so the usual functional
+patterns (e.g. append to an accumulator in a tail-recursive loop) don't copy the
+whole container on every step.
+
+- PVector: a bit-partitioned vector trie with a tail buffer (like Clojure's
+  PersistentVector). O(log32 n) get and set, amortised O(1) append.
+
+- PMap: a hash array mapped trie (HAMT). O(log32 n) get and set.
+"""
+
+from typing import Any, Iterable, Iterator, List, Tuple
+
+BITS = 5
+WIDTH = 1 << BITS
+MASK = WIDTH - 1
+
+
+def _chunks(items: list, size: int) -> List[list]:
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+class PVector:
+    """Persistent vector
+
+    Elements live in 32-wide leaves at the bottom of a trie. The last (up to)
+    32 elements are kept in a separate tail leaf, so most appends only copy the
+    tail.
+
+    Nodes are plain lists, and are never modified after being created.
+    """
+
+    __slots__ = ("_count", "_shift", "_root", "_tail")
+
+    def __init__(self, items: Iterable = ()):
+        items = list(items)
+        count = len(items)
+        tail_offset = self._tail_offset_for(count)
+        nodes = _chunks(items[:tail_offset], WIDTH)
+        shift = BITS
+        while len(nodes) > WIDTH:
+            nodes = _chunks(nodes, WIDTH)
+            shift += BITS
+        self._count = count
+        self._shift = shift
+        self._root = nodes
+        self._tail = items[tail_offset:]
+
+    @classmethod
+    def _make(cls, count, shift, root, tail) -> "PVector":
+        v = cls.__new__(cls)
+        v._count = count
+        v._shift = shift
+        v._root = root
+        v._tail = tail
+        return v
+
+    @staticmethod
+    def _tail_offset_for(count: int) -> int:
+        return 0 if count < WIDTH else ((count - 1) >> BITS) << BITS
+
+    def _leaf_for(self, i: int) -> list:
+        if i >= self._tail_offset_for(self._count):
+            return self._tail
+        node = self._root
+        for level in range(self._shift, 0, -BITS):
+            node = node[(i >> level) & MASK]
+        return node
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, i: int):
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        return self._leaf_for(i)[i & MASK]
+
+    def iter_from(self, start: int) -> Iterator:
+        """Iterate over elements, starting at index START"""
+        i = start
+        while i < self._count:
+            leaf = self._leaf_for(i)
+            yield from leaf[i & MASK :]
+            i = (i | MASK) + 1
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def append(self, value) -> "PVector":
+        """Return a new vector with VALUE added to the end"""
+        count, shift, root = self._count, self._shift, self._root
+        if count - self._tail_offset_for(count) < WIDTH:
+            return self._make(count + 1, shift, root, self._tail + [value])
+
+        # The tail is full - push it into the trie and start a new one
+        if (count >> BITS) > (1 << shift):
+            # No room under the current root, so add a level
+            root = [root, self._new_path(shift, self._tail)]
+            shift += BITS
+        else:
+            root = self._push_tail(shift, root, self._tail)
+        return self._make(count + 1, shift, root, [value])
+
+    def _push_tail(self, level: int, parent: list, tail: list) -> list:
+        subidx = ((self._count - 1) >> level) & MASK
+        node = list(parent)
+        if level == BITS:
+            child = tail
+        elif subidx < len(parent):
+            child = self._push_tail(level - BITS, parent[subidx], tail)
+        else:
+            child = self._new_path(level - BITS, tail)
+
+        if subidx < len(node):
+            node[subidx] = child
+        else:
+            node.append(child)
+        return node
+
+    def _new_path(self, level: int, node: list) -> list:
+        if level == 0:
+            return node
+        return [self._new_path(level - BITS, node)]
+
+    def set(self, i: int, value) -> "PVector":
+        """Return a new vector with the element at I replaced by VALUE"""
+        if i < 0:
+            i += self._count
+        if not 0 <= i < self._count:
+            raise IndexError(i)
+        if i >= self._tail_offset_for(self._count):
+            tail = list(self._tail)
+            tail[i & MASK] = value
+            return self._make(self._count, self._shift, self._root, tail)
+        root = self._do_set(self._shift, self._root, i, value)
+        return self._make(self._count, self._shift, root, self._tail)
+
+    def _do_set(self, level: int, node: list, i: int, value) -> list:
+        node = list(node)
+        if level == 0:
+            node[i & MASK] = value
+        else:
+            subidx = (i >> level) & MASK
+            node[subidx] = self._do_set(level - BITS, node[subidx], i, value)
+        return node
+
+    def __repr__(self):
+        return f"PVector({list(self)})"
+
+
+class _Collision:
+    """Entries whose keys all have the same (full) hash"""
+
+    __slots__ = ("hash", "entries")
+
+    def __init__(self, h: int, entries: List[Tuple[Any, Any]]):
+        self.hash = h
+        self.entries = entries
+
+
+class _Node:
+    """HAMT node: a bitmap of occupied slots, and a dense array of entries
+
+    Each entry is either a (key, value) tuple, a _Node, or a _Collision.
+    """
+
+    __slots__ = ("bitmap", "array")
+
+    def __init__(self, bitmap: int, array: list):
+        self.bitmap = bitmap
+        self.array = array
+
+
+_EMPTY_NODE = _Node(0, [])
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hash(key) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _merge(shift: int, h1: int, e1, h2: int, e2):
+    """Make a node containing two entries with different positions or hashes"""
+    if h1 == h2:
+        return _Collision(h1, [e1, e2])
+    b1 = (h1 >> shift) & MASK
+    b2 = (h2 >> shift) & MASK
+    if b1 == b2:
+        return _Node(1 << b1, [_merge(shift + BITS, h1, e1, h2, e2)])
+    if b1 < b2:
+        return _Node((1 << b1) | (1 << b2), [e1, e2])
+    return _Node((1 << b1) | (1 << b2), [e2, e1])
+
+
+def _assoc(node, shift: int, h: int, key, value):
+    """Return (new node, whether a new key was added)"""
+    if isinstance(node, _Collision):
+        if node.hash == h:
+            entries = list(node.entries)
+            for idx, (k, _) in enumerate(entries):
+                if k == key:
+                    entries[idx] = (key, value)
+                    return _Collision(h, entries), False
+            return _Collision(h, entries + [(key, value)]), True
+        # Different hash that shares this position - push the collision down
+        return _merge(shift, node.hash, node, h, (key, value)), True
+
+    bit = 1 << ((h >> shift) & MASK)
+    idx = bin(node.bitmap & (bit - 1)).count("1")
+
+    if not node.bitmap & bit:
+        array = node.array[:idx] + [(key, value)] + node.array[idx:]
+        return _Node(node.bitmap | bit, array), True
+
+    entry = node.array[idx]
+    if isinstance(entry, tuple):
+        if entry[0] == key:
+            new_entry, added = (key, value), False
+        else:
+            new_entry = _merge(shift + BITS, _hash(entry[0]), entry, h, (key, value))
+            added = True
+    else:
+        new_entry, added = _assoc(entry, shift + BITS, h, key, value)
+
+    array = list(node.array)
+    array[idx] = new_entry
+    return _Node(node.bitmap, array), added
+
+
+def _iter_entries(node) -> Iterator[Tuple[Any, Any]]:
+    if isinstance(node, _Collision):
+        yield from node.entries
+        return
+    for entry in node.array:
+        if isinstance(entry, tuple):
+            yield entry
+        else:
+            yield from _iter_entries(entry)
+
+
+class PMap:
+    """Persistent hash map (unordered)"""
+
+    __slots__ = ("_root", "_count")
+
+    def __init__(self, items: Iterable[Tuple[Any, Any]] = ()):
+        root, count = _EMPTY_NODE, 0
+        for key, value in items:
+            root, added = _assoc(root, 0, _hash(key), key, value)
+            count += added
+        self._root = root
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def get(self, key, default=None):
+        h = _hash(key)
+        node, shift = self._root, 0
+        while True:
+            if isinstance(node, _Collision):
+                for k, v in node.entries:
+                    if k == key:
+                        return v
+                return default
+            bit = 1 << ((h >> shift) & MASK)
+            if not node.bitmap & bit:
+                return default
+            entry = node.array[bin(node.bitmap & (bit - 1)).count("1")]
+            if isinstance(entry, tuple):
+                return entry[1] if entry[0] == key else default
+            node, shift = entry, shift + BITS
+
+    def set(self, key, value) -> "PMap":
+        """Return a new map with KEY bound to VALUE"""
+        root, added = _assoc(self._root, 0, _hash(key), key, value)
+        m = PMap.__new__(PMap)
+        m._root = root
+        m._count = self._count + added
+        return m
+
+    def items(self) -> Iterator[Tuple[Any, Any]]:
+        return _iter_entries(self._root)
+
+    def __iter__(self):
+        return (k for k, _ in self.items())
+
+    def __repr__(self):
+        return f"PMap({dict(self.items())})"
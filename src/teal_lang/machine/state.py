@@ -1,11 +1,169 @@
 """Machine state representation"""
 
+from dataclasses import dataclass
+from typing import List, Optional
+
+from . import blobs
+from . import types as mt
+from .teal_serialisable import TealSerialisable
 from .types import TlType
 
 # TODO convert this class to TealSerialisable, there's duplicated logic. Sorry -
 # it came earlier in the design, and is slightly non-trivial to change.
 
 
+class LazyValue:
+    """A serialised Teal value, decoded the first time it is used
+
+    Resumed machines often only touch the top of the stack, and pass the rest
+    of their state (e.g. big lists) through untouched. So containers on the
+    stack and in frames are kept serialised when a State is deserialised, and
+    are only decoded when the machine reads them (see State.ds_pop and
+    LazyFrame). An untouched value is re-serialised as it was, without being
+    decoded.
+    """
+
+    __slots__ = ("payload",)
+
+    # Lists and hashes with at least this many items are deserialised lazily
+    min_items = 16
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+    def force(self) -> TlType:
+        """Decode the value"""
+        raise NotImplementedError
+
+    def serialise(self):
+        return self.force().serialise()
+
+
+class LazyJsonValue(LazyValue):
+    """A value serialised with TlType.serialise"""
+
+    __slots__ = ()
+
+    def force(self):
+        return TlType.deserialise(self.payload)
+
+    def serialise(self):
+        return self.payload
+
+
+class TlBlobRef(LazyValue):
+    """A value in the blob store, referred to by its digest (see blobs)"""
+
+    __slots__ = ()
+
+    def force(self):
+        return blobs.load(self.payload)
+
+    def serialise(self):
+        return [type(self).__name__, self.payload]
+
+
+def strict(value):
+    """Decode VALUE if it's a LazyValue"""
+    return value.force() if isinstance(value, LazyValue) else value
+
+
+def is_big(value) -> bool:
+    """Whether VALUE should be serialised lazily, or in the blob store"""
+    kind = type(value)
+    if kind is mt.TlList or kind is mt.TlHash:
+        return len(value) >= LazyValue.min_items
+    return (
+        kind is mt.TlString
+        and blobs.STORE is not None
+        and len(value) >= blobs.THRESHOLD
+    )
+
+
+def serialise_value(value):
+    """Serialise a value, putting it in the blob store if it's big enough"""
+    if is_big(value):
+        from . import codec  # codec depends on this module
+
+        digest = blobs.offload(codec.dumps(value))
+        if digest is not None:
+            return TlBlobRef(digest).serialise()
+    return value.serialise()
+
+
+class LazyFrame(list):
+    """Local variable slots, some of which may be LazyValues"""
+
+    __slots__ = ()
+
+    def __getitem__(self, idx):
+        value = super().__getitem__(idx)
+        if isinstance(value, LazyValue):
+            value = value.force()
+            self[idx] = value
+        return value
+
+
+def lazy_frame(values: list) -> list:
+    """Make a LazyFrame from VALUES, if any of them are lazy"""
+    if any(isinstance(value, LazyValue) for value in values):
+        return LazyFrame(values)
+    return values
+
+
+def deserialise_lazily(obj) -> TlType:
+    """Deserialise a value created with serialise_value, lazily if it's big"""
+    if obj[0] == "TlBlobRef":
+        return TlBlobRef(obj[1])
+    if obj[0] in ("TlList", "TlHash") and len(obj[1]) >= LazyValue.min_items:
+        return LazyJsonValue(obj)
+    return TlType.deserialise(obj)
+
+
+def serialise_frame(frame: list) -> list:
+    """Serialise a list of local variable slots (empty slots are None)"""
+    return [None if value is None else serialise_value(value) for value in frame]
+
+
+def deserialise_frame(data: list) -> list:
+    """Deserialise the list created by serialise_frame"""
+    return lazy_frame(
+        [None if value is None else deserialise_lazily(value) for value in data]
+    )
+
+
+@dataclass
+class Frame(TealSerialisable):
+    """A function call in progress, on a thread's call stack
+
+    Frames are private to their thread. One is only shared (as an
+    ActivationRecord, pointed to by arec_ptr) when a new thread may need to
+    refer back to it - see TlMachine._share_frames.
+    """
+
+    function: mt.TlFunctionPtr
+    locals: List[Optional[TlType]]  # Local variable slots
+    call_site: Optional[int] = None  # IP of the Call in the caller
+    arec_ptr: Optional[int] = None
+
+    def serialise(self):
+        return dict(
+            function=self.function.serialise(),
+            locals=serialise_frame(self.locals),
+            call_site=self.call_site,
+            arec_ptr=self.arec_ptr,
+        )
+
+    @classmethod
+    def deserialise(cls, d):
+        d["function"] = TlType.deserialise(d["function"])
+        d["locals"] = deserialise_frame(d["locals"])
+        return super().deserialise(d)
+
+
 class State:
     """Data local/specific to a particular thread"""
 
@@ -13,9 +171,9 @@ class State:
         self.ip = 0
         self._ds = list(data)
         self.stopped = False
-        self.bindings = {}
+        self.frames = []  # the call stack, innermost last
+        self.locals = []  # local variable slots of the current frame
         self.error_msg = None
-        self.current_arec_ptr = None
 
     def ds_push(self, val):
         if not isinstance(val, TlType):
@@ -23,15 +181,21 @@ class State:
         self._ds.append(val)
 
     def ds_pop(self):
-        return self._ds.pop()
+        val = self._ds.pop()
+        if isinstance(val, LazyValue):
+            return val.force()
+        return val
 
     def ds_peek(self, offset):
         """Peek at the Nth value from the top of the stack (0-indexed)"""
-        return self._ds[-(offset + 1)]
+        val = self._ds[-(offset + 1)]
+        if isinstance(val, LazyValue):
+            val = self._ds[-(offset + 1)] = val.force()
+        return val
 
     def ds_set(self, offset, val):
-        """Set the value at offset in the stack"""
-        if not isinstance(val, TlType):
+        """Set the value at offset in the stack (which may be lazy)"""
+        if not isinstance(val, (TlType, LazyValue)):
             raise TypeError(val)
         self._ds[-(offset + 1)] = val
 
@@ -40,8 +204,8 @@ class State:
 
     def to_table(self):
         return (
-            "Bind: "
-            + ", ".join(f"{k}->{v}" for k, v in self.bindings.items())
+            "Locals: "
+            + ", ".join(f"{k}->{v}" for k, v in enumerate(self.locals))
             + f"\nData: {self._ds}"
         )
 
@@ -55,10 +219,9 @@ class State:
         return dict(
             ip=self.ip,
             stopped=self.stopped,
-            ds=[value.serialise() for value in self._ds],
-            bindings={name: value.serialise() for name, value in self.bindings.items()},
+            ds=[serialise_value(value) for value in self._ds],
+            frames=[frame.serialise() for frame in self.frames],
             error_msg=self.error_msg,
-            current_arec_ptr=self.current_arec_ptr,
         )
 
     @classmethod
@@ -66,10 +229,8 @@ class State:
         s = cls([])
         s.ip = data["ip"]
         s.stopped = data["stopped"]
-        s._ds = [TlType.deserialise(obj) for obj in data["ds"]]
-        s.bindings = {
-            name: TlType.deserialise(val) for name, val in data["bindings"].items()
-        }
+        s._ds = [deserialise_lazily(obj) for obj in data["ds"]]
+        s.frames = [Frame.deserialise(frame) for frame in data["frames"]]
+        s.locals = s.frames[-1].locals if s.frames else []
         s.error_msg = data["error_msg"]
-        s.current_arec_ptr = data["current_arec_ptr"]
         return s
@@ -1,9 +1,8 @@
 """TealSerialisable class"""
 import datetime
-from dataclasses import asdict, dataclass
+from dataclasses import asdict
 
 
-@dataclass
 class TealSerialisable:
     """A basic serialisation mixin.
 
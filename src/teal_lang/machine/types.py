@@ -5,8 +5,10 @@ Requirement: all types must be trivially JSON serialisable.
 See https://docs.python.org/3/library/json.html#py-to-json-table
 """
 
+from collections.abc import Mapping, Sequence
 from typing import Optional
-from collections import UserList, UserDict
+
+from .persistent import PMap, PVector
 
 # TODO Convert these to dataclasses
 
@@ -135,22 +137,178 @@ class TlQuote(TlType):
         return cls(TlType.deserialise(data))
 
 
-class TlList(UserList, TlType):
+class TlList(Sequence, TlType):
+    """An immutable list
+
+    Elements are stored in two parts: a linked list of cons cells at the front
+    (so cons/first/rest are O(1)), followed by a slice of a persistent vector
+    (so append is amortised O(1) and nth is O(log n)).
+
+    Operations that "change" the list return a new TlList sharing structure
+    with this one.
+    """
+
+    def __init__(self, items=()):
+        self._front = None  # (value, next) cons cells, or None
+        self._front_len = 0
+        self._vec = PVector(items)
+        self._start = 0
+        self._flat = None
+
+    @classmethod
+    def _make(cls, front, front_len, vec, start) -> "TlList":
+        lst = cls.__new__(cls)
+        lst._front = front
+        lst._front_len = front_len
+        lst._vec = vec
+        lst._start = start
+        lst._flat = None
+        return lst
+
+    def __len__(self):
+        return self._front_len + len(self._vec) - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1 and stop == len(self):
+                return self._drop(start)
+            return TlList(self[j] for j in range(start, stop, step))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("list index out of range")
+        if i >= self._front_len:
+            return self._vec[self._start + i - self._front_len]
+        if i >= 32:
+            # Deep into the cons cells - index a flattened copy instead
+            if self._flat is None:
+                self._flat = PVector(iter(self))
+            return self._flat[i]
+        cell = self._front
+        for _ in range(i):
+            cell = cell[1]
+        return cell[0]
+
+    def _drop(self, n: int) -> "TlList":
+        if n >= self._front_len:
+            start = self._start + n - self._front_len
+            return self._make(None, 0, self._vec, start)
+        cell = self._front
+        for _ in range(n):
+            cell = cell[1]
+        return self._make(cell, self._front_len - n, self._vec, self._start)
+
+    def __iter__(self):
+        cell = self._front
+        while cell is not None:
+            yield cell[0]
+            cell = cell[1]
+        yield from self._vec.iter_from(self._start)
+
+    def __eq__(self, other):
+        if not isinstance(other, (TlList, list)):
+            return False
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __add__(self, other):
+        return self.concat(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def rest(self) -> "TlList":
+        """All but the first element"""
+        if self._front is not None:
+            front, next_cell = self._front
+            return self._make(next_cell, self._front_len - 1, self._vec, self._start)
+        start = min(self._start + 1, len(self._vec))
+        return self._make(None, 0, self._vec, start)
+
+    def cons(self, value) -> "TlList":
+        """A new list with VALUE at the front"""
+        front = (value, self._front)
+        return self._make(front, self._front_len + 1, self._vec, self._start)
+
+    def appended(self, value) -> "TlList":
+        """A new list with VALUE at the end"""
+        vec = self._vec.append(value)
+        return self._make(self._front, self._front_len, vec, self._start)
+
+    def concat(self, other) -> "TlList":
+        """A new list with the elements of OTHER at the end"""
+        vec = self._vec
+        for value in other:
+            vec = vec.append(value)
+        return self._make(self._front, self._front_len, vec, self._start)
+
     def serialise_data(self):
-        return [a.serialise() for a in self.data]
+        return [a.serialise() for a in self]
 
     @classmethod
     def from_data(cls, data):
         return cls([TlType.deserialise(a) for a in data])
 
 
-class TlHash(UserDict, TlType):
+class TlHash(Mapping, TlType):
+    """An immutable hash, which keeps insertion order
+
+    Keys are indexed in a persistent hash map, pointing into a persistent
+    vector of (key, value) entries. set() returns a new TlHash sharing
+    structure with this one.
+    """
+
+    def __init__(self, items=()):
+        self._index = PMap()
+        self._entries = PVector()
+        if isinstance(items, Mapping):
+            items = items.items()
+        for key, value in items:
+            self._set_in_place(key, value)
+
+    def _set_in_place(self, key, value):
+        pos = self._index.get(key)
+        if pos is None:
+            self._index = self._index.set(key, len(self._entries))
+            self._entries = self._entries.append((key, value))
+        else:
+            self._entries = self._entries.set(pos, (key, value))
+
+    def __getitem__(self, key):
+        pos = self._index.get(key)
+        if pos is None:
+            raise KeyError(key)
+        return self._entries[pos][1]
+
+    def __contains__(self, key):
+        return self._index.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return (k for k, _ in self._entries)
+
+    def items(self):
+        return iter(self._entries)
+
+    def __repr__(self):
+        return repr(dict(self._entries))
+
+    def set(self, key, value) -> "TlHash":
+        """A new hash with KEY bound to VALUE"""
+        hsh = TlHash.__new__(TlHash)
+        hsh._index = self._index
+        hsh._entries = self._entries
+        hsh._set_in_place(key, value)
+        return hsh
+
     def serialise_data(self):
-        return [[k.serialise(), v.serialise()] for k, v in self.data.items()]
+        return [[k.serialise(), v.serialise()] for k, v in self.items()]
 
     @classmethod
     def from_data(cls, data):
-        return cls({TlType.deserialise(k): TlType.deserialise(v) for k, v in data})
+        return cls((TlType.deserialise(k), TlType.deserialise(v)) for k, v in data)
 
 
 class TlFunctionPtr(TlType):
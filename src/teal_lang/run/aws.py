@@ -4,7 +4,6 @@ import json
 import logging
 import os
 import sys
-import time
 import traceback
 
 from .. import __version__, load
@@ -44,12 +43,12 @@ def resume(event, context):
     # a result to. So all exceptions must appear in the AWS console.
     #
     # However, any waiting machines need to find out about this.
-    _run_machine(controller, vmid)
+    _run_machine(controller, vmid, context)
 
 
-def _run_machine(controller, vmid):
+def _run_machine(controller, vmid, context=None):
     try:
-        invoker = Invoker(controller)
+        invoker = Invoker(controller, context)
         machine = TlMachine(vmid, invoker)
         machine.run()
 
@@ -71,7 +70,8 @@ def event_handler(event, context):
     for h in lambda_handlers.ALL_HANDLERS:
         if h.can_handle(event):
             LOG.info("Handling with %s", str(h))
-            return h.handle(event, _new_session, UserResolvableError)
+            new_session = functools.partial(_new_session, context=context)
+            return h.handle(event, new_session, UserResolvableError)
 
     raise ValueError(f"Can't handle event {event}")
 
@@ -91,7 +91,11 @@ def set_exe(event, context):
 
 
 def getoutput(event, context):
-    """Get Teal standard output for a session"""
+    """Get Teal standard output for a session
+
+    The output is paginated: if there is more, the result includes a "next"
+    token. Pass it back in the event to get the next page.
+    """
     session_id = event.get("session_id", None)
 
     if not session_id:
@@ -99,18 +103,18 @@ def getoutput(event, context):
 
     try:
         controller = ddb_controller.DataController.with_session_id(session_id)
-        output = [o.serialise() for o in controller.get_stdout()]
+        output, next_page = _get_page(controller, db.STDOUT, event.get("next"))
         errors = [
             controller.get_state(idx).error_msg for idx in controller.get_thread_ids()
         ]
     except ControllerError:
         return _fail("Error getting data")
 
-    return _success(output=output, errors=errors)
+    return _success(output=output, errors=errors, next=next_page)
 
 
 def getevents(event, context) -> dict:
-    """Get probe events for a session"""
+    """Get probe events for a session (paginated, like getoutput)"""
     session_id = event.get("session_id", None)
 
     if not session_id:
@@ -118,18 +122,33 @@ def getevents(event, context) -> dict:
 
     try:
         controller = ddb_controller.DataController.with_session_id(session_id)
-        events = [pe.serialise() for pe in controller.get_probe_events()]
+        events, next_page = _get_page(controller, db.PEVENTS, event.get("next"))
     except ControllerError:
         return _fail("Error loading session data")
 
-    return _success(events=events)
+    return _success(events=events, next=next_page)
 
 
 ## Helpers
 
+# Approximate maximum number of records returned by getoutput/getevents at once
+PAGE_SIZE = 2000
+
+
+def _get_page(controller, group, start_after):
+    """Get (records, next page token) from the shards of GROUP"""
+    records = []
+    last = None
+    for item_id, shard in controller.iter_shards(group, start_after):
+        if len(records) >= PAGE_SIZE:
+            return records, last
+        records += shard
+        last = item_id
+    return records, None
+
 
 def _new_session(
-    function, args, check_period, wait_for_finish, timeout, code_override=None
+    function, args, wait_for_finish, timeout, code_override=None, context=None
 ):
     """Create a new teal session"""
     LOG.info("Creating new session and running function: %s", function)
@@ -161,18 +180,14 @@ def _new_session(
         msg = "".join(traceback.format_exception(*sys.exc_info()))
         raise UserResolvableError("Error initialising Teal", msg) from exc
 
-    _run_machine(controller, vmid)
+    _run_machine(controller, vmid, context)
 
     # TODO reduce duplication - this is all similar to common.py
-    if wait_for_finish:
-        start_time = time.time()
-        while not controller.all_stopped():
-            time.sleep(check_period)
-            if time.time() - start_time > timeout:
-                raise UserResolvableError(
-                    f"Timeout waiting for Teal program to finish ({controller.session_id})",
-                    "",
-                )
+    if wait_for_finish and not controller.wait_all_stopped(timeout):
+        raise UserResolvableError(
+            f"Timeout waiting for Teal program to finish ({controller.session_id})",
+            "",
+        )
 
     return controller
 
@@ -19,15 +19,14 @@ class ThreadDied(UnexpectedError):
 
 
 def wait_for_finish(check_period, timeout, data_controller, invoker):
-    """Wait for a machine to finish, checking every CHECK_PERIOD
+    """Wait for a machine to finish, checking the invoker every CHECK_PERIOD
 
     If timeout is None, wait indefinitely.
 
     """
     start_time = time.time()
     try:
-        while not data_controller.all_stopped():
-            time.sleep(check_period)
+        while not data_controller.wait_all_stopped(check_period):
             if timeout and time.time() - start_time > timeout:
                 raise Exception("Timeout waiting for finish")
 
@@ -73,7 +72,10 @@ def run_and_wait(controller, invoker, waiter, filename, function, args: List[str
         waiter(controller, invoker)
 
     finally:
-        items = controller.get_probe_events() + controller.get_probe_logs()
+        # Executors with resources to release (e.g. a pool of workers)
+        if hasattr(invoker, "close"):
+            invoker.close()
+        items = [*controller.get_probe_events(), *controller.get_probe_logs()]
         for p in sorted(items, key=lambda p: p.thread):
             if hasattr(p, "event"):
                 LOG.info(f"*** [{p.thread}] {p.event} {p.data}")
@@ -4,6 +4,7 @@ from functools import partial
 from ..machine.controller import ControllerError
 from ..controllers import ddb as ddb_controller
 from ..executors import multiprocess as mp
+from ..executors import pool as teal_pool
 from ..executors import thread as teal_thread
 from .common import run_and_wait, wait_for_finish
 
@@ -18,7 +19,7 @@ def run_ddb_local(filename, function, args, timeout=10):
     try:
         return run_and_wait(controller, invoker, waiter, filename, function, args)
     except pynamodb.exceptions.PynamoDBException as exc:
-        raise ControllerError("Database error: {exc}") from exc
+        raise ControllerError(f"Database error: {exc}") from exc
 
 
 def run_ddb_processes(filename, function, args, timeout=10):
@@ -29,4 +30,15 @@ def run_ddb_processes(filename, function, args, timeout=10):
     try:
         return run_and_wait(controller, invoker, waiter, filename, function, args)
     except pynamodb.exceptions.PynamoDBException as exc:
-        raise ControllerError("Database error: {exc}") from exc
+        raise ControllerError(f"Database error: {exc}") from exc
+
+
+def run_ddb_pool(filename, function, args, timeout=10):
+    """Run with dynamodb and a pool of Python threads"""
+    controller = ddb_controller.DataController.with_new_session()
+    invoker = teal_pool.Invoker(controller)
+    waiter = partial(wait_for_finish, 1, timeout)
+    try:
+        return run_and_wait(controller, invoker, waiter, filename, function, args)
+    except pynamodb.exceptions.PynamoDBException as exc:
+        raise ControllerError(f"Database error: {exc}") from exc
@@ -51,7 +51,6 @@ class CliHandler(TealEventHandler):
             controller = new_session(
                 function=event.get("function", "main"),
                 args=[mt.TlString(a) for a in event.get("args", [])],
-                check_period=event.get("check_period", 0.2),
                 wait_for_finish=event.get("wait_for_finish", True),
                 timeout=timeout,
                 code_override=event.get("code", None),
@@ -99,7 +98,6 @@ class S3Handler(TealEventHandler):
             function="on_upload",  # constant
             args=[mt.TlString(bucket), mt.TlString(key)],
             wait_for_finish=False,
-            check_period=None,
             timeout=None,
         )
 
@@ -122,7 +120,6 @@ class HttpHandler(TealEventHandler):
             function="on_http",  # constant
             args=[mt.to_teal_type(o) for o in (method, path, event)],
             wait_for_finish=False,
-            check_period=0.1,
             timeout=10.0,  # TODO? make configurable
         )
 
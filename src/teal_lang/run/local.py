@@ -3,15 +3,37 @@ import os
 from functools import partial
 
 from ..controllers import local as local
+from ..controllers import shared as shared
+from ..executors import aio as teal_aio
+from ..executors import multiprocess as mp
+from ..executors import pool as teal_pool
 from ..executors import thread as teal_thread
 from ..machine.types import to_py_type
 from .common import LOG, run_and_wait, wait_for_finish
 
 
-def run_local(filename, function, args, timeout_s=10):
+def run_local(filename, function, args, timeout_s=10, executor=teal_thread):
     LOG.debug(f"PYTHONPATH: {os.getenv('PYTHONPATH')}")
     controller = local.DataController()
-    invoker = teal_thread.Invoker(controller)
+    invoker = executor.Invoker(controller)
     check_period = 0.1
     waiter = partial(wait_for_finish, check_period, timeout_s)
     return run_and_wait(controller, invoker, waiter, filename, function, args)
+
+
+def run_local_pool(filename, function, args, timeout_s=10):
+    """Run with in-memory storage and a pool of Python threads"""
+    return run_local(filename, function, args, timeout_s, executor=teal_pool)
+
+
+def run_local_asyncio(filename, function, args, timeout_s=10):
+    """Run with in-memory storage, and threads as coroutines on one event loop"""
+    return run_local(filename, function, args, timeout_s, executor=teal_aio)
+
+
+def run_local_processes(filename, function, args, timeout_s=10):
+    """Run with memory shared between Python processes"""
+    controller = shared.DataController()
+    invoker = mp.Invoker(controller)
+    waiter = partial(wait_for_finish, 0.1, timeout_s)
+    return run_and_wait(controller, invoker, waiter, filename, function, args)
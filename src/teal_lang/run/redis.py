@@ -0,0 +1,20 @@
+"""Run Teal with a Redis storage backend"""
+from functools import partial
+
+from ..controllers import redis as redis_controller
+from ..executors import pool as teal_pool
+from ..executors import thread as teal_thread
+from .common import run_and_wait, wait_for_finish
+
+
+def run_redis(filename, function, args, timeout=10, client=None, executor=teal_thread):
+    """Run with Redis (at TEAL_REDIS_URL, or CLIENT) and python threading"""
+    controller = redis_controller.DataController.with_new_session(client)
+    invoker = executor.Invoker(controller)
+    waiter = partial(wait_for_finish, 0.1, timeout)
+    return run_and_wait(controller, invoker, waiter, filename, function, args)
+
+
+def run_redis_pool(filename, function, args, timeout=10, client=None):
+    """Run with Redis and a pool of Python threads"""
+    return run_redis(filename, function, args, timeout, client, executor=teal_pool)
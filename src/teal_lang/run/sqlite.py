@@ -0,0 +1,45 @@
+"""Run Teal with a SQLite storage backend"""
+from functools import partial
+
+from ..controllers import sqlite as sqlite_controller
+from ..executors import pool as teal_pool
+from ..executors import thread as teal_thread
+from .common import run_and_wait, wait_for_finish
+
+
+def run_sqlite(
+    filename,
+    function,
+    args,
+    timeout=10,
+    path=sqlite_controller.DEFAULT_PATH,
+    executor=teal_thread,
+):
+    """Run with SQLite (at PATH) and python threading"""
+    controller = sqlite_controller.DataController.with_new_session(path)
+    invoker = executor.Invoker(controller)
+    waiter = partial(wait_for_finish, 0.1, timeout)
+    return run_and_wait(controller, invoker, waiter, filename, function, args)
+
+
+def run_sqlite_pool(
+    filename, function, args, timeout=10, path=sqlite_controller.DEFAULT_PATH
+):
+    """Run with SQLite (at PATH) and a pool of Python threads"""
+    return run_sqlite(filename, function, args, timeout, path, executor=teal_pool)
+
+
+def get_output(controller) -> dict:
+    """Get the standard output of a session, like the getoutput API"""
+    return dict(
+        output=[item.serialise() for item in controller.get_stdout()],
+        errors=[
+            controller.get_state(vmid).error_msg
+            for vmid in controller.get_thread_ids()
+        ],
+    )
+
+
+def get_events(controller) -> dict:
+    """Get the probe events of a session, like the getevents API"""
+    return dict(events=[item.serialise() for item in controller.get_probe_events()])
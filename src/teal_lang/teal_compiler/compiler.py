@@ -1,8 +1,10 @@
 """Optimise and compile an AST into executable code"""
+import copy
+import dataclasses
 import itertools
 import logging
 from functools import singledispatch, singledispatchmethod, wraps
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Set
 
 from ..cli.interface import format_source_problem
 from ..exceptions import UserResolvableError
@@ -38,6 +40,53 @@ class TealCompileError(UserResolvableError):
         super().__init__(msg, explanation)
 
 
+def toplevel_names(exprs: list) -> Set[str]:
+    """Find the names bound at top level (function definitions and imports)"""
+    names = set()
+    for e in exprs:
+        if isinstance(e, nodes.N_Definition):
+            names.add(e.name)
+        elif (
+            isinstance(e, nodes.N_Call)
+            and isinstance(e.fn, nodes.N_Id)
+            and e.fn.name == "import"
+            and len(e.args) in (3, 4)
+        ):
+            qualifier = e.args[3] if len(e.args) == 4 else e.args[0]
+            if isinstance(qualifier.value, nodes.N_Id):
+                names.add(qualifier.value.name)
+    return names
+
+
+def find_locals(n: nodes.N_Definition) -> List[str]:
+    """Find the local variables of a function: parameters, then assignments
+
+    The position of each name in the result is its slot index in the frame.
+    Nested function definitions (lambdas) have their own frames.
+    """
+    names = list(dict.fromkeys(n.paramlist))
+
+    def walk(node):
+        if isinstance(node, list):
+            for item in node:
+                walk(item)
+        elif isinstance(node, (nodes.N_Lambda, nodes.N_Definition)):
+            return
+        elif isinstance(node, nodes.Node):
+            if (
+                isinstance(node, nodes.N_Binop)
+                and node.op == "="
+                and isinstance(node.lhs, nodes.N_Id)
+                and node.lhs.name not in names
+            ):
+                names.append(node.lhs.name)
+            for f in dataclasses.fields(node):
+                walk(getattr(node, f.name))
+
+    walk(n.body)
+    return names
+
+
 def optimise_block(n: nodes.N_Definition, block: nodes.N_Progn):
     """Optimise a single block (progn) of expressions"""
     if not isinstance(block, nodes.N_Progn):
@@ -69,6 +118,134 @@ def optimise_tailcall(n: nodes.N_Definition):
     return n
 
 
+def calls_builtin(name: str, shadowed: Set[str]) -> bool:
+    """Check whether calling NAME calls a builtin (see compile_builtin_call)
+
+    SHADOWED is the set of local and global names, which take precedence over
+    builtins (see CompileToplevel.compile_name).
+    """
+    return name in mi.BUILTINS and name not in shadowed
+
+
+def literal_value(n) -> Optional[mt.TlType]:
+    """Get the value of N if it's a literal (or a plain literal argument)"""
+    if isinstance(n, nodes.N_Argument) and n.symbol is None:
+        n = n.value
+    if not isinstance(n, nodes.N_Literal):
+        return None
+    if isinstance(n.value, mt.TlType):
+        return n.value
+    return mt.to_teal_type(n.value)
+
+
+def fold_binop(op: str, a: mt.TlType, b: mt.TlType) -> Optional[mt.TlType]:
+    """Evaluate A OP B like the machine does, or None if it can't be folded
+
+    Anything that would fail at run time isn't folded, so that it still does.
+    """
+    numbers = (mt.TlInt, mt.TlFloat)
+    if op in ("+", "*"):
+        if not isinstance(a, numbers) or not isinstance(b, numbers):
+            return None
+        cls = mt.TlFloat if mt.TlFloat in (type(a), type(b)) else mt.TlInt
+        return cls(a + b if op == "+" else a * b)
+
+    if op in ("&&", "||"):
+        if not isinstance(a, mt.BOOLEANS) or not isinstance(b, mt.BOOLEANS):
+            return None
+        a, b = isinstance(a, mt.TlTrue), isinstance(b, mt.TlTrue)
+        result = (a and b) if op == "&&" else (a or b)
+    elif op == "==":
+        result = a == b
+    elif op in ("<", ">"):
+        try:
+            result = a < b if op == "<" else a > b
+        except TypeError:
+            return None
+    else:
+        return None
+
+    if result not in (True, False):
+        return None
+    return mt.TlTrue() if result else mt.TlFalse()
+
+
+def optimise_constants(n: nodes.N_Definition, global_names: Set[str]):
+    """Evaluate constant expressions in a definition at compile time
+
+    - binops with literal operands become a literal
+    - ifs with a literal condition are replaced by the branch that's taken
+    - list and hash constructors with literal arguments become a literal
+
+    Nested lambdas are optimised when they are compiled.
+    """
+    # Names that would be resolved before the builtins (see compile_name)
+    shadowed = set(find_locals(n)) | global_names
+
+    def fold_fields(node):
+        for f in dataclasses.fields(node):
+            setattr(node, f.name, fold(getattr(node, f.name)))
+
+    def fold(node):
+        if isinstance(node, list):
+            return [fold(item) for item in node]
+        elif isinstance(node, (nodes.N_Lambda, nodes.N_Definition)):
+            return node
+        elif not isinstance(node, nodes.Node):
+            return node
+
+        if isinstance(node, (nodes.N_Async, nodes.N_Await)) and isinstance(
+            node.expr, nodes.N_Call
+        ):
+            # async and await need a call, so only its arguments are folded
+            fold_fields(node.expr)
+            return node
+
+        fold_fields(node)
+
+        if isinstance(node, nodes.N_Progn):
+            # Splice in blocks left by pruned ifs (evaluates the same way, and
+            # keeps tail calls in the last position)
+            node.exprs = flatten(
+                e.exprs if isinstance(e, nodes.N_Progn) else [e] for e in node.exprs
+            )
+
+        elif isinstance(node, nodes.N_If):
+            cond = literal_value(node.cond)
+            if cond is not None:
+                # Same test as JumpIf
+                taken = not isinstance(cond, (mt.TlNull, mt.TlFalse))
+                return node.then if taken else node.els
+
+        elif isinstance(node, nodes.N_Binop) and calls_builtin(node.op, shadowed):
+            a, b = literal_value(node.lhs), literal_value(node.rhs)
+            if a is not None and b is not None:
+                value = fold_binop(node.op, a, b)
+                if value is not None:
+                    return nodes.N_Literal.from_node(node, value)
+
+        elif (
+            isinstance(node, nodes.N_Call)
+            and isinstance(node.fn, nodes.N_Id)
+            and node.fn.name in ("list", "hash")
+            and calls_builtin(node.fn.name, shadowed)
+        ):
+            values = [literal_value(arg) for arg in node.args]
+            if all(v is not None for v in values):
+                if node.fn.name == "list":
+                    value = mt.TlList(values)
+                else:
+                    try:
+                        value = mt.TlHash(zip(values[::2], values[1::2]))
+                    except TypeError:  # unhashable keys
+                        return node
+                return nodes.N_Literal.from_node(node, value)
+
+        return node
+
+    n.body = fold(n.body)
+
+
 def replace_gotos(code: list):
     """Replace Labels and Gotos with Jumps"""
     labels = {}
@@ -92,12 +269,77 @@ def replace_gotos(code: list):
     return code
 
 
+JUMPS = (mi.Jump, mi.JumpIf)
+
+
+def peephole(code: list) -> list:
+    """Simplify patterns in the (goto-free) code of one function
+
+    - StoreLocal N; Pop -> PopLocal N
+    - Jump 0 is removed
+
+    Instructions that are jumped to are never merged into the one before them,
+    and jumps are adjusted to the new positions. PopLocal keeps the source of
+    the StoreLocal.
+    """
+    targets = set(
+        idx + 1 + int(instr.operands[0])
+        for idx, instr in enumerate(code)
+        if isinstance(instr, JUMPS)
+    )
+    result = []
+    new_position = {}  # old index -> new index
+    jumps = []  # (old index, jump)
+    idx = 0
+    while idx < len(code):
+        instr = code[idx]
+        nxt = code[idx + 1] if idx + 1 < len(code) else None
+        new_position[idx] = len(result)
+        if (
+            isinstance(instr, mi.StoreLocal)
+            and isinstance(nxt, mi.Pop)
+            and idx + 1 not in targets
+        ):
+            result.append(mi.PopLocal(*instr.operands, source=instr.source))
+            idx += 2
+            continue
+
+        if isinstance(instr, mi.Jump) and int(instr.operands[0]) == 0:
+            pass
+        else:
+            if isinstance(instr, JUMPS):
+                jumps.append((idx, len(result)))
+            result.append(instr)
+        idx += 1
+    new_position[len(code)] = len(result)
+
+    changed = False
+    for old_idx, new_idx in jumps:
+        jump = result[new_idx]
+        target = new_position[old_idx + 1 + int(jump.operands[0])]
+        offset = target - (new_idx + 1)
+        result[new_idx] = type(jump)(mt.TlInt(offset), source=jump.source)
+        changed = changed or (offset == 0 and isinstance(jump, mi.Jump))
+
+    # Moving jumps can make new Jump 0s
+    return peephole(result) if changed else result
+
+
 class CompileToplevel:
-    def __init__(self, exprs):
-        """Compile a toplevel list of expressions"""
+    def __init__(self, exprs, count_saved=False):
+        """Compile a toplevel list of expressions
+
+        If COUNT_SAVED, also count the instructions that constant folding saves
+        in each function (by compiling it without folding too).
+        """
         self.functions = {}
+        self.local_names = {}
         self.attributes = {}
         self.bindings = {}
+        self.count_saved = count_saved
+        self.saved_instructions = {}  # identifier -> count, if count_saved
+        self.global_names = toplevel_names(exprs)
+        self.scope = None  # name -> slot, for the function being compiled
         self.labels = {}
         self.instruction_idx = 0
         for e in exprs:
@@ -107,35 +349,109 @@ class CompileToplevel:
         """Make a new executable function object with a unique name, and save it"""
         count = len(self.functions)
         identifier = f"#{count}:{name}"
-        start_label = nodes.N_Label.from_node(n, START_LABEL)
-        code = self.compile_function(optimise_tailcall(n))
-        fn_code = replace_gotos([start_label] + code)
+        # Before folding, which may prune assignments that are still referenced
+        local_names = find_locals(n)
+        if self.count_saved:
+            unfolded_size = len(self.compile_unfolded(n, local_names))
+        optimise_constants(n, self.global_names)
+        fn_code = self.compile_definition(n, local_names)
         self.functions[identifier] = fn_code
+        self.local_names[identifier] = local_names
+        if self.count_saved:
+            self.saved_instructions[identifier] = unfolded_size - len(fn_code)
         # self.attributes[identifier] = parse_attribute(n.attribute)
         return identifier
 
-    def compile_function(self, n: nodes.N_Definition) -> list:
-        """Compile a function into executable code"""
-        bindings = flatten(
-            [
-                [mi.Bind.from_node(n, mt.TlSymbol(arg)), mi.Pop.from_node(n)]
-                for arg in reversed(n.paramlist)
-            ]
+    def compile_definition(self, n: nodes.N_Definition, local_names: List[str]) -> list:
+        """Compile a definition into code with jumps"""
+        start_label = nodes.N_Label.from_node(n, START_LABEL)
+        code = self.compile_function(optimise_tailcall(n), local_names)
+        return replace_gotos([start_label] + code)
+
+    def compile_unfolded(self, n: nodes.N_Definition, local_names: List[str]) -> list:
+        """Compile a copy of N without constant folding, and discard it
+
+        Nested lambdas made along the way are forgotten, so the real compile
+        gives them the same identifiers.
+        """
+        state = (self.functions, self.local_names, self.saved_instructions)
+        self.functions, self.local_names, self.saved_instructions = (
+            dict(d) for d in state
         )
-        body = self.compile_expr(n.body)
+        self.count_saved = False
+        try:
+            code = self.compile_definition(copy.deepcopy(n), local_names)
+        finally:
+            self.functions, self.local_names, self.saved_instructions = state
+            self.count_saved = True
+        return code
+
+    def compile_function(self, n: nodes.N_Definition, local_names: List[str]) -> list:
+        """Compile a function into executable code, with LOCAL_NAMES in its frame"""
+        outer_scope = self.scope
+        self.scope = {name: slot for slot, name in enumerate(local_names)}
+        try:
+            bindings = flatten(
+                [
+                    [
+                        mi.StoreLocal.from_node(n, mt.TlInt(self.scope[arg])),
+                        mi.Pop.from_node(n),
+                    ]
+                    for arg in reversed(n.paramlist)
+                ]
+            )
+            body = self.compile_expr(n.body)
+        finally:
+            self.scope = outer_scope
         return bindings + body + [mi.Return.from_node(n)]
 
+    def shadowed_names(self) -> Set[str]:
+        """Names that take precedence over builtins here (see calls_builtin)"""
+        local_names = self.scope.keys() if self.scope is not None else ()
+        return self.global_names | set(local_names)
+
+    def compile_builtin_call(self, n: nodes.Node, name: str, num_args: int) -> list:
+        """Compile a call to builtin NAME, with arguments already on the stack
+
+        Builtin handlers get the number of arguments as their operand, so the
+        builtin's own instruction does the same as calling it by value. Those
+        with other operands are called by value.
+        """
+        cls = mi.BUILTINS[name]
+        if cls.num_ops is None and cls.op_types is None:
+            return [cls.from_node(n)]
+        elif cls.num_ops in (None, 1) and cls.op_types in (None, [int]):
+            return [cls.from_node(n, mt.TlInt(num_args))]
+        else:
+            call = mi.Call.from_node(n, mt.TlInt(num_args))
+            return self.compile_name(n, name) + [call]
+
+    def compile_name(self, n: nodes.Node, name: str) -> list:
+        """Compile a reference to NAME, resolving it at compile time
+
+        Precedence: local variable -> global binding -> builtin
+        """
+        if self.scope is not None and name in self.scope:
+            return [mi.LoadLocal.from_node(n, mt.TlInt(self.scope[name]))]
+        elif name in self.global_names:
+            return [mi.LoadGlobal.from_node(n, mt.TlSymbol(name))]
+        elif name in mi.BUILTINS:
+            return [mi.PushV.from_node(n, mt.TlInstruction(name))]
+        else:
+            raise TealCompileError(n, f"'{name}' is not defined")
+
     def wrap_foreign_function(self, n, qualified_name, num_args):
         """Wrap a foreign function in a Teal function"""
         fn_code = [
             # args will already be on the stack, ready
-            mi.PushB.from_node(n, mt.TlSymbol(qualified_name)),
+            mi.LoadGlobal.from_node(n, mt.TlSymbol(qualified_name)),
             mi.Call.from_node(n, mt.TlInt(num_args)),
             mi.Return.from_node(n),
         ]
         count = len(self.functions)
         identifier = f"#F:{qualified_name}"
         self.functions[identifier] = fn_code
+        self.local_names[identifier] = []
 
     ## At the toplevel, no executable code is created - only bindings
 
@@ -213,12 +529,13 @@ class CompileToplevel:
 
     @compile_expr.register
     def _(self, n: nodes.N_Literal):
-        val = mt.to_teal_type(n.value)
+        # Values made by optimise_constants are already Teal values
+        val = n.value if isinstance(n.value, mt.TlType) else mt.to_teal_type(n.value)
         return [mi.PushV.from_node(n, val)]
 
     @compile_expr.register
     def _(self, n: nodes.N_Id):
-        return [mi.PushB.from_node(n, mt.TlSymbol(n.name))]
+        return self.compile_name(n, n.name)
 
     @compile_expr.register
     def _(self, n: nodes.N_Progn):
@@ -237,6 +554,8 @@ class CompileToplevel:
         # NOTE: parser only allows direct, named function calls atm, not
         # arbitrary expressions, so no need to check the type of n.fn
         arg_code = flatten(self.compile_expr(arg) for arg in n.args)
+        if not is_async and calls_builtin(n.fn.name, self.shadowed_names()):
+            return arg_code + self.compile_builtin_call(n, n.fn.name, len(n.args))
         instr = mi.ACall if is_async else mi.Call
         return (
             arg_code
@@ -287,34 +606,48 @@ class CompileToplevel:
         if n.op == "=":
             if not isinstance(n.lhs, nodes.N_Id):
                 raise ValueError(f"Can't assign to non-identifier {n.lhs}")
-            return rhs + [mi.Bind.from_node(n, mt.TlSymbol(str(n.lhs.name)))]
+            slot = self.scope[n.lhs.name]
+            return rhs + [mi.StoreLocal.from_node(n, mt.TlInt(slot))]
 
         else:
             lhs = self.compile_expr(n.lhs)
+            op = str(n.op)
             # TODO check arg order. Reverse?
+            if calls_builtin(op, self.shadowed_names()):
+                return rhs + lhs + self.compile_builtin_call(n, op, 2)
             return (
                 rhs
                 + lhs
-                + [
-                    mi.PushB.from_node(n, mt.TlSymbol(str(n.op))),
-                    mi.Call.from_node(n, mt.TlInt(2)),
-                ]
+                + self.compile_name(n, op)
+                + [mi.Call.from_node(n, mt.TlInt(2))]
             )
 
 
 ###
 
 
-def tl_compile(top_nodes: list) -> Executable:
-    """Compile top-level nodes into an executable"""
-    collection = CompileToplevel(top_nodes)
+def tl_compile(top_nodes: list, count_saved=False) -> Executable:
+    """Compile top-level nodes into an executable
+
+    If COUNT_SAVED, the executable lists the instructions saved by constant
+    folding in each function (see CompileToplevel).
+    """
+    collection = CompileToplevel(top_nodes, count_saved)
 
     location_offset = 0
     code = []
     locations = {}
     for fn_name, fn_code in collection.functions.items():
+        fn_code = peephole(fn_code)
         locations[fn_name] = location_offset
         location_offset += len(fn_code)
         code += fn_code
 
-    return Executable(collection.bindings, locations, code, collection.attributes)
+    return Executable(
+        collection.bindings,
+        locations,
+        code,
+        collection.attributes,
+        collection.local_names,
+        saved_instructions=collection.saved_instructions,
+    )
@@ -1,6 +1,7 @@
 import os
 import logging
 from ast import literal_eval
+from bisect import bisect_right
 from itertools import chain
 from pathlib import Path
 from typing import Any
@@ -34,6 +35,26 @@ def index_column(text, index):
     return column
 
 
+class LineIndex:
+    """Line and column lookup for positions in a source text
+
+    Built once per text, so finding a position is a binary search instead of a
+    scan of the text. Nodes on the same line share the line's string.
+    """
+
+    def __init__(self, text):
+        self.lines = text.split("\n")
+        self.starts = [0]  # index of the start of each line
+        for line in self.lines[:-1]:
+            self.starts.append(self.starts[-1] + len(line) + 1)
+
+    def position(self, index):
+        """Get the (line number, line, column) of INDEX (see index_column)"""
+        lineno = bisect_right(self.starts, index)
+        last_cr = self.starts[lineno - 1] - 1 if lineno > 1 else 0
+        return lineno, self.lines[lineno - 1], index - last_cr
+
+
 class TealLexer(Lexer):
     def __init__(self, filename, source_text):
         super().__init__()
@@ -174,9 +195,7 @@ def post_lex(toks):
 def N(parser, parse_item, node_cls: n.Node, *args):
     """Factory for nodes with source text line and column information"""
     try:
-        lineno = parser.source_text[: parse_item.index].count("\n") + 1
-        line = parser.source_text.split("\n")[lineno - 1]
-        column = index_column(parser.source_text, parse_item.index)
+        lineno, line, column = parser.line_index.position(parse_item.index)
     except AttributeError:
         lineno = None
         line = None
@@ -193,6 +212,7 @@ class TealParser(Parser):
         super().__init__()
         self.filename = filename
         self.source_text = source_text
+        self.line_index = LineIndex(source_text)
 
     tokens = TealLexer.tokens
     precedence = (
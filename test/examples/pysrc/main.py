@@ -1,3 +1,4 @@
+import asyncio
 import time
 import random
 
@@ -26,3 +27,9 @@ def coin():
 
 def bad_fn():
     raise Exception("Something broke!")
+
+
+async def async_double(x):
+    """Double X, after yielding to the event loop"""
+    await asyncio.sleep(0.01)
+    return x * 2
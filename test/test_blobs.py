@@ -0,0 +1,66 @@
+"""Test storing big values in the blob store"""
+import json
+
+import pytest
+
+import teal_lang.machine.types as mt
+from teal_lang.machine import blobs, codec
+from teal_lang.machine.future import Future
+from teal_lang.machine.state import Frame, State, TlBlobRef
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = blobs.DirectoryBlobStore(tmp_path)
+    monkeypatch.setattr(blobs, "STORE", store)
+    monkeypatch.setattr(blobs, "THRESHOLD", 1000)
+    return store
+
+
+def big_state(big):
+    state = State([big, mt.TlInt(1), big])
+    state.frames = [Frame(mt.TlFunctionPtr("main", None), [big], arec_ptr=0)]
+    state.locals = state.frames[-1].locals
+    return state
+
+
+def blob_files(store):
+    return [p for p in store.path.glob("*/*") if p.is_file()]
+
+
+@pytest.mark.parametrize("format", ["binary", "json"])
+def test_big_values_stored_once(store, format):
+    big = mt.TlList([mt.TlString(f"item {i}") for i in range(1000)])
+    state = big_state(big)
+    if format == "binary":
+        data = codec.dumps(state)
+        back = codec.loads(data)
+    else:
+        data = json.dumps(state.serialise())
+        back = State.deserialise(json.loads(data))
+
+    assert len(data) < 500
+    assert len(blob_files(store)) == 1
+    assert isinstance(back._ds[0], TlBlobRef)
+    assert back == state
+    assert back.ds_pop() == big
+    assert back.locals[0] == big
+
+
+def test_future_value(store):
+    text = mt.TlString("x" * 2000)
+    future = Future(resolved=True, value=text)
+    back = codec.loads(codec.dumps(future))
+    assert isinstance(back.value, TlBlobRef)
+    assert back.value.force() == text
+    assert Future.deserialise(future.serialise()).value.force() == text
+
+    # Small values are stored inline
+    future.value = mt.TlString("x")
+    assert codec.loads(codec.dumps(future)).value == future.value
+    assert len(blob_files(store)) == 1
+
+
+def test_missing_blob(store):
+    with pytest.raises(blobs.BlobError):
+        TlBlobRef("0" * 64).force()
@@ -0,0 +1,98 @@
+"""Test the binary serialisation format"""
+import pytest
+
+import teal_lang.machine.types as mt
+from teal_lang.load import compile_text
+from teal_lang.machine import codec
+from teal_lang.machine.arec import ActivationRecord
+from teal_lang.machine.future import Future
+from teal_lang.machine.state import Frame, LazyFrame, LazyValue, State
+
+VALUES = [
+    mt.TlNull(),
+    mt.TlTrue(),
+    mt.TlFalse(),
+    mt.TlInt(-300),
+    mt.TlInt(2 ** 70),
+    mt.TlFloat(1.5),
+    mt.TlString("héllo"),
+    mt.TlSymbol("foo"),
+    mt.TlFuturePtr(3),
+    mt.TlFuturePtr("plugin:id"),
+    mt.TlQuote(mt.TlList([mt.TlInt(1)])),
+    mt.TlList([mt.TlString("a"), mt.TlList([]), mt.TlString("a")]),
+    mt.TlHash({mt.TlString("a"): mt.TlInt(1), mt.TlInt(2): mt.TlNull()}),
+    mt.TlFunctionPtr("#0:foo", None),
+    mt.TlForeignPtr("foo", "mod", "mod.foo"),
+]
+
+
+@pytest.mark.parametrize("obj", VALUES)
+def test_values(obj):
+    back = codec.loads(codec.dumps(obj))
+    assert type(back) == type(obj)
+    assert back == obj
+
+
+def test_records():
+    state = State([mt.TlList([mt.TlInt(i) for i in range(1000)])])
+    state.frames = [
+        Frame(mt.TlFunctionPtr("main", None), [mt.TlInt(1)], arec_ptr=3),
+        Frame(mt.TlFunctionPtr("foo", None), [None, mt.TlString("x")], 7),
+    ]
+    state.locals = state.frames[-1].locals
+    state.ip = 42
+    back = codec.loads(codec.dumps(state))
+    assert back == state
+    assert back.locals is back.frames[-1].locals
+    assert len(codec.dumps(state)) < len(str(state.serialise())) / 4
+
+    arec = ActivationRecord(
+        function=mt.TlFunctionPtr("foo", None),
+        dynamic_chain=0,
+        vmid=1,
+        ref_count=2,
+        call_site=5,
+        locals=[mt.TlInt(0), None],
+    )
+    assert codec.loads(codec.dumps(arec)) == arec
+
+    future = Future(continuations=[1, 2], chain=3, resolved=True, value=mt.TlInt(0))
+    assert codec.loads(codec.dumps(future)).serialise() == future.serialise()
+
+
+def test_executable():
+    exe = compile_text("fn foo(a) { b = [a, 1.5, \"x\"]; b }")
+    assert codec.loads(codec.dumps(exe)).serialise() == exe.serialise()
+
+
+def test_bad_data():
+    with pytest.raises(codec.CodecError):
+        codec.loads(b"not teal data")
+    with pytest.raises(codec.CodecError):
+        codec.dumps(object())
+
+
+def test_lazy_state():
+    big = mt.TlList([mt.TlString(f"s{i % 7}") for i in range(100)])
+    state = State([mt.TlHash({mt.TlString("k"): big}), mt.TlInt(1), big])
+    state.frames = [Frame(mt.TlFunctionPtr("main", None), [big, None], arec_ptr=0)]
+    state.locals = state.frames[-1].locals
+    data = codec.dumps(state)
+
+    back = codec.loads(data)
+    assert not isinstance(back._ds[0], LazyValue)  # too small
+    assert isinstance(back._ds[2], LazyValue)
+    assert isinstance(back.locals, LazyFrame)
+    # Untouched values are copied, not decoded
+    assert codec.dumps(back) == data
+    assert back.ds_pop() == big
+    assert back.locals[0] == big
+    assert back.locals[1] is None
+
+    back.ds_push(mt.TlString("new"))
+    again = codec.loads(codec.dumps(back))
+    assert again == back
+    assert again == State.deserialise(back.serialise())
+    assert again.ds_pop() == mt.TlString("new")
+    assert again.ds_peek(1) == state.ds_peek(2)
@@ -0,0 +1,149 @@
+"""Test the Teal compiler"""
+import pytest
+
+import teal_lang.load as load
+import teal_lang.machine.executable as me
+import teal_lang.machine.instructionset as mi
+import teal_lang.machine.types as mt
+from teal_lang.load import compile_text
+from teal_lang.teal_compiler.compiler import TealCompileError, peephole, tl_compile
+from teal_lang.teal_parser.parser import LineIndex, index_column, tl_parse
+
+
+def fn_code(exe, name):
+    """Get the code of a (non-foreign) function in an executable"""
+    identifier = exe.bindings[name].identifier
+    start = exe.locations[identifier]
+    ends = [loc for loc in exe.locations.values() if loc > start]
+    return exe.code[start : min(ends, default=len(exe.code))], identifier
+
+
+def test_local_slots():
+    exe = compile_text("fn foo(a, b) { c = a + b; c }")
+    code, identifier = fn_code(exe, "foo")
+    assert exe.local_names[identifier] == ["a", "b", "c"]
+    assert mi.LoadLocal(mt.TlInt(2)) in code
+    assert not any(isinstance(i, mi.LoadGlobal) for i in code)
+
+
+def test_globals_and_builtins():
+    exe = compile_text("fn foo() { bar() }\nfn bar() { length([1]) }")
+    code, _ = fn_code(exe, "foo")
+    assert mi.LoadGlobal(mt.TlSymbol("bar")) in code
+    code, _ = fn_code(exe, "bar")
+    assert mi.Length() in code
+
+
+def test_builtin_calls():
+    exe = compile_text(
+        "fn foo(x) { future(x, 1) }\nfn bar(length) { length(1) }\nfn baz(x) { x + 1 }"
+    )
+    # future's instruction takes other operands, so it's called by value
+    code, _ = fn_code(exe, "foo")
+    assert code[-3:-1] == [mi.PushV(mt.TlInstruction("future")), mi.Call(mt.TlInt(2))]
+    code, _ = fn_code(exe, "bar")
+    assert code[-2] == mi.Call(mt.TlInt(1))
+    code, _ = fn_code(exe, "baz")
+    assert code[-2] == mi.Plus()
+
+
+def test_undefined():
+    with pytest.raises(TealCompileError):
+        compile_text("fn foo() { bar }")
+
+
+def test_exe_cache(tmp_path, monkeypatch):
+    filename = tmp_path / "cached.tl"
+    filename.write_text("fn main() { 1 }")
+    cache_dir = tmp_path / "cache"
+    exe = load.compile_file(filename, cache_dir)
+    assert load.compile_file(filename, cache_dir) is exe
+    assert me.Executable.deserialise(exe.serialise()) is exe
+
+    # A new process loads it from disk, without compiling
+    monkeypatch.setattr(me, "_cache", me.OrderedDict())
+    monkeypatch.setattr(load, "tl_parse", None)
+    again = load.compile_file(filename, cache_dir)
+    assert again is not exe
+    assert again.serialise() == exe.serialise()
+
+    assert load.source_key("fn main() { 2 }") != exe.source_key
+
+
+def test_line_index():
+    text = "fn a() {\n  1\n}\n\nfn b() { 2 }"
+    index = LineIndex(text)
+    for i in range(len(text)):
+        lineno = text[:i].count("\n") + 1
+        line = text.split("\n")[lineno - 1]
+        assert index.position(i) == (lineno, line, index_column(text, i))
+
+
+def test_constant_folding():
+    text = """
+fn foo(x) {
+  if 1 + 2 * 3 == 7 { [1, 2.5 * 2, "a" < "b"] } else { foo(x) }
+}
+fn bar() { list = 1; list(list, 2) }
+fn baz() { 1 + "a" }
+fn qux(x) { if false { y = 1 }; if x { y } else { 0 } }
+"""
+    exe = tl_compile(tl_parse("<string>", text), count_saved=True)
+    code, identifier = fn_code(exe, "foo")
+    value = mt.TlList([mt.TlInt(1), mt.TlFloat(5.0), mt.TlTrue()])
+    assert code[1:] == [mi.PushV(value), mi.Return()]
+    assert exe.saved_instructions[identifier] == 18
+
+    # Shadowed builtins and operations that fail at run time are left alone
+    for name, call in (("bar", mi.Call), ("baz", mi.Plus)):
+        code, identifier = fn_code(exe, name)
+        assert isinstance(code[-2], call)
+        assert exe.saved_instructions[identifier] == 0
+
+    # Assignments in pruned branches still make local variables
+    code, identifier = fn_code(exe, "qux")
+    assert exe.local_names[identifier] == ["x", "y"]
+    assert mi.LoadLocal(mt.TlInt(1)) in code
+
+    # Only counted on request
+    assert not compile_text(text).saved_instructions
+
+
+def test_peephole():
+    exe = compile_text("fn foo(a) { b = a; if a { 1 } else { list(b) } }")
+    code, _ = fn_code(exe, "foo")
+    assert code == [
+        mi.PopLocal(mt.TlInt(0)),
+        mi.LoadLocal(mt.TlInt(0)),
+        mi.PopLocal(mt.TlInt(1)),
+        mi.LoadLocal(mt.TlInt(0)),
+        mi.JumpIf(mt.TlInt(3)),
+        mi.LoadLocal(mt.TlInt(1)),
+        mi.List(mt.TlInt(1)),
+        mi.Jump(mt.TlInt(1)),
+        mi.PushV(mt.TlInt(1)),
+        mi.Return(),
+    ]
+
+    # Jumps are moved over merged and removed instructions
+    source = ["foo.tl", 1, "b = a", 0]
+    code = [
+        mi.LoadLocal(mt.TlInt(0)),
+        mi.JumpIf(mt.TlInt(4)),
+        mi.StoreLocal(mt.TlInt(1), source=source),
+        mi.Pop(),
+        mi.Jump(mt.TlInt(0)),
+        mi.StoreLocal(mt.TlInt(1)),
+        mi.Pop(),  # jumped to, so not merged
+        mi.Return(),
+    ]
+    code = peephole(code)
+    assert code == [
+        mi.LoadLocal(mt.TlInt(0)),
+        mi.JumpIf(mt.TlInt(2)),
+        mi.PopLocal(mt.TlInt(1)),
+        mi.StoreLocal(mt.TlInt(1)),
+        mi.Pop(),
+        mi.Return(),
+    ]
+    assert code[2].source == source
@@ -1,18 +1,30 @@
 """Test Controller features"""
+import tempfile
+import threading
+from functools import lru_cache
+from pathlib import Path
+
 import pytest
 import teal_lang.controllers.ddb_model as db
 import teal_lang.machine.types as mt
 from teal_lang.controllers.ddb import DataController as DdbController
 from teal_lang.controllers.local import DataController as LocalController
+from teal_lang.controllers.shared import DataController as SharedController
+from teal_lang.controllers.sqlite import DataController as SqliteController
 from teal_lang.machine.arec import ActivationRecord
 from teal_lang.machine.future import Future
 from teal_lang.machine.probe import Probe
 from teal_lang.machine.state import State
 
-pytestmark = pytest.mark.ddblocal
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
 
 
-def setup_module(module):
+@lru_cache(maxsize=None)
+def create_session_table():
+    """Make a new, empty session table (once) for the DynamoDB controllers"""
     if db.SessionItem.exists():
         db.SessionItem.delete_table()
     db.SessionItem.create_table(
@@ -21,13 +33,41 @@ def setup_module(module):
 
 
 def NewDdbSession():
+    create_session_table()
     base = db.init_base_session()
     return DdbController(db.new_session(), base)
 
 
+def NewBinaryDdbSession():
+    create_session_table()
+    return DdbController.with_new_session(codec="binary")
+
+
+SQLITE_PATH = Path(tempfile.mkdtemp()) / "sessions.db"
+REDIS_SERVER = fakeredis.FakeServer() if fakeredis else None
+
+
+def NewSqliteSession():
+    return SqliteController.with_new_session(SQLITE_PATH)
+
+
+def NewRedisSession():
+    from teal_lang.controllers.redis import DataController as RedisController
+
+    return RedisController.with_new_session(fakeredis.FakeRedis(server=REDIS_SERVER))
+
+
 CONTROLLERS = [
     LocalController,
+    SharedController,
+    NewSqliteSession,
+    pytest.param(
+        NewRedisSession,
+        marks=[pytest.mark.skipif(fakeredis is None, reason="needs fakeredis")],
+    ),
+    # Only the DynamoDB controllers need a DynamoDB endpoint (and --testddb)
     pytest.param(NewDdbSession, marks=[pytest.mark.ddblocal]),
+    pytest.param(NewBinaryDdbSession, marks=[pytest.mark.ddblocal]),
 ]
 
 
@@ -59,14 +99,16 @@ def test_arec(Controller):
         vmid=0,
         ref_count=0,
         call_site=0,
-        bindings={"foo": mt.TlString("hello")},
+        locals=[mt.TlString("hello"), None],
     )
     ctrl.set_arec(r, rec)
     rec2 = ctrl.get_arec(r)
     assert rec == rec2
 
     previous = rec2.ref_count
-    ctrl.increment_ref(r)
+    count = ctrl.increment_ref(r)
+    if not isinstance(ctrl, DdbController):  # doesn't return the count (yet)
+        assert count == previous + 1
     rec2 = ctrl.get_arec(r)
     assert rec2.ref_count == previous + 1
 
@@ -98,7 +140,7 @@ def test_probe(Controller):
     probe.log("foobar")
 
     ctrl.set_probe_data(t, probe)
-    logs = ctrl.get_probe_logs()
+    logs = list(ctrl.get_probe_logs())
     assert len(logs) == 1
     assert logs[0].text == "foobar"
 
@@ -122,3 +164,129 @@ def test_future(Controller):
     ctrl.add_continuation(t, 5)
     f2 = ctrl.get_future(t)
     assert f2.continuations == [5]
+
+
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_update_future(Controller):
+    ctrl = Controller()
+    t = ctrl.new_thread()
+    ctrl.set_future(t, Future())
+    calls = []
+
+    def wait(future):
+        if not calls:
+            # Another machine gets in first
+            ctrl.add_continuation(t, 1)
+        calls.append(1)
+        future.continuations.append(2)
+        return True, len(calls)
+
+    ctrl.update_future(t, wait)
+    assert ctrl.get_future(t).continuations == [1, 2]
+
+
+@pytest.mark.parametrize("Controller", CONTROLLERS)
+def test_wait_all_stopped(Controller):
+    ctrl = Controller()
+    threads = [ctrl.new_thread() for _ in range(2)]
+    for vmid in threads:
+        ctrl.set_stopped(vmid, False)
+    assert not ctrl.wait_all_stopped(0.05)
+
+    # Thread 0 is resumed before it has finished stopping
+    ctrl.set_stopped(threads[0], False)
+    ctrl.set_stopped(threads[0], True)
+    assert not ctrl.wait_all_stopped(0.05)
+    ctrl.set_stopped(threads[0], True)
+
+    timer = threading.Timer(0.1, ctrl.set_stopped, (threads[1], True))
+    timer.start()
+    assert ctrl.wait_all_stopped(5)
+    timer.join()
+
+
+def test_local_concurrency():
+    ctrl = LocalController()
+    futures = [ctrl.new_thread() for _ in range(4)]
+    for vmid in futures:
+        ctrl.set_future(vmid, Future())
+    new_ids = []
+
+    def work():
+        for i in range(500):
+            new_ids.append(ctrl.new_thread())
+            ctrl.update_future(futures[i % 4], wait)
+
+    def wait(future):
+        future.continuations.append(len(future.continuations))
+        return True, None
+
+    workers = [threading.Thread(target=work) for _ in range(8)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert len(set(new_ids)) == 8 * 500
+    for vmid in futures:
+        assert ctrl.get_future(vmid).continuations == list(range(1000))
+
+
+def test_shared_processes():
+    from teal_lang.controllers.shared import FORK
+
+    ctrl = SharedController()
+    futures = [ctrl.new_thread() for _ in range(2)]
+    for vmid in futures:
+        ctrl.set_future(vmid, Future())
+    new_ids = FORK.SimpleQueue()
+
+    def work():
+        for i in range(50):
+            new_ids.put(ctrl.new_thread())
+            ctrl.update_future(futures[i % 2], wait)
+
+    def wait(future):
+        future.continuations.append(len(future.continuations))
+        return True, None
+
+    workers = [FORK.Process(target=work) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert all(w.exitcode == 0 for w in workers)
+    ids = [new_ids.get() for _ in range(4 * 50)]
+    assert len(set(ids) | set(futures)) == 4 * 50 + 2
+    for vmid in futures:
+        assert ctrl.get_future(vmid).continuations == list(range(100))
+
+
+def test_sqlite_concurrency():
+    session = NewSqliteSession()
+    futures = [session.new_thread() for _ in range(2)]
+    for vmid in futures:
+        session.set_future(vmid, Future())
+    new_ids = []
+
+    def work():
+        # Each worker has its own controller (and connection), like a process
+        ctrl = SqliteController.with_session_id(session.session_id, SQLITE_PATH)
+        for i in range(50):
+            new_ids.append(ctrl.new_thread())
+            ctrl.update_future(futures[i % 2], wait)
+
+    def wait(future):
+        future.continuations.append(len(future.continuations))
+        return True, None
+
+    workers = [threading.Thread(target=work) for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    assert len(set(new_ids)) == 4 * 50
+    for vmid in futures:
+        assert session.get_future(vmid).continuations == list(range(100))
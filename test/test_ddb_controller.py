@@ -0,0 +1,66 @@
+"""Test features specific to the DynamoDB controller"""
+import pytest
+import teal_lang.controllers.ddb_model as db
+from teal_lang.controllers.ddb import DataController as DdbController
+from teal_lang.machine.probe import Probe
+
+pytestmark = pytest.mark.ddblocal
+
+
+def setup_module(module):
+    if db.SessionItem.exists():
+        db.SessionItem.delete_table()
+    db.SessionItem.create_table(
+        read_capacity_units=1, write_capacity_units=1, wait=True
+    )
+
+
+def NewDdbSession():
+    base = db.init_base_session()
+    return DdbController(db.new_session(), base)
+
+
+def test_id_leases():
+    ctrl1 = NewDdbSession()
+    ctrl2 = DdbController.with_session_id(ctrl1.session_id)
+    threads = [c.new_thread() for c in (ctrl1, ctrl2, ctrl1)]
+    arecs = [c.new_arec() for c in (ctrl2, ctrl1, ctrl2)]
+    assert threads[0] == 0
+    assert len(set(threads)) == len(set(arecs)) == 3
+
+    for vmid in threads:
+        ctrl2.set_stopped(vmid, False)
+    assert ctrl1.get_thread_ids() == sorted(threads)
+    assert not ctrl1.all_stopped()
+
+
+def test_lock_lease():
+    ctrl = NewDdbSession()
+    t = ctrl.new_thread()
+    key = f"{db.FUTURE}:{t}"
+
+    # Take a lock and never release it
+    crashed = db.SessionLocker(ctrl.SI.get(ctrl.session_id, key), lease=1.0)
+    crashed.__enter__()
+
+    other = db.SessionLocker(ctrl.SI.get(ctrl.session_id, key), timeout=0.1)
+    with pytest.raises(db.LockTimeout):
+        other.__enter__()
+
+    other.timeout = 5.0
+    with other:
+        pass
+
+
+def test_probe_shards():
+    ctrl = NewDdbSession()
+    probe = Probe(1)
+    for i in range(2 * db.SHARD_SIZE + 1):
+        probe.event("step", i=i)
+    ctrl.set_probe_data(1, probe)
+
+    shards = list(ctrl.iter_shards(db.PEVENTS))
+    assert [len(records) for _, records in shards] == [db.SHARD_SIZE] * 2 + [1]
+    assert list(ctrl.iter_shards(db.PEVENTS, shards[0][0])) == shards[1:]
+    events = list(ctrl.get_probe_events())
+    assert [e.data["i"] for e in events] == list(range(2 * db.SHARD_SIZE + 1))
@@ -1,19 +1,45 @@
 import logging
 import random
 import sys
+import tempfile
+from functools import partial
 from pathlib import Path
 
 import pytest
 import teal_lang.controllers.ddb_model as db
 import teal_lang.examples as teal_examples
 from teal_lang.machine.types import TlType, to_py_type, to_teal_type
-from teal_lang.run.dynamodb import run_ddb_local, run_ddb_processes
-from teal_lang.run.local import run_local
+from teal_lang.run.dynamodb import run_ddb_local, run_ddb_pool, run_ddb_processes
+from teal_lang.run.local import (
+    run_local,
+    run_local_asyncio,
+    run_local_pool,
+    run_local_processes,
+)
+from teal_lang.run.sqlite import run_sqlite
+
+try:
+    import fakeredis
+    from teal_lang.run.redis import run_redis_pool
+except ImportError:
+    fakeredis = None
 
 LOG = logging.getLogger(__name__)
 
+SQLITE_PATH = Path(tempfile.mkdtemp()) / "sessions.db"
+
 CALL_METHODS = [
     run_local,
+    run_local_pool,
+    run_local_asyncio,
+    pytest.param(run_local_processes, marks=[pytest.mark.slow]),
+    pytest.param(partial(run_sqlite, path=SQLITE_PATH), id="run_sqlite"),
+    pytest.param(
+        fakeredis and partial(run_redis_pool, client=fakeredis.FakeRedis()),
+        marks=[pytest.mark.skipif(fakeredis is None, reason="needs fakeredis")],
+        id="run_redis_pool",
+    ),
+    pytest.param(run_ddb_pool, marks=[pytest.mark.slow, pytest.mark.ddblocal]),
     pytest.param(run_ddb_local, marks=[pytest.mark.slow, pytest.mark.ddblocal]),
     pytest.param(run_ddb_processes, marks=[pytest.mark.slow, pytest.mark.ddblocal]),
 ]
@@ -38,9 +64,9 @@ def session_db(pytestconfig):
     if not pytestconfig.getoption("testddb"):
         return
 
-    from . import test_controllers
+    from . import test_ddb_controller
 
-    test_controllers.setup_module(None)
+    test_ddb_controller.setup_module(None)
 
 
 @pytest.mark.parametrize("filename,function,args,expected", TESTS, ids=IDS)
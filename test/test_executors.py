@@ -0,0 +1,136 @@
+"""Test the executors that are not covered by test_examples"""
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+
+import pytest
+from teal_lang.controllers import local
+from teal_lang.executors import thread as teal_thread
+from teal_lang.run.common import run_and_wait, wait_for_finish
+from teal_lang.run.local import run_local_asyncio, run_local_pool
+
+SLEEPERS = """
+import(async_double, :python pysrc.main, 1);
+
+fn nap(n) {
+  NAP;
+  async_double(n)
+}
+
+fn spawn(n, futures) {
+  if n == 0 {
+    futures
+  } else {
+    f = async nap(n);
+    spawn(n + -1, conc(f, futures))
+  }
+}
+
+fn total(futures, acc) {
+  if futures == [] {
+    acc
+  } else {
+    total(rest(futures), acc + await first(futures))
+  }
+}
+
+fn main() {
+  total(spawn(50, []), 0)
+}
+"""
+
+
+@pytest.mark.parametrize("nap", ["sleep(0.2)", "s = sleep; s(0.2)"])
+def test_asyncio_threads_run_concurrently(tmp_path, nap):
+    filename = tmp_path / "sleepers.tl"
+    filename.write_text(SLEEPERS.replace("NAP", nap))
+    start = time.time()
+    result = run_local_asyncio(str(filename), "main", [])
+    assert result == 2 * sum(range(1, 51))
+    # 50 threads, each sleeping for 0.2s
+    assert time.time() - start < 2
+
+
+CHAIN = """
+fn leaf() {
+  sleep(0.2);
+  1
+}
+
+fn middle() {
+  x = async leaf();
+  await x + 10
+}
+
+fn main() {
+  y = async middle();
+  await y + 100
+}
+"""
+
+
+def test_pool_workers_exit(tmp_path):
+    filename = tmp_path / "chain.tl"
+    filename.write_text(CHAIN)
+    assert run_local_pool(str(filename), "main", []) == 111
+
+    def workers():
+        return [t for t in threading.enumerate() if t.name.startswith("teal_")]
+
+    # The pool is shut down when run_and_wait returns, without waiting
+    deadline = time.time() + 2
+    while workers() and time.time() < deadline:
+        time.sleep(0.01)
+    assert not workers()
+
+
+class CountingInvoker(teal_thread.Invoker):
+    """Thread invoker that records the threads it invokes"""
+
+    inline = True
+
+    def __init__(self, data_controller):
+        super().__init__(data_controller)
+        self.invoked = []
+
+    def can_continue_inline(self):
+        return self.inline
+
+    def invoke(self, vmid, run_async=True):
+        self.invoked.append(vmid)
+        super().invoke(vmid, run_async)
+
+
+@pytest.mark.parametrize("inline", [True, False])
+def test_continue_inline(tmp_path, inline):
+    filename = tmp_path / "chain.tl"
+    filename.write_text(CHAIN)
+    controller = local.DataController()
+    invoker = CountingInvoker(controller)
+    invoker.inline = inline
+    waiter = partial(wait_for_finish, 0.1, 10)
+    result = run_and_wait(controller, invoker, waiter, str(filename), "main", [])
+
+    assert result == 111
+    # Three threads are started. Inline, middle is resumed by leaf's machine
+    # when leaf finishes, and then main is, so neither is invoked again.
+    assert len(set(invoker.invoked)) == 3
+    assert len(invoker.invoked) == (3 if inline else 5)
+    assert controller.wait_all_stopped(0)
+    assert all(controller.get_state(vmid).stopped for vmid in set(invoker.invoked))
+
+
+def test_lambda_continue_inline(monkeypatch):
+    monkeypatch.setenv("RESUME_FN_NAME", "resume")
+    from teal_lang.executors import awslambda
+
+    monkeypatch.setattr(awslambda, "INLINE_MIN_REMAINING_MS", 60000)
+
+    def context(remaining_ms):
+        return SimpleNamespace(get_remaining_time_in_millis=lambda: remaining_ms)
+
+    controller = local.DataController()
+    assert not awslambda.Invoker(controller).can_continue_inline()
+    assert not awslambda.Invoker(controller, context(59999)).can_continue_inline()
+    assert awslambda.Invoker(controller, context(60000)).can_continue_inline()
@@ -1,6 +1,8 @@
 import json
+import sys
 
 import teal_lang.machine.instructionset as instructionset
+from teal_lang.machine.executable import link_operands
 from teal_lang.machine.instruction import Instruction
 from teal_lang.machine.instructionset import *
 from teal_lang.machine.types import *
@@ -20,3 +22,11 @@ def test_jsonable():
     jdeser = json.loads(jser)
     deser = Instruction.deserialise(jdeser, instructionset)
     assert instr == deser
+
+
+def test_link_operands():
+    assert link_operands(Jump(TlInt(5))) == 5
+    assert type(link_operands(Jump(TlInt(5)))) is int
+    assert link_operands(LoadGlobal(TlSymbol("foo"))) is sys.intern("foo")
+    assert link_operands(PushV(TlInt(3))) == TlInt(3)
+    assert link_operands(Pop()) is None
@@ -53,7 +53,7 @@ def test_lists():
 def test_list():
     list_a = TlList([TlInt(1), TlInt(2), TlInt(3)])
     assert len(list_a) == 3
-    list_a.append(TlInt(789))
+    list_a = list_a.appended(TlInt(789))
     assert len(list_a) == 4
     deser = to_json_and_back(list_a)
     print(deser)
@@ -61,6 +61,24 @@ def test_list():
     assert deser[3] == TlInt(789)
 
 
+def test_list_sharing():
+    base = TlList([TlInt(i) for i in range(100)])
+    consed = base.cons(TlInt(-1))
+    appended = base.rest().appended(TlInt(100))
+    assert len(base) == 100 and base[0] == TlInt(0)
+    assert consed[0] == TlInt(-1) and consed[100] == TlInt(99)
+    assert appended[0] == TlInt(1) and appended[-1] == TlInt(100)
+    assert to_json_and_back(consed) == consed
+
+
+def test_hash_set():
+    h = TlHash({TlInt(1): TlInt(2)})
+    h2 = h.set(TlString("a"), TlInt(3)).set(TlInt(1), TlInt(4))
+    assert dict(h) == {TlInt(1): TlInt(2)}
+    assert list(h2.items()) == [(TlInt(1), TlInt(4)), (TlString("a"), TlInt(3))]
+    assert to_json_and_back(h2) == h2
+
+
 def test_quote():
     obj = TlQuote(TlList([TlInt(1), TlString("foo")]))
     deser = to_json_and_back(obj)